@@ -0,0 +1,416 @@
+"""
+Compressed archive of the raw DPRNT text of every cycle.
+
+# Segments and cycle counts per machine
+python haas_archive.py list
+
+# Print the raw cycles of one part in December
+python haas_archive.py cat -m st30l -p 265-4183 --since 2025-12-01 --until 2026-01-01
+"""
+
+import argparse
+import gzip
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from typing import IO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+# archive/<machine>/<YYYYmmdd>_<NNN>.gz with its index <YYYYmmdd>_<NNN>.idx
+SEGMENT_RE = re.compile(r"^(?P<day>\d{8})_(?P<number>\d{3})\.gz$")
+
+
+class IndexEntry(NamedTuple):
+    """
+    One line of a segment index: where a cycle is and what it is.
+    """
+
+    timestamp: str
+    part_number: str
+    offset: int
+    length: int
+    cycle_id: str = ""
+
+
+class ArchivedCycle(NamedTuple):
+    """
+    A cycle read back from the archive.
+    """
+
+    machine: str
+    timestamp: str
+    part_number: str
+    data: str
+    cycle_id: str = ""
+
+
+def read_index(segment_path: str) -> List[IndexEntry]:
+    """
+    Read the index of a segment.
+
+    Args:
+        segment_path: Path of the .gz segment.
+
+    Returns:
+        The entries in the order the cycles were archived. Lines written before
+        cycles had ids have an empty cycle_id. A last line without its newline was
+        being written when the process died and is left out.
+    """
+    entries = []
+    index_path = segment_path[: -len(".gz")] + ".idx"
+    if not os.path.isfile(index_path):
+        return entries
+    with open(index_path, encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            fields = line[:-1].split("\t")
+            if len(fields) in (4, 5):
+                offset, length = int(fields[2]), int(fields[3])
+                entries.append(
+                    IndexEntry(fields[0], fields[1], offset, length, *fields[4:])
+                )
+    return entries
+
+
+class _Segment:
+    """
+    The segment a machine is currently archiving to.
+    """
+
+    def __init__(self, directory: str, day: str, number: int) -> None:
+        self.day = day
+        self.number = number
+        base = os.path.join(directory, f"{day}_{number:03d}")
+        self.path = f"{base}.gz"
+        index_path = f"{base}.idx"
+
+        # Drop the tail of a cycle that was being written when the process died:
+        # a partial last index line, so the next line starts on a line of its own,
+        # and data past the last indexed cycle, so the segment stays a valid gzip
+        # file and the offsets stay right
+        if os.path.isfile(index_path):
+            with open(index_path, "rb") as f:
+                complete = f.read().rfind(b"\n") + 1
+            if os.path.getsize(index_path) > complete:
+                os.truncate(index_path, complete)
+        entries = read_index(self.path)
+        end = entries[-1].offset + entries[-1].length if entries else 0
+        self.data: IO[bytes] = open(self.path, "ab")
+        if self.data.tell() > end:
+            self.data.truncate(end)
+        self.size = end
+        self.index: IO[str] = open(index_path, "a", encoding="utf-8")
+
+    def close(self) -> None:
+        self.data.close()
+        self.index.close()
+
+
+class CycleArchive:
+    """
+    Append-only archive of raw cycles, one set of segments per machine.
+
+    Every cycle is compressed as its own gzip member and appended to the machine's
+    current segment, so a segment is a normal .gz file (zcat prints every cycle)
+    and any one cycle can be decompressed on its own. A sidecar index holds one
+    line per cycle with the receive timestamp, part number, byte offset,
+    compressed length and cycle id. Segments are named after the day and rotate
+    at midnight or when they reach max_segment_bytes, so reading a month of
+    history only opens that month's segments, and only the cycles that match are
+    decompressed. When a machine starts a new day, its segments older than
+    keep_days are deleted.
+
+    The archive is shared by every logger in a process and is thread safe.
+    """
+
+    def __init__(
+        self,
+        directory: str = "archive",
+        max_segment_bytes: int = 64 * 1024 * 1024,
+        keep_days: int = 90,
+    ) -> None:
+        """
+        Initialize the archive. Segments are opened on first use.
+
+        Args:
+            directory: Root directory of the archive.
+            max_segment_bytes: Size at which a segment is closed and a new one started.
+            keep_days: Days of cycles kept per machine. 0 keeps every cycle.
+        """
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.keep_days = keep_days
+        self._segments: Dict[str, _Segment] = {}
+        self._lock = threading.Lock()
+
+    def _segment_for(self, machine: str, day: str) -> _Segment:
+        """
+        Get the segment a cycle of this machine and day goes to. The lock must be held.
+
+        Args:
+            machine: Machine name.
+            day: Receive day as YYYYmmdd.
+
+        Returns:
+            The open segment, rotated if needed.
+        """
+        segment = self._segments.get(machine)
+        if segment is not None and segment.day == day:
+            if segment.size < self.max_segment_bytes:
+                return segment
+            number = segment.number + 1
+        else:
+            # Continue the last segment of the day, if an earlier run started one
+            machine_dir = os.path.join(self.directory, machine)
+            os.makedirs(machine_dir, exist_ok=True)
+            filenames = os.listdir(machine_dir)
+            self._prune(machine_dir, filenames, day)
+            numbers = [
+                int(match.group("number"))
+                for match in map(SEGMENT_RE.match, filenames)
+                if match and match.group("day") == day
+            ]
+            number = max(numbers, default=0)
+
+        if segment is not None:
+            segment.close()
+        segment = _Segment(os.path.join(self.directory, machine), day, number)
+        if segment.size >= self.max_segment_bytes:
+            segment.close()
+            segment = _Segment(os.path.join(self.directory, machine), day, number + 1)
+        self._segments[machine] = segment
+        return segment
+
+    def _prune(self, machine_dir: str, filenames: List[str], day: str) -> None:
+        """
+        Delete the segments of one machine that are older than keep_days. The lock
+        must be held.
+
+        Args:
+            machine_dir: Archive directory of the machine.
+            filenames: Files in that directory.
+            day: Day the machine is starting, as YYYYmmdd.
+        """
+        if self.keep_days <= 0:
+            return
+        start = datetime.strptime(day, "%Y%m%d") - timedelta(days=self.keep_days)
+        oldest = start.strftime("%Y%m%d")
+        removed = 0
+        for filename in filenames:
+            match = SEGMENT_RE.match(filename)
+            if not match or match.group("day") >= oldest:
+                continue
+            base = os.path.join(machine_dir, filename[: -len(".gz")])
+            try:
+                # Index first, a segment without one is never read
+                if os.path.isfile(f"{base}.idx"):
+                    os.remove(f"{base}.idx")
+                os.remove(f"{base}.gz")
+                removed += 1
+            except OSError as e:
+                print(f"[archive] ERROR: Could not remove {base}.gz: {e}")
+        if removed:
+            print(
+                f"[archive] Removed {removed} segment(s) older than {self.keep_days} days from {machine_dir}"
+            )
+
+    def append(
+        self, machine: str, cycles: List[Tuple[str, Optional[str], str, str]]
+    ) -> None:
+        """
+        Archive raw cycles of one machine.
+
+        A cycle replayed from the journal after a crash can be archived twice,
+        readers skip the second copy by its cycle id.
+
+        Args:
+            machine: Machine name.
+            cycles: List of (timestamp, part_number, data, cycle_id) tuples. The
+            timestamp is the receive time as YYYY-mm-dd HH:MM:SS.
+        """
+        with self._lock:
+            for timestamp, part_number, data, cycle_id in cycles:
+                day = timestamp[:10].replace("-", "")
+                segment = self._segment_for(machine, day)
+                member = gzip.compress(data.encode("utf-8"), mtime=0)
+                segment.data.write(member)
+                # Data before index, so the index never points past the data
+                segment.data.flush()
+                part = (part_number or "").replace("\t", " ")
+                segment.index.write(
+                    f"{timestamp}\t{part}\t{segment.size}\t{len(member)}\t{cycle_id}\n"
+                )
+                segment.index.flush()
+                segment.size += len(member)
+
+    def close(self) -> None:
+        """
+        Close every open segment.
+        """
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
+
+
+def find_segments(
+    directory: str = "archive",
+    machine: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+) -> List[Tuple[str, str]]:
+    """
+    Find the segments that can hold cycles of a machine and time range.
+
+    Args:
+        directory: Root directory of the archive.
+        machine: Only this machine.
+        since: Only days on or after this one (YYYY-mm-dd[ HH:MM:SS]).
+        until: Only days before this time (exclusive).
+
+    Returns:
+        (machine, segment path) pairs in machine and time order.
+    """
+    if not os.path.isdir(directory):
+        return []
+    first_day = since[:10].replace("-", "") if since else None
+    # A time of day in until still needs that day's segments
+    last_day = until[:10].replace("-", "") if until else None
+    until_has_time = bool(until and until[10:].strip(" :0"))
+
+    segments = []
+    machines = [machine] if machine else sorted(os.listdir(directory))
+    for name in machines:
+        machine_dir = os.path.join(directory, name)
+        if not os.path.isdir(machine_dir):
+            continue
+        for filename in sorted(os.listdir(machine_dir)):
+            match = SEGMENT_RE.match(filename)
+            if not match:
+                continue
+            day = match.group("day")
+            if first_day and day < first_day:
+                continue
+            if last_day and (day > last_day or (day == last_day and not until_has_time)):
+                continue
+            segments.append((name, os.path.join(machine_dir, filename)))
+    return segments
+
+
+def read_segment(
+    machine: str,
+    segment_path: str,
+    part_number: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+) -> Iterator[ArchivedCycle]:
+    """
+    Read the matching cycles of one segment, decompressing only those.
+
+    Args:
+        machine: Machine the segment belongs to.
+        segment_path: Path of the .gz segment.
+        part_number: Only this part number.
+        since: Only cycles received at or after this time (YYYY-mm-dd[ HH:MM:SS]).
+        until: Only cycles received before this time.
+
+    Yields:
+        The matching cycles in the order they were archived.
+    """
+    entries = [
+        entry
+        for entry in read_index(segment_path)
+        if (part_number is None or entry.part_number == part_number)
+        and (since is None or entry.timestamp >= since)
+        and (until is None or entry.timestamp < until)
+    ]
+    if not entries:
+        return
+    with open(segment_path, "rb") as f:
+        for entry in entries:
+            f.seek(entry.offset)
+            data = gzip.decompress(f.read(entry.length)).decode("utf-8")
+            yield ArchivedCycle(
+                machine, entry.timestamp, entry.part_number, data, entry.cycle_id
+            )
+
+
+def read_cycles(
+    directory: str = "archive",
+    machine: Optional[str] = None,
+    part_number: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+) -> Iterator[ArchivedCycle]:
+    """
+    Read archived cycles, decompressing only the ones that match.
+
+    Args:
+        directory: Root directory of the archive.
+        machine: Only this machine.
+        part_number: Only this part number.
+        since: Only cycles received at or after this time (YYYY-mm-dd[ HH:MM:SS]).
+        until: Only cycles received before this time.
+
+    Yields:
+        The matching cycles in machine and time order.
+    """
+    for name, segment_path in find_segments(directory, machine, since, until):
+        yield from read_segment(name, segment_path, part_number, since, until)
+
+
+def list_segments(args: argparse.Namespace) -> None:
+    """
+    Print the segments with their cycle count and size.
+    """
+    print(f"{'machine':<16} {'segment':<20} {'cycles':>8} {'bytes':>12}")
+    for name, segment_path in find_segments(args.dir, args.machine, args.since, args.until):
+        print(
+            f"{name:<16} {os.path.basename(segment_path):<20}"
+            f" {len(read_index(segment_path)):>8} {os.path.getsize(segment_path):>12,}"
+        )
+
+
+def cat_cycles(args: argparse.Namespace) -> None:
+    """
+    Print the raw text of the matching cycles.
+    """
+    for cycle in read_cycles(args.dir, args.machine, args.part, args.since, args.until):
+        print(f"==> {cycle.machine} {cycle.timestamp} {cycle.part_number} <==")
+        print(cycle.data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Haas CNC Data Logger - Read the raw cycle archive",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python haas_archive.py list                                  # Every segment
+    python haas_archive.py cat -m st30l --since 2025-12-09       # Raw cycles since a day
+
+Notes:
+    - The logger archives every cycle to archive/<machine>/ unless it runs with --no-archive
+    - Cycles are kept for --archive-days of the logger (default: 90), older segments are deleted
+    - Times are YYYY-mm-dd or YYYY-mm-dd HH:MM:SS, --until is exclusive
+    - Segments are gzip files, zcat archive/st30l/20251209_000.gz prints a whole day
+        """,
+    )
+    parser.add_argument(
+        "-d", "--dir", default="archive", help="Archive directory (default: archive)"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, func, help_text in (
+        ("list", list_segments, "Segments with their cycle count and size"),
+        ("cat", cat_cycles, "Print the raw text of archived cycles"),
+    ):
+        command = subparsers.add_parser(name, help=help_text)
+        command.add_argument("-m", "--machine", help="Only this machine")
+        command.add_argument("--since", help="Only cycles received at or after this time")
+        command.add_argument("--until", help="Only cycles received before this time")
+        command.set_defaults(func=func)
+    subparsers.choices["cat"].add_argument("-p", "--part", help="Only this part number")
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,286 @@
+"""
+Parse archived raw cycles again and rebuild the CSV files or the database.
+
+# Rebuild December with a new schema file, one file per machine and part
+python haas_backfill.py -s dprnt_schemas.json -a --since 2025-12-01 --until 2026-01-01
+
+# Update the cycles in the database
+python haas_backfill.py -s dprnt_schemas.json --db cnc_data.db
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from functools import partial
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from haas_archive import SEGMENT_RE, find_segments, read_segment
+from haas_layout import PathLayout
+from haas_logger2 import HaasDataLogger
+from haas_parser import SchemaRegistry
+from haas_sqlite import SqliteStore
+
+# A parsed cycle: (part_number, parsed_data)
+Record = Tuple[Optional[str], Dict[str, str]]
+
+# One unit of work: (machine, YYYYmmdd, segment paths of that day)
+Task = Tuple[str, str, List[str]]
+
+# Schemas of a worker process, loaded once by init_worker
+_schemas: Optional[SchemaRegistry] = None
+
+
+def init_worker(schema_file: Optional[str]) -> None:
+    """
+    Load the schemas once per worker process.
+
+    Args:
+        schema_file: JSON schema file, or None for the built-in fields.
+    """
+    global _schemas
+    _schemas = SchemaRegistry.load(schema_file) if schema_file else SchemaRegistry()
+
+
+def plan_tasks(
+    archive_dir: str,
+    machine: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+) -> List[Task]:
+    """
+    Split the archive into one task per machine and day.
+
+    Args:
+        archive_dir: Root directory of the archive.
+        machine: Only this machine.
+        since: Only cycles received at or after this time.
+        until: Only cycles received before this time.
+
+    Returns:
+        Tasks in machine and day order.
+    """
+    tasks: Dict[Tuple[str, str], List[str]] = {}
+    for name, segment_path in find_segments(archive_dir, machine, since, until):
+        match = SEGMENT_RE.match(os.path.basename(segment_path))
+        if match:
+            tasks.setdefault((name, match.group("day")), []).append(segment_path)
+    return [(name, day, paths) for (name, day), paths in tasks.items()]
+
+
+def parse_day(
+    task: Task,
+    part_number: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+) -> Tuple[str, str, List[Record], List[str], int]:
+    """
+    Parse the archived cycles of one machine and day. Runs in a worker process.
+
+    The cycles go through HaasDataLogger.parse_data_to_dict with their original
+    receive time, so the rows are the same as if the logger had received them with
+    the current parser and schemas. A cycle archived twice (replayed from the
+    journal after a crash) is parsed once.
+
+    Args:
+        task: (machine, day, segment paths) from plan_tasks.
+        part_number: Only this part number.
+        since: Only cycles received at or after this time.
+        until: Only cycles received before this time.
+
+    Returns:
+        Tuple of (machine, day, records, cycle ids, raw characters parsed). The
+        cycle id is empty for a cycle archived before cycles had ids.
+    """
+    machine, day, paths = task
+    logger = HaasDataLogger(machine_name=machine, schemas=_schemas)
+    records: List[Record] = []
+    cycle_ids: List[str] = []
+    seen = set()
+    characters = 0
+    for path in paths:
+        for cycle in read_segment(machine, path, part_number, since, until):
+            if cycle.cycle_id:
+                if cycle.cycle_id in seen:
+                    continue
+                seen.add(cycle.cycle_id)
+            characters += len(cycle.data)
+            records.append(
+                (
+                    cycle.part_number or None,
+                    logger.parse_data_to_dict(cycle.data, cycle.timestamp),
+                )
+            )
+            cycle_ids.append(cycle.cycle_id)
+    return machine, day, records, cycle_ids, characters
+
+
+def run_tasks(
+    tasks: List[Task],
+    jobs: int,
+    schema_file: Optional[str],
+    part_number: Optional[str],
+    since: Optional[str],
+    until: Optional[str],
+) -> Iterator[Tuple[str, str, List[Record], List[str], int]]:
+    """
+    Parse the tasks on a pool of worker processes.
+
+    Results come back in task order, so rows are written in time order, while the
+    workers parse the following days.
+
+    Args:
+        tasks: Tasks from plan_tasks.
+        jobs: Number of worker processes. 1 parses in this process.
+        schema_file: JSON schema file, or None for the built-in fields.
+        part_number: Only this part number.
+        since: Only cycles received at or after this time.
+        until: Only cycles received before this time.
+
+    Yields:
+        The result of parse_day for each task.
+    """
+    work = partial(parse_day, part_number=part_number, since=since, until=until)
+    if jobs <= 1:
+        init_worker(schema_file)
+        yield from map(work, tasks)
+        return
+
+    with multiprocessing.Pool(jobs, init_worker, (schema_file,)) as pool:
+        yield from pool.imap(work, tasks)
+
+
+def backfill(args: argparse.Namespace) -> None:
+    """
+    Parse the selected archived cycles and write them, with progress reporting.
+    """
+    tasks = plan_tasks(args.archive, args.machine, args.since, args.until)
+    if not tasks:
+        print(f"[backfill] No archived cycles in {args.archive} for this selection")
+        return
+
+    if not args.db and os.path.isdir(args.out) and os.listdir(args.out):
+        print(f"[backfill] Warning: {args.out} is not empty, rows are appended to the files in it")
+
+    store = SqliteStore(args.db) if args.db else None
+    layout = PathLayout(args.layout) if args.layout else None
+    loggers: Dict[str, HaasDataLogger] = {}
+    print(
+        f"[backfill] {len(tasks)} machine day(s) with {args.jobs} worker(s) -> {args.db or args.out}"
+    )
+
+    start = time.monotonic()
+    cycles = 0
+    characters = 0
+    without_id = 0
+    try:
+        for done, (machine, day, records, cycle_ids, day_characters) in enumerate(
+            run_tasks(
+                tasks, args.jobs, args.schema_file, args.part, args.since, args.until
+            ),
+            1,
+        ):
+            if store is not None:
+                # Only a cycle with an id can be matched to its stored version
+                matched = [i for i, cycle_id in enumerate(cycle_ids) if cycle_id]
+                without_id += len(records) - len(matched)
+                if matched:
+                    store.replace_records(
+                        [records[i] for i in matched], [cycle_ids[i] for i in matched]
+                    )
+            elif records:
+                if machine not in loggers:
+                    loggers[machine] = HaasDataLogger(
+                        machine_name=machine,
+                        append_mode=args.append_mode,
+                        output_dir=args.out,
+                        layout=layout,
+                    )
+                loggers[machine].write_records(records)
+
+            cycles += len(records)
+            characters += day_characters
+            elapsed = max(time.monotonic() - start, 1e-9)
+            print(
+                f"[backfill] {done}/{len(tasks)} {machine} {day}: {len(records)} cycle(s),"
+                f" {cycles / elapsed:,.0f} cycles/s overall"
+            )
+    finally:
+        if store is not None:
+            store.close()
+
+    if without_id:
+        print(
+            f"[backfill] {without_id:,} cycle(s) were archived without a cycle id, their stored version is kept"
+        )
+    elapsed = max(time.monotonic() - start, 1e-9)
+    print(
+        f"[backfill] {cycles:,} cycle(s) in {elapsed:.1f}s:"
+        f" {cycles / elapsed:,.0f} cycles/s, {characters / elapsed / 1e6:.1f} MB/s of raw text"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Haas CNC Data Logger - Parse archived cycles again with the current parser and schemas",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python haas_backfill.py -a                                   # Every archived cycle to cnc_backfill/
+    python haas_backfill.py -s dprnt_schemas.json -m st30l -a --since 2025-12-01
+    python haas_backfill.py -s dprnt_schemas.json --db cnc_data.db   # Update the cycles in the database
+
+Notes:
+    - The work is split by machine and day and spread over all CPU cores (-j)
+    - CSV files are appended to, write to an empty --out directory and swap it in when done
+    - With --db, each archived cycle replaces its stored version, one transaction per machine and day
+    - Stored cycles that are not in the archive are kept
+        """,
+    )
+    parser.add_argument(
+        "--archive", default="archive", help="Archive directory (default: archive)"
+    )
+    parser.add_argument(
+        "-s",
+        "--schemas",
+        dest="schema_file",
+        help="JSON file with extra DPRNT fields per program (see dprnt_schemas.json)",
+    )
+    parser.add_argument("-m", "--machine", help="Only this machine")
+    parser.add_argument("-p", "--part", help="Only this part number")
+    parser.add_argument("--since", help="Only cycles received at or after this time")
+    parser.add_argument("--until", help="Only cycles received before this time")
+    parser.add_argument(
+        "-a",
+        "--append",
+        action="store_true",
+        dest="append_mode",
+        help="Append mode: one CSV file per machine and part instead of one per cycle",
+    )
+    parser.add_argument(
+        "--out",
+        default="cnc_backfill",
+        help="Directory the CSV files are written to (default: cnc_backfill)",
+    )
+    parser.add_argument(
+        "--layout",
+        default="",
+        help='Sort the CSV files into subdirectories, ex. "{machine}/{yyyy}/{mm}"',
+    )
+    parser.add_argument(
+        "--db", help="Update the cycles in this SQLite database instead of writing CSV files"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Worker processes (default: number of CPU cores)",
+    )
+    args = parser.parse_args()
+
+    try:
+        PathLayout(args.layout)
+    except ValueError as e:
+        parser.error(str(e))
+    backfill(args)
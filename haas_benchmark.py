@@ -0,0 +1,1399 @@
+"""
+Micro-benchmarks for the Haas CNC Data Logger.
+
+# Compare the streaming framer with the original buffer rescanning
+python haas_benchmark.py framing
+
+# Allocations per received chunk of recv_into() against recv() and decode()
+python haas_benchmark.py receive
+
+# Compare the DPRNT parser with the original regex searches
+python haas_benchmark.py parsing
+
+# Throughput, latency and memory of every stage of the logger, saved for comparison
+python haas_benchmark.py stages -n 200000 --json before.json
+python haas_benchmark.py stages -n 200000 --json after.json
+python haas_benchmark.py compare before.json after.json
+
+# Connections per second and memory per connection of the server mode designs
+python haas_benchmark.py server --connections 500
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from haas_framing import END_OF_CYCLE, MAX_LINE_LENGTH, PART_NUMBER_RE, CycleFramer
+from haas_logger2 import HaasDataLogger
+from haas_parser import SchemaRegistry, default_parser
+from haas_sqlite import SqliteStore
+from haas_storage import CsvHandleCache, read_csv_rows
+
+CHUNK_SIZE = 4096
+
+# Format version of the stages --json output
+RESULTS_VERSION = 1
+
+SAMPLE_CYCLE_HEAD = """
+ PART NUMBER: 265-4183, REV. X2
+
+ DATE YYMMDD: 251209
+ TIME HHMMSS: 150843
+
+ PARTS MADE: 412
+
+ TIME, LAST PART: 73 SECONDS
+"""
+
+
+def make_cycle(size: int) -> str:
+    """
+    Build a cycle of roughly the given size, padded with probing report lines.
+
+    Args:
+        size: Approximate cycle size in characters.
+
+    Returns:
+        The cycle text, ending with the End of Cycle line.
+    """
+    lines = [SAMPLE_CYCLE_HEAD]
+    length = len(SAMPLE_CYCLE_HEAD)
+    n = 0
+    while length < size:
+        line = f" PROBE {n:05d} X: {n * 0.0001:+.4f} Y: {n * -0.0002:+.4f} Z: 0.0000\r\n"
+        lines.append(line)
+        length += len(line)
+        n += 1
+    lines.append("End of Cycle\r\n")
+    return "".join(lines)
+
+
+def chunked(data: bytes, size: int = CHUNK_SIZE) -> List[bytes]:
+    """
+    Split data into chunks the size of one socket recv().
+
+    Args:
+        data: Bytes to split.
+        size: Chunk size.
+
+    Returns:
+        List of chunks.
+    """
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def legacy_frame(chunks: List[bytes]) -> None:
+    """
+    Frame one cycle the way process_data did before CycleFramer.
+
+    Args:
+        chunks: Received chunks of one cycle.
+    """
+    buffer = ""
+    part_number = None
+    for data in chunks:
+        buffer += data.decode("utf-8", errors="ignore")
+        if not part_number:
+            match = re.search(r"PART NUMBER:\s*([^\s,]+)", buffer, re.IGNORECASE)
+            if match:
+                part_number = match.group(1).strip()
+        if "End of Cycle" in buffer or "END OF CYCLE" in buffer.upper():
+            buffer = ""
+            part_number = None
+
+
+def streaming_frame(chunks: List[bytes]) -> None:
+    """
+    Frame one cycle with CycleFramer.
+
+    Args:
+        chunks: Received chunks of one cycle.
+    """
+    framer = CycleFramer()
+    for received in chunks:
+        framer.feed(received)
+
+
+def time_per_byte(
+    func: Callable[[List[bytes]], None], chunks: List[bytes]
+) -> float:
+    """
+    Time a framing function and return nanoseconds per received byte.
+
+    Args:
+        func: Framing function to time.
+        chunks: Chunks of one cycle.
+
+    Returns:
+        Best of several runs, in nanoseconds per byte.
+    """
+    total = sum(len(c) for c in chunks)
+    repeat = max(1, 2_000_000 // total)
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func(chunks)
+        best = min(best, (time.perf_counter() - start) / repeat)
+    return best * 1e9 / total
+
+
+def legacy_parse(data: str) -> Dict[str, str]:
+    """
+    Parse one cycle the way parse_data_to_dict did before DprntParser.
+
+    Args:
+        data: Raw data string of one cycle.
+
+    Returns:
+        Dictionary of the parsed fields.
+    """
+    result = dict.fromkeys(default_parser.columns, "")
+    part_match = re.search(
+        r"PART NUMBER:\s*([^\s,]+)(?:,\s*REV\.\s*([^\]]+))?", data, re.IGNORECASE
+    )
+    if part_match:
+        result["Part_Number"] = part_match.group(1).strip()
+        if part_match.group(2):
+            result["Revision"] = part_match.group(2).strip()
+    for column, pattern in (
+        ("Date_YYMMDD", r"DATE YYMMDD:\s*(\d+)"),
+        ("Time_HHMMSS", r"TIME HHMMSS:\s*(\d+)"),
+        ("Parts_Counter", r"PARTS\s*MADE:\s*(\d+)"),
+        ("Last_Part_Time_Seconds", r"TIME,\s*LAST\s*PART:\s*(\d+(?:\.\d+)?)\s*SECONDS"),
+    ):
+        match = re.search(pattern, data, re.IGNORECASE)
+        if match:
+            result[column] = match.group(1).strip()
+    return result
+
+
+def time_per_call(func: Callable[[str], object], data: str) -> float:
+    """
+    Time a parsing function and return microseconds per call.
+
+    Args:
+        func: Parsing function to time.
+        data: Cycle text to parse.
+
+    Returns:
+        Best of several runs, in microseconds per call.
+    """
+    repeat = max(1, 2_000_000 // len(data))
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func(data)
+        best = min(best, (time.perf_counter() - start) / repeat)
+    return best * 1e6
+
+
+def bench_parsing(args: argparse.Namespace) -> None:
+    """
+    Show the time per cycle of both parsers for small and large cycles.
+
+    Each size is run twice: with every field present, and with the last part timer
+    missing, which makes both parsers scan the whole cycle.
+    """
+    print(f"{'cycle size':>12} {'fields':>8} {'legacy us':>12} {'parser us':>12}")
+    for size in args.sizes:
+        cycle = make_cycle(size)
+        for label, data in (
+            ("all", cycle),
+            ("missing", cycle.replace("TIME, LAST PART", "TIMER")),
+        ):
+            legacy = time_per_call(legacy_parse, data)
+            parser = time_per_call(default_parser.parse, data)
+            print(f"{size:>12,} {label:>8} {legacy:12.1f} {parser:12.1f}")
+
+
+def bench_framing(args: argparse.Namespace) -> None:
+    """
+    Show the cost per byte of both framers as the cycle size grows.
+    """
+    print(f"{'cycle size':>12} {'legacy ns/B':>12} {'streaming ns/B':>15}")
+    for size in args.sizes:
+        chunks = chunked(make_cycle(size).encode("utf-8"))
+        # The legacy framer is quadratic, skip the sizes that take minutes
+        legacy = (
+            f"{time_per_byte(legacy_frame, chunks):12.2f}"
+            if size <= args.legacy_limit
+            else f"{'skipped':>12}"
+        )
+        streaming = time_per_byte(streaming_frame, chunks)
+        print(f"{size:>12,} {legacy} {streaming:15.2f}")
+
+
+
+class TextCycleFramer:
+    """
+    CycleFramer as it was before it framed bytes: every chunk is decoded and
+    framed as text, the decoded chunks are kept until the cycle ends. Kept to
+    compare the receive paths.
+    """
+
+    END_OF_CYCLE_RE = re.compile(re.escape(END_OF_CYCLE), re.IGNORECASE)
+
+    def __init__(self) -> None:
+        """
+        Initialize an empty framer.
+        """
+        self._overlap_length = len(END_OF_CYCLE) - 1
+        self._skip_marker_line = False
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Discard the buffered cycle and start a new one.
+        """
+        self._chunks: List[str] = []
+        self._tail = ""
+        self._line = ""
+        self.part_number: Optional[str] = None
+
+    def _append(self, text: str) -> None:
+        """
+        Add text to the current cycle and search its complete lines for the part.
+        """
+        self._chunks.append(text)
+        if self.part_number is not None:
+            return
+        pending = self._line + text
+        cut = pending.rfind("\n")
+        if cut < 0:
+            self._line = pending[-MAX_LINE_LENGTH:]
+            return
+        self._line = pending[cut + 1 :][-MAX_LINE_LENGTH:]
+        match = PART_NUMBER_RE.search(pending, 0, cut)
+        if match:
+            self.part_number = match.group(1).strip()
+
+    def _drop_marker_line(self, text: str) -> str:
+        """
+        Drop the rest of the End of Cycle line, up to and including the newline.
+        """
+        newline = text.find("\n", 0, MAX_LINE_LENGTH)
+        if newline < 0 and len(text) < MAX_LINE_LENGTH:
+            self._skip_marker_line = True
+            return ""
+        self._skip_marker_line = False
+        return text[newline + 1 :] if newline >= 0 else text
+
+    def feed(self, text: str) -> List[Tuple[str, Optional[str]]]:
+        """
+        Add newly decoded text and return every cycle it completes.
+        """
+        cycles: List[Tuple[str, Optional[str]]] = []
+        if self._skip_marker_line:
+            text = self._drop_marker_line(text)
+        while text:
+            window = self._tail + text
+            match = (
+                self.END_OF_CYCLE_RE.search(window)
+                if END_OF_CYCLE in window.upper()
+                else None
+            )
+            if match is None:
+                self._append(text)
+                self._tail = window[-self._overlap_length :]
+                break
+            end = match.end() - len(self._tail)
+            self._append(text[:end])
+            if self.part_number is None:
+                part_match = PART_NUMBER_RE.search(self._line)
+                if part_match:
+                    self.part_number = part_match.group(1).strip()
+            cycles.append(("".join(self._chunks), self.part_number))
+            self.reset()
+            text = self._drop_marker_line(text[end:])
+        return cycles
+
+
+def receive_text(sock: socket.socket, framer: Any) -> int:
+    """
+    Receive and frame one chunk the way process_data did before recv_into().
+
+    Returns:
+        Number of cycles completed.
+    """
+    data = sock.recv(CHUNK_SIZE)
+    return len(framer.feed(data.decode("utf-8", errors="ignore")))
+
+
+def receive_bytes(sock: socket.socket, framer: Any) -> int:
+    """
+    Receive and frame one chunk the way process_data does.
+
+    Returns:
+        Number of cycles completed.
+    """
+    framer.recv_into(sock)
+    return len(framer.frame())
+
+
+# name -> (framer class, receive function)
+RECEIVE_PATHS: Dict[str, Tuple[Callable[[], Any], Callable[..., int]]] = {
+    "recv+decode": (TextCycleFramer, receive_text),
+    "recv_into": (CycleFramer, receive_bytes),
+}
+
+
+def measure_receive(name: str, chunks: List[bytes], memory: bool) -> Dict[str, Any]:
+    """
+    Receive a stream over a socket pair, one chunk at a time.
+
+    Each chunk is sent before the receive is measured, so only the receive and
+    framing are timed or traced.
+
+    Args:
+        name: One of RECEIVE_PATHS.
+        chunks: The stream, in CHUNK_SIZE pieces.
+        memory: Trace the allocations of every receive with tracemalloc instead of
+        timing them, tracing slows them down.
+
+    Returns:
+        The seconds spent receiving, or the bytes allocated per chunk: the peak of
+        each receive above what was allocated before it, split between chunks
+        that completed no cycle and chunks that did.
+    """
+    make, receive = RECEIVE_PATHS[name]
+    framer = make()
+    sender, receiver = socket.socketpair()
+    clock = time.perf_counter
+    elapsed = 0.0
+    steady: List[int] = []
+    completing: List[int] = []
+    if memory:
+        tracemalloc.start()
+    try:
+        for chunk in chunks:
+            sender.sendall(chunk)
+            if memory:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                cycles = receive(receiver, framer)
+                (completing if cycles else steady).append(
+                    tracemalloc.get_traced_memory()[1] - before
+                )
+            else:
+                start = clock()
+                receive(receiver, framer)
+                elapsed += clock() - start
+    finally:
+        if memory:
+            tracemalloc.stop()
+        sender.close()
+        receiver.close()
+    steady.sort()
+    return {
+        "seconds": elapsed,
+        "steady_bytes": steady[len(steady) // 2] if steady else 0,
+        "steady_max_bytes": steady[-1] if steady else 0,
+        "completing_bytes": sum(completing) / len(completing) if completing else 0,
+        "steady_chunks": len(steady),
+        "buffer_bytes": getattr(framer, "capacity", 0),
+    }
+
+
+def bench_receive(args: argparse.Namespace) -> None:
+    """
+    Compare the time and allocations per chunk of both receive paths.
+    """
+    stream = "".join(
+        generate_cycles(args.cycles, args.seed, args.probe_lines)
+    ).encode("utf-8")
+    chunks = chunked(stream)
+    print(
+        f"[bench] {args.cycles:,} cycles, {len(stream) / 1024:,.0f} KiB in"
+        f" {len(chunks):,} chunks of {CHUNK_SIZE} bytes"
+    )
+    print(
+        f"{'path':<12} {'ns/B':>7} {'B/chunk':>9} {'max B/chunk':>12}"
+        f" {'B/cycle end':>12} {'buffer KiB':>11}"
+    )
+    for name in args.paths:
+        timed = min(
+            (measure_receive(name, chunks, memory=False) for _ in range(3)),
+            key=lambda result: result["seconds"],
+        )
+        traced = measure_receive(name, chunks, memory=True)
+        print(
+            f"{name:<12} {timed['seconds'] * 1e9 / len(stream):>7.2f}"
+            f" {traced['steady_bytes']:>9,} {traced['steady_max_bytes']:>12,}"
+            f" {traced['completing_bytes']:>12,.0f} {traced['buffer_bytes'] / 1024:>11,.0f}"
+        )
+
+# Part numbers the generated dataset cycles through
+DATASET_PARTS = ("265-4183", "265-4184", "1120-07A", "TEST-001", "88-1002-3")
+
+
+def generate_cycle(
+    rng: random.Random, number: int, when: datetime, probe_lines: int = 0
+) -> str:
+    """
+    Build one cycle as the control prints it, like the output of dprnt_example.txt.
+
+    The cycles rotate between three kinds: the built-in fields only, a program
+    (O03020) with the spindle fields of dprnt_schemas.json, and a probe report with
+    the X/Y/Z errors of its header schema.
+
+    Args:
+        rng: Random source, seeded for a repeatable dataset.
+        number: Sequence number of the cycle, used for the parts counter.
+        when: Time the cycle finished, printed as DATE YYMMDD and TIME HHMMSS.
+        probe_lines: Extra probe point lines, to make cycles larger.
+
+    Returns:
+        The cycle text, ending with the End of Cycle line.
+    """
+    kind = number % 3
+    lines = []
+    if kind == 1:
+        lines.append(" PROGRAM: O03020\r\n")
+    elif kind == 2:
+        lines.append(" PROBE REPORT\r\n")
+    lines += [
+        f" PART NUMBER: {DATASET_PARTS[number % len(DATASET_PARTS)]}, REV. X{number % 4}\r\n",
+        "\r\n",
+        f" DATE YYMMDD: {when:%y%m%d}\r\n",
+        f" TIME HHMMSS: {when:%H%M%S}\r\n",
+        "\r\n",
+        f" PARTS MADE: {number}\r\n",
+        "\r\n",
+        f" TIME, LAST PART: {rng.randint(20, 400)} SECONDS\r\n",
+    ]
+    if kind == 1:
+        lines += [
+            f" SPINDLE LOAD: {rng.uniform(5, 95):.1f}\r\n",
+            f" TOOL NUMBER: {rng.randint(1, 24)}\r\n",
+            f" SPINDLE RPM: {rng.choice((800, 1200, 2500, 4000, 8100))}\r\n",
+        ]
+    elif kind == 2:
+        lines += [
+            f" {axis} ERROR: {rng.gauss(0, 0.002):+.4f}\r\n" for axis in "XYZ"
+        ]
+    lines += [
+        f" PROBE {n:05d} X: {rng.uniform(-50, 50):+.4f} Z: {rng.uniform(-5, 0):+.4f}\r\n"
+        for n in range(probe_lines)
+    ]
+    lines.append("\r\n End of Cycle\r\n")
+    return "".join(lines)
+
+
+def generate_cycles(count: int, seed: int = 1, probe_lines: int = 0) -> Iterator[str]:
+    """
+    Generate a repeatable dataset of cycles, one finished every 30 seconds.
+
+    Args:
+        count: Number of cycles.
+        seed: Random seed. The same seed gives the same dataset.
+        probe_lines: Extra probe point lines per cycle.
+
+    Yields:
+        The text of each cycle.
+    """
+    rng = random.Random(seed)
+    start = datetime(2025, 12, 1, 6, 0, 0)
+    for number in range(1, count + 1):
+        when = start + timedelta(seconds=30 * number)
+        yield generate_cycle(rng, number, when, probe_lines)
+
+
+def dataset_chunks(path: Optional[str], count: int, seed: int) -> Iterator[bytes]:
+    """
+    The dataset as the bytes of successive recv() calls.
+
+    Args:
+        path: Dataset file written by the generate command, or None to generate
+        count cycles on the fly.
+        count: Number of cycles to generate when there is no file.
+        seed: Random seed of the generated cycles.
+
+    Yields:
+        Chunks of CHUNK_SIZE bytes, like process_data receives them.
+    """
+    if path:
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    return
+                yield data
+
+    pending = b""
+    for cycle in generate_cycles(count, seed):
+        pending += cycle.encode("utf-8")
+        while len(pending) >= CHUNK_SIZE:
+            yield pending[:CHUNK_SIZE]
+            pending = pending[CHUNK_SIZE:]
+    if pending:
+        yield pending
+
+
+class Dataset:
+    """
+    The input of the stages benchmark: a dataset file or generated cycles.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str],
+        count: int,
+        seed: int,
+        write_cycles: int,
+        schemas: SchemaRegistry,
+    ) -> None:
+        """
+        Initialize the dataset. Nothing is read or generated until a stage runs.
+
+        Args:
+            path: Dataset file, or None to generate count cycles.
+            count: Number of cycles to generate when there is no file.
+            seed: Random seed of the generated cycles.
+            write_cycles: Number of cycles the write and report stages use.
+            schemas: Schemas the cycles are parsed with.
+        """
+        self.path = path
+        self.count = count
+        self.seed = seed
+        self.write_cycles = write_cycles
+        self.schemas = schemas
+
+    def chunks(self) -> Iterator[bytes]:
+        """
+        Yields:
+            The dataset in CHUNK_SIZE pieces, as received from the socket.
+        """
+        return dataset_chunks(self.path, self.count, self.seed)
+
+    def cycles(self) -> Iterator[Tuple[str, Optional[str]]]:
+        """
+        Frame the dataset into cycles, one chunk at a time.
+
+        Yields:
+            The framed (data, part_number) cycles of the dataset.
+        """
+        framer = CycleFramer()
+        for chunk in self.chunks():
+            yield from framer.feed(chunk)
+
+    def records(self) -> List[Tuple[Optional[str], Dict[str, str]]]:
+        """
+        The first write_cycles cycles, parsed, one every 30 seconds of machine time.
+
+        Each record has its own Timestamp, so NEW FILE mode writes one file per
+        cycle as it does in production.
+
+        Returns:
+            (part_number, parsed_data) tuples for write_records.
+        """
+        logger = HaasDataLogger(machine_name="Bench", schemas=self.schemas)
+        start = datetime(2025, 12, 1, 6, 0, 0)
+        records = []
+        for number, (data, part_number) in enumerate(self.cycles()):
+            if number >= self.write_cycles:
+                break
+            when = start + timedelta(seconds=30 * number)
+            timestamp = when.strftime("%Y-%m-%d %H:%M:%S")
+            records.append((part_number, logger.parse_data_to_dict(data, timestamp)))
+        return records
+
+
+# A stage: prepare(dataset, workdir) builds the input outside of the measurement,
+# run(input, workdir) returns the time of each operation and the bytes processed
+StagePrepare = Callable[[Dataset, str], Any]
+StageRun = Callable[[Any, str], Tuple[List[float], int]]
+
+
+def run_frame(chunks: Iterable[bytes], workdir: str) -> Tuple[List[float], int]:
+    """
+    Feed every chunk to a CycleFramer, timing each feed.
+    """
+    framer = CycleFramer()
+    timings = []
+    size = 0
+    clock = time.perf_counter
+    for chunk in chunks:
+        start = clock()
+        framer.feed(chunk)
+        timings.append(clock() - start)
+        size += len(chunk)
+    return timings, size
+
+
+def run_parse(
+    cycles: Tuple[SchemaRegistry, Iterable[Tuple[str, Optional[str]]]], workdir: str
+) -> Tuple[List[float], int]:
+    """
+    Parse every framed cycle with parse_data_to_dict, timing each call.
+    """
+    schemas, framed = cycles
+    logger = HaasDataLogger(machine_name="Bench", schemas=schemas)
+    timings = []
+    size = 0
+    clock = time.perf_counter
+    for data, _ in framed:
+        start = clock()
+        logger.parse_data_to_dict(data)
+        timings.append(clock() - start)
+        size += len(data)
+    return timings, size
+
+
+def write_stage(append_mode: bool, max_open_files: int = 0, db: bool = False) -> StageRun:
+    """
+    Build the run function of a write stage: one write_records call per cycle, as
+    the writer thread does when cycles arrive one at a time.
+
+    Args:
+        append_mode: Append mode instead of NEW FILE mode.
+        max_open_files: Keep this many append mode files open (CsvHandleCache).
+        db: Write to an SQLite database instead of CSV files.
+    """
+
+    def run(
+        records: List[Tuple[Optional[str], Dict[str, str]]], workdir: str
+    ) -> Tuple[List[float], int]:
+        cache = CsvHandleCache(max_open_files) if max_open_files else None
+        store = SqliteStore(os.path.join(workdir, "bench.db")) if db else None
+        logger = HaasDataLogger(
+            machine_name="Bench",
+            append_mode=append_mode,
+            handle_cache=cache,
+            output_dir=workdir,
+            store=store,
+        )
+        timings = []
+        clock = time.perf_counter
+        try:
+            for record in records:
+                start = clock()
+                logger.write_records([record])
+                timings.append(clock() - start)
+        finally:
+            if cache is not None:
+                cache.close_all()
+            if store is not None:
+                store.close()
+        return timings, directory_size(workdir)
+
+    return run
+
+
+def prepare_csv_report(dataset: Dataset, workdir: str) -> str:
+    """
+    Write the records to append mode files to be read back.
+    """
+    write_stage(append_mode=True)(dataset.records(), workdir)
+    return workdir
+
+
+def run_csv_report(directory: str, workdir: str) -> Tuple[List[float], int]:
+    """
+    Read every CSV file back, timing each file.
+    """
+    timings = []
+    clock = time.perf_counter
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".csv"):
+            start = clock()
+            read_csv_rows(os.path.join(directory, filename))
+            timings.append(clock() - start)
+    return timings, directory_size(directory)
+
+
+def prepare_db_report(dataset: Dataset, workdir: str) -> str:
+    """
+    Write the records to a database in one transaction.
+    """
+    path = os.path.join(workdir, "bench.db")
+    store = SqliteStore(path)
+    store.write_records(dataset.records())
+    store.close()
+    return path
+
+
+def run_db_report(path: str, workdir: str) -> Tuple[List[float], int]:
+    """
+    Time the cycle statistics query and a full CSV export of the database.
+    """
+    store = SqliteStore(path)
+    timings = []
+    clock = time.perf_counter
+    try:
+        start = clock()
+        store.stats()
+        timings.append(clock() - start)
+        start = clock()
+        store.export_csv(os.path.join(workdir, "export"))
+        timings.append(clock() - start)
+    finally:
+        store.close()
+    return timings, os.path.getsize(path)
+
+
+def directory_size(directory: str) -> int:
+    """
+    Total size of the files under a directory.
+    """
+    return sum(
+        os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, _, filenames in os.walk(directory)
+        for filename in filenames
+    )
+
+
+# name -> (prepare, run, what one operation is)
+STAGES: Dict[str, Tuple[StagePrepare, StageRun, str]] = {
+    "frame": (lambda dataset, _: dataset.chunks(), run_frame, "chunk"),
+    "parse": (
+        lambda dataset, _: (dataset.schemas, dataset.cycles()),
+        run_parse,
+        "cycle",
+    ),
+    "write-new": (
+        lambda dataset, _: dataset.records(),
+        write_stage(append_mode=False),
+        "cycle",
+    ),
+    "write-append": (
+        lambda dataset, _: dataset.records(),
+        write_stage(append_mode=True),
+        "cycle",
+    ),
+    "write-cached": (
+        lambda dataset, _: dataset.records(),
+        write_stage(append_mode=True, max_open_files=64),
+        "cycle",
+    ),
+    "write-db": (
+        lambda dataset, _: dataset.records(),
+        write_stage(append_mode=False, db=True),
+        "cycle",
+    ),
+    "report-csv": (prepare_csv_report, run_csv_report, "file"),
+    "report-db": (prepare_db_report, run_db_report, "query"),
+}
+
+
+def percentile(timings: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile of sorted timings.
+    """
+    if not timings:
+        return 0.0
+    return timings[min(len(timings) - 1, int(p * len(timings)))]
+
+
+def measure_stage(name: str, dataset: Dataset, memory: bool) -> Dict[str, Any]:
+    """
+    Run one stage and summarize it.
+
+    The stage runs once for the timings, then, unless memory is False, a second
+    time under tracemalloc for the peak memory, so tracing does not slow the
+    timed run. Each run gets an empty work directory. The logger's messages go to
+    os.devnull, formatting them is still part of the time.
+
+    Args:
+        name: Stage name, a key of STAGES.
+        dataset: Input of the stage.
+        memory: Also measure the peak memory.
+
+    Returns:
+        The results of the stage: operations, seconds, throughput, latency
+        percentiles in microseconds and peak memory in KiB.
+    """
+    prepare, run, unit = STAGES[name]
+    peak_kib = None
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        workdir = tempfile.mkdtemp(prefix=f"haas_bench_{name}_")
+        try:
+            timings, size = run(prepare(dataset, workdir), workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        if memory:
+            workdir = tempfile.mkdtemp(prefix=f"haas_bench_{name}_")
+            try:
+                stage_input = prepare(dataset, workdir)
+                tracemalloc.start()
+                run(stage_input, workdir)
+                peak_kib = tracemalloc.get_traced_memory()[1] / 1024
+            finally:
+                tracemalloc.stop()
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    seconds = sum(timings)
+    timings.sort()
+    per_second = len(timings) / seconds if seconds else 0.0
+    return {
+        "unit": unit,
+        "operations": len(timings),
+        "bytes": size,
+        "seconds": round(seconds, 6),
+        "per_second": round(per_second, 1),
+        "mb_per_second": round(size / seconds / 1e6, 3) if seconds else 0.0,
+        "p50_us": round(percentile(timings, 0.50) * 1e6, 2),
+        "p95_us": round(percentile(timings, 0.95) * 1e6, 2),
+        "p99_us": round(percentile(timings, 0.99) * 1e6, 2),
+        "max_us": round(timings[-1] * 1e6, 2) if timings else 0.0,
+        "peak_kib": round(peak_kib, 1) if peak_kib is not None else None,
+    }
+
+
+def bench_stages(args: argparse.Namespace) -> None:
+    """
+    Measure every selected stage and print a table, and save the results as JSON.
+    """
+    dataset = Dataset(
+        args.dataset,
+        args.cycles,
+        args.seed,
+        args.write_cycles,
+        SchemaRegistry.load(args.schema_file) if args.schema_file else SchemaRegistry(),
+    )
+    results: Dict[str, Any] = {
+        "version": RESULTS_VERSION,
+        "meta": {
+            "label": args.label,
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "dataset": args.dataset or f"generated {args.cycles} cycles, seed {args.seed}",
+            "write_cycles": args.write_cycles,
+            "schemas": args.schema_file,
+        },
+        "stages": {},
+    }
+
+    print(
+        f"{'stage':<14} {'ops':>9} {'ops/s':>11} {'MB/s':>8} {'p50 us':>9}"
+        f" {'p95 us':>9} {'p99 us':>9} {'max us':>10} {'peak KiB':>10}"
+    )
+    for name in args.stages:
+        result = measure_stage(name, dataset, not args.no_memory)
+        results["stages"][name] = result
+        peak = (
+            f"{result['peak_kib']:10,.0f}"
+            if result["peak_kib"] is not None
+            else f"{'-':>10}"
+        )
+        print(
+            f"{name:<14} {result['operations']:>9,} {result['per_second']:>11,.0f}"
+            f" {result['mb_per_second']:>8.2f} {result['p50_us']:>9.1f} {result['p95_us']:>9.1f}"
+            f" {result['p99_us']:>9.1f} {result['max_us']:>10.1f} {peak}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"[bench] Results saved to {args.json}")
+
+
+def bench_generate(args: argparse.Namespace) -> None:
+    """
+    Write a dataset file for the stages benchmark.
+    """
+    size = 0
+    with open(args.output, "w", newline="") as f:
+        for cycle in generate_cycles(args.cycles, args.seed, args.probe_lines):
+            f.write(cycle)
+            size += len(cycle)
+    print(f"[bench] {args.cycles:,} cycles, {size / 1e6:.1f} MB written to {args.output}")
+
+
+def compare_results(args: argparse.Namespace) -> None:
+    """
+    Compare two stages results and exit with 1 if a stage got slower than the
+    threshold.
+    """
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    def change(old: Optional[float], value: Optional[float]) -> Optional[float]:
+        if not old or value is None:
+            return None
+        return (value / old - 1) * 100
+
+    def shown(percent: Optional[float]) -> str:
+        return f"{percent:+8.1f}%" if percent is not None else f"{'-':>9}"
+
+    print(f"{'stage':<14} {'ops/s':>9} {'p99':>9} {'peak':>9}")
+    regressions = []
+    for name, result in new["stages"].items():
+        old = base["stages"].get(name)
+        if old is None:
+            print(f"{name:<14} {'new':>9}")
+            continue
+        throughput = change(old["per_second"], result["per_second"])
+        print(
+            f"{name:<14} {shown(throughput)} {shown(change(old['p99_us'], result['p99_us']))}"
+            f" {shown(change(old['peak_kib'], result['peak_kib']))}"
+        )
+        if throughput is not None and throughput < -args.threshold:
+            regressions.append(name)
+
+    if base["meta"].get("platform") != new["meta"].get("platform"):
+        print("[bench] Warning: the results are from different platforms")
+    if regressions:
+        print(f"[bench] Slower by more than {args.threshold:.0f}%: {', '.join(regressions)}")
+        sys.exit(1)
+    print(f"[bench] No stage slower by more than {args.threshold:.0f}%")
+
+
+# Server mode designs: name -> extra haas_logger2.py arguments
+SERVER_DESIGNS: Dict[str, List[str]] = {
+    "event-loop": [],
+    "threads": ["--threaded"],
+}
+
+LOGGER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "haas_logger2.py")
+
+
+def free_port() -> int:
+    """
+    A TCP port nothing listens on right now.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_usage(pid: int) -> Tuple[Optional[int], Optional[int], Optional[float]]:
+    """
+    Resident memory, thread count and CPU time of a process, from /proc (Linux only).
+
+    Args:
+        pid: Process ID.
+
+    Returns:
+        Tuple of (resident memory in KiB, threads, user and system CPU seconds),
+        all None without /proc.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+        with open(f"/proc/{pid}/stat") as f:
+            # The fields after the command name, which may hold spaces
+            stat = f.read().rpartition(")")[2].split()
+    except OSError:
+        return None, None, None
+    cpu = (int(stat[11]) + int(stat[12])) / os.sysconf("SC_CLK_TCK")
+    return int(status["VmRSS"].split()[0]), int(status["Threads"]), cpu
+
+
+def scrape_metrics(port: int) -> Dict[str, float]:
+    """
+    Read the metrics of a logger with a single machine.
+
+    Args:
+        port: Its --metrics-port.
+
+    Returns:
+        Metric name -> value, histograms left out. Empty if not reachable yet.
+    """
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=2) as response:
+            text = response.read().decode("utf-8")
+    except OSError:
+        return {}
+    metrics = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#") and "_bucket" not in line:
+            name, _, value = line.rpartition(" ")
+            metrics[name.split("{", 1)[0]] = float(value)
+    return metrics
+
+
+def wait_for_metrics(
+    port: int, condition: Callable[[Dict[str, float]], bool], timeout: float = 60.0
+) -> Dict[str, float]:
+    """
+    Poll the metrics of a logger until a condition holds.
+
+    Raises:
+        TimeoutError: If it doesn't hold within timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        metrics = scrape_metrics(port)
+        if metrics and condition(metrics):
+            return metrics
+        time.sleep(0.05)
+    raise TimeoutError("the logger did not reach the expected state")
+
+
+async def connect_burst(port: int, count: int, concurrency: int, data: bytes) -> None:
+    """
+    Open count connections, concurrency at a time, each sending data and closing.
+    """
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one() -> None:
+        async with slots:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(data)
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+
+    await asyncio.gather(*(one() for _ in range(count)))
+
+
+def measure_server(design: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Run haas_logger2.py in server mode with one design and load it.
+
+    The logger runs in its own process so its memory and CPU time can be read.
+    The rate is connections opened, sent one line and closed, counted once the
+    logger has closed them all. The client runs on the same computer, so on few
+    cores the CPU time the logger spent per connection is the fairer comparison.
+    The memory per connection is the growth of the logger's resident memory while
+    args.connections connections are held open, each in the middle of a cycle.
+
+    Args:
+        design: A key of SERVER_DESIGNS.
+        args: The server command arguments.
+
+    Returns:
+        Connections per second, CPU microseconds per connection, resident memory
+        in KiB idle and with the connections held, KiB per connection and the
+        thread counts.
+    """
+    port, metrics_port = free_port(), free_port()
+    workdir = tempfile.mkdtemp(prefix=f"haas_bench_server_{design}_")
+    logger = subprocess.Popen(
+        [
+            sys.executable,
+            LOGGER_SCRIPT,
+            "-H",
+            "127.0.0.1",
+            "-p",
+            str(port),
+            "-n",
+            "bench",
+            "--no-journal",
+            "--no-archive",
+            "--metrics-port",
+            str(metrics_port),
+            "--max-connections",
+            str(args.connections + args.concurrency),
+            "--backlog",
+            str(args.backlog),
+        ]
+        + SERVER_DESIGNS[design],
+        cwd=workdir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    held: List[socket.socket] = []
+    try:
+        wait_for_metrics(metrics_port, lambda m: True)
+        line = b"PART NUMBER: BENCH-1\r\n"
+
+        cpu_before = process_usage(logger.pid)[2]
+        start = time.perf_counter()
+        asyncio.run(connect_burst(port, args.rate_connections, args.concurrency, line))
+        wait_for_metrics(
+            metrics_port,
+            lambda m: m["haas_connections_total"] >= args.rate_connections
+            and m["haas_connected"] == 0,
+        )
+        rate = args.rate_connections / (time.perf_counter() - start)
+
+        idle_kib, idle_threads, cpu_after = process_usage(logger.pid)
+        for _ in range(args.connections):
+            sock = socket.create_connection(("127.0.0.1", port))
+            sock.sendall(line)
+            held.append(sock)
+        wait_for_metrics(
+            metrics_port,
+            lambda m: m["haas_connected"] == args.connections
+            and m["haas_bytes_received_total"]
+            >= (args.rate_connections + args.connections) * len(line),
+        )
+        held_kib, held_threads, _ = process_usage(logger.pid)
+    finally:
+        for sock in held:
+            sock.close()
+        if os.name == "nt":
+            logger.terminate()
+        else:
+            logger.send_signal(signal.SIGINT)
+        try:
+            logger.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            logger.kill()
+            logger.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    cpu_per_connection = (
+        (cpu_after - cpu_before) / args.rate_connections
+        if cpu_after is not None and cpu_before is not None
+        else None
+    )
+    per_connection = (
+        (held_kib - idle_kib) / args.connections
+        if held_kib is not None and idle_kib is not None
+        else None
+    )
+    return {
+        "connections_per_second": round(rate, 1),
+        "cpu_us_per_connection": (
+            round(cpu_per_connection * 1e6, 1) if cpu_per_connection is not None else None
+        ),
+        "idle_kib": idle_kib,
+        "held_kib": held_kib,
+        "kib_per_connection": round(per_connection, 1) if per_connection is not None else None,
+        "idle_threads": idle_threads,
+        "held_threads": held_threads,
+    }
+
+
+def bench_server(args: argparse.Namespace) -> None:
+    """
+    Compare the server mode designs and print a table.
+    """
+    print(
+        f"[bench] {args.rate_connections:,} connections, {args.concurrency} at a time,"
+        f" then {args.connections:,} held open"
+    )
+    print(
+        f"{'design':<12} {'conn/s':>9} {'CPU us/conn':>12} {'idle KiB':>10} {'held KiB':>10}"
+        f" {'KiB/conn':>9} {'threads':>13}"
+    )
+    for design in args.designs:
+        result = measure_server(design, args)
+
+        def shown(value: Optional[float], width: int, spec: str = ",.0f") -> str:
+            return f"{value:>{width}{spec}}" if value is not None else f"{'-':>{width}}"
+
+        threads = (
+            f"{result['idle_threads']} -> {result['held_threads']}"
+            if result["held_threads"] is not None
+            else "-"
+        )
+        print(
+            f"{design:<12} {result['connections_per_second']:>9,.0f}"
+            f" {shown(result['cpu_us_per_connection'], 12)}"
+            f" {shown(result['idle_kib'], 10)} {shown(result['held_kib'], 10)}"
+            f" {shown(result['kib_per_connection'], 9, ',.1f')} {threads:>13}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Haas CNC Data Logger micro-benchmarks",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python haas_benchmark.py generate -n 2000000 -o cycles.txt     # A dataset of 2 million cycles
+    python haas_benchmark.py stages --dataset cycles.txt -s dprnt_schemas.json --json pi5.json
+    python haas_benchmark.py compare main.json branch.json          # Exit code 1 on a regression
+    python haas_benchmark.py server --connections 1000              # Event loop against a thread per connection
+
+Notes:
+    - Stages: frame, parse, write-new, write-append, write-cached, write-db, report-csv, report-db
+    - frame and parse use the whole dataset, the write and report stages its first --write-cycles cycles
+    - Latencies are per operation: a 4 KiB chunk, a cycle, a CSV file or a database query
+    - Peak memory is measured by tracemalloc in a second run, --no-memory skips it
+    - receive traces every receive with tracemalloc: B/chunk is the peak allocated by a chunk that ends no cycle, B/cycle end by one that does
+    - server runs haas_logger2.py in server mode in a separate process, memory is read from /proc (Linux)
+        """,
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    framing = subparsers.add_parser(
+        "framing", help="Cost per byte of cycle framing as the cycle grows"
+    )
+    framing.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1_000, 16_000, 256_000, 1_000_000, 4_000_000],
+        help="Cycle sizes in characters",
+    )
+    framing.add_argument(
+        "--legacy-limit",
+        type=int,
+        default=1_000_000,
+        help="Largest cycle size to run through the legacy framer (default: 1000000)",
+    )
+    framing.set_defaults(func=bench_framing)
+
+    receive = subparsers.add_parser(
+        "receive", help="Time and allocations per received chunk"
+    )
+    receive.add_argument(
+        "--paths",
+        nargs="+",
+        choices=list(RECEIVE_PATHS),
+        default=list(RECEIVE_PATHS),
+        help="Receive paths to run (default: all)",
+    )
+    receive.add_argument(
+        "-n",
+        "--cycles",
+        type=int,
+        default=2_000,
+        help="Cycles in the stream (default: 2000)",
+    )
+    receive.add_argument(
+        "--probe-lines",
+        type=int,
+        default=400,
+        help="Probe lines per cycle, so most chunks end no cycle (default: 400, about 15 KiB per cycle)",
+    )
+    receive.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    receive.set_defaults(func=bench_receive)
+
+    parsing = subparsers.add_parser(
+        "parsing", help="Time per cycle of the DPRNT field parser"
+    )
+    parsing.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[300, 4_000, 64_000, 1_000_000],
+        help="Cycle sizes in characters",
+    )
+    parsing.set_defaults(func=bench_parsing)
+
+    generate = subparsers.add_parser(
+        "generate", help="Write a dataset of realistic DPRNT cycles"
+    )
+    generate.add_argument(
+        "-n",
+        "--cycles",
+        type=int,
+        default=1_000_000,
+        help="Number of cycles (default: 1000000)",
+    )
+    generate.add_argument(
+        "-o",
+        "--output",
+        default="bench_cycles.txt",
+        help="Dataset file (default: bench_cycles.txt)",
+    )
+    generate.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    generate.add_argument(
+        "--probe-lines",
+        type=int,
+        default=0,
+        help="Extra probe point lines per cycle, for larger cycles (default: 0)",
+    )
+    generate.set_defaults(func=bench_generate)
+
+    stages = subparsers.add_parser(
+        "stages", help="Throughput, latency and peak memory of each stage of the logger"
+    )
+    stages.add_argument(
+        "--dataset",
+        help="Dataset file from the generate command (default: generate cycles)",
+    )
+    stages.add_argument(
+        "-n",
+        "--cycles",
+        type=int,
+        default=100_000,
+        help="Cycles to generate without --dataset (default: 100000)",
+    )
+    stages.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    stages.add_argument(
+        "--write-cycles",
+        type=int,
+        default=5_000,
+        help="Cycles used by the write and report stages (default: 5000)",
+    )
+    stages.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(STAGES),
+        default=list(STAGES),
+        help="Stages to run (default: all)",
+    )
+    stages.add_argument(
+        "-s",
+        "--schemas",
+        dest="schema_file",
+        help="JSON file with extra DPRNT fields per program (see dprnt_schemas.json)",
+    )
+    stages.add_argument(
+        "--no-memory", action="store_true", help="Skip the peak memory run"
+    )
+    stages.add_argument("--label", default="", help="Free text saved with the results")
+    stages.add_argument("--json", help="Save the results to this JSON file")
+    stages.set_defaults(func=bench_stages)
+
+    compare = subparsers.add_parser(
+        "compare", help="Compare two stages results saved with --json"
+    )
+    compare.add_argument("base", help="Results before the change")
+    compare.add_argument("new", help="Results after the change")
+    compare.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="Throughput drop in percent that counts as a regression (default: 10)",
+    )
+    compare.set_defaults(func=compare_results)
+
+    server = subparsers.add_parser(
+        "server", help="Connections per second and memory per connection of server mode"
+    )
+    server.add_argument(
+        "--designs",
+        nargs="+",
+        choices=list(SERVER_DESIGNS),
+        default=list(SERVER_DESIGNS),
+        help="Designs to run (default: all)",
+    )
+    server.add_argument(
+        "--rate-connections",
+        type=int,
+        default=2_000,
+        help="Connections opened and closed for the rate (default: 2000)",
+    )
+    server.add_argument(
+        "--concurrency",
+        type=int,
+        default=50,
+        help="Connections opened at a time for the rate (default: 50)",
+    )
+    server.add_argument(
+        "--backlog",
+        type=int,
+        default=128,
+        help="Listen backlog of the logger, below --concurrency connections get dropped and retried (default: 128)",
+    )
+    server.add_argument(
+        "--connections",
+        type=int,
+        default=500,
+        help="Connections held open for the memory (default: 500)",
+    )
+    server.set_defaults(func=bench_server)
+
+    args = parser.parse_args()
+    args.func(args)
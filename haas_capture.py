@@ -0,0 +1,361 @@
+"""
+Recordings of the raw TCP stream of machine connections, for replaying them later.
+
+# Captures with their chunk count, size and length
+python haas_capture.py list
+
+# Replay one at 10x speed against a server mode logger
+python haas_simulator.py -H localhost --replay captures/st30l/20251209_061502_192.168.1.21_5062.cap --speed 10
+"""
+
+import argparse
+import gzip
+import json
+import os
+import queue
+import struct
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, IO, List, Optional, Tuple
+
+# First line of a capture file, followed by one line of JSON metadata
+CAPTURE_MAGIC = b"HAASCAP1\n"
+
+# Chunk header: seconds since the connection opened, payload length
+CHUNK_HEADER = struct.Struct("<dI")
+
+# A received chunk: (seconds since the connection opened, bytes as received)
+Chunk = Tuple[float, bytes]
+
+
+class Capture:
+    """
+    Recording of one connection.
+
+    Every chunk returned by recv() is appended as it arrived: a 12-byte header with
+    the receive time (seconds since the connection opened) and the length, then the
+    bytes themselves, undecoded. Chunk boundaries and timing are kept exactly, so a
+    replay feeds the logger the same reads in the same rhythm as the machine did.
+
+    write() and close() only queue the chunk for the thread of the CaptureRecorder,
+    so a receive loop never waits for the disk. That thread creates the file, and
+    flushes it whenever it has written every queued chunk, so a capture survives the
+    logger being killed and only the chunks of the last moment are lost.
+    """
+
+    def __init__(
+        self, recorder: "CaptureRecorder", base: str, metadata: Dict[str, Any]
+    ) -> None:
+        """
+        Queue the creation of the capture file with its header.
+
+        Args:
+            recorder: Recorder whose thread writes the file.
+            base: Path of the file without .cap, a number is added if it exists.
+            metadata: Machine, peer and local port, stored in the header.
+        """
+        self.recorder = recorder
+        self.base = base
+        self.machine = metadata.get("machine", "capture")
+        self.path = ""
+        # Set by the recorder thread when the file can't be written
+        self.failed = False
+        self.started = time.time()
+        self.chunks = 0
+        self.size = 0
+        self._file: Optional[IO[bytes]] = None
+        header = dict(metadata, started=self.started)
+        recorder.put(self, CAPTURE_MAGIC + json.dumps(header).encode("utf-8") + b"\n")
+
+    def write(self, data: bytes, received: Optional[float] = None) -> None:
+        """
+        Append one received chunk.
+
+        Args:
+            data: The bytes returned by one recv(). A view is copied before this
+            returns, so the buffer behind it can be reused.
+            received: Receive time as returned by time.time(). Defaults to now.
+        """
+        elapsed = (received if received is not None else time.time()) - self.started
+        self.recorder.put(self, CHUNK_HEADER.pack(elapsed, len(data)) + data)
+        self.chunks += 1
+        self.size += len(data)
+
+    def close(self) -> None:
+        """
+        Close the capture file once everything queued is written.
+        """
+        self.recorder.put(self, None)
+
+    def append(self, data: bytes) -> None:
+        """
+        Write queued bytes, creating the file first. Runs on the recorder thread.
+
+        Args:
+            data: Bytes to append.
+        """
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.base), exist_ok=True)
+            path = f"{self.base}.cap"
+            number = 1
+            while os.path.exists(path):
+                # Reconnects within the same second
+                path = f"{self.base}_{number}.cap"
+                number += 1
+            self._file = open(path, "wb")
+            self.path = path
+            print(f"[{self.machine}] Recording the connection to {path}")
+        self._file.write(data)
+
+    def flush(self) -> None:
+        """
+        Flush the written bytes to the OS. Runs on the recorder thread.
+        """
+        if self._file is not None:
+            self._file.flush()
+
+    def close_file(self) -> None:
+        """
+        Close the file. Runs on the recorder thread.
+        """
+        if self._file is not None:
+            self._file.close()
+
+
+class CaptureRecorder:
+    """
+    Creates one capture per connection under directory/<machine>/.
+
+    Shared by every logger in a process. One thread writes every capture, in the
+    order the chunks were queued; call close() to write what is still queued.
+    """
+
+    def __init__(self, directory: str = "captures") -> None:
+        """
+        Initialize the recorder. The thread is started on first use.
+
+        Args:
+            directory: Root directory of the captures.
+        """
+        self.directory = directory
+        self._queue: "queue.Queue[Optional[Tuple[Capture, Optional[bytes]]]]" = (
+            queue.Queue()
+        )
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def open(self, machine: str, peer: Tuple[str, int], local_port: int) -> Capture:
+        """
+        Start the capture of a new connection.
+
+        Args:
+            machine: Machine name.
+            peer: Remote (IP address, port) of the connection.
+            local_port: Port the logger listened on or connected to.
+
+        Returns:
+            The capture, written to <YYYYmmdd_HHMMSS>_<ip>_<port>.cap.
+        """
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        base = os.path.join(self.directory, machine, f"{timestamp}_{peer[0]}_{peer[1]}")
+        return Capture(
+            self,
+            base,
+            {"machine": machine, "peer": f"{peer[0]}:{peer[1]}", "port": local_port},
+        )
+
+    def put(self, capture: Capture, data: Optional[bytes]) -> None:
+        """
+        Queue bytes for a capture file, starting the thread if needed.
+
+        Args:
+            capture: The capture the bytes belong to.
+            data: Bytes to append, or None to close the file.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="capture", daemon=True
+                )
+                self._thread.start()
+        self._queue.put((capture, data))
+
+    def _run(self) -> None:
+        """
+        Recorder thread: write queued chunks until close() is called.
+        """
+        # Captures with a file open, and those of them with unflushed bytes
+        captures: Dict[int, Capture] = {}
+        unflushed: Dict[int, Capture] = {}
+        while True:
+            try:
+                item = self._queue.get(block=not unflushed)
+            except queue.Empty:
+                # Everything queued is written, get it to the OS
+                for capture in unflushed.values():
+                    try:
+                        capture.flush()
+                    except OSError:
+                        pass
+                unflushed.clear()
+                continue
+            if item is None:
+                break
+            capture, data = item
+            key = id(capture)
+            if data is None:
+                captures.pop(key, None)
+                unflushed.pop(key, None)
+                try:
+                    capture.close_file()
+                except OSError:
+                    pass
+                continue
+            if capture.failed:
+                # The rest of the connection is not recorded
+                continue
+            try:
+                capture.append(data)
+                captures[key] = capture
+                unflushed[key] = capture
+            except OSError as e:
+                print(f"[{capture.machine}] ERROR: Could not record the connection: {e}")
+                capture.failed = True
+
+        for capture in captures.values():
+            try:
+                capture.close_file()
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        """
+        Write everything still queued and stop the thread.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+
+def read_capture(path: str) -> Tuple[Dict[str, Any], List[Chunk]]:
+    """
+    Read a capture file. Files compressed with gzip (.cap.gz) are read as well.
+
+    Args:
+        path: Capture file.
+
+    Returns:
+        Tuple of (header metadata, chunks in receive order). A partly written last
+        chunk is left out.
+
+    Raises:
+        ValueError: If the file is not a capture.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        if f.readline() != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        metadata = json.loads(f.readline())
+        chunks: List[Chunk] = []
+        try:
+            while True:
+                header = f.read(CHUNK_HEADER.size)
+                if len(header) < CHUNK_HEADER.size:
+                    break
+                elapsed, length = CHUNK_HEADER.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    break
+                chunks.append((elapsed, data))
+        except EOFError:
+            # A compressed capture that was cut off
+            pass
+    return metadata, chunks
+
+
+def find_captures(paths: List[str]) -> List[str]:
+    """
+    Expand directories into the capture files they hold.
+
+    Args:
+        paths: Capture files and directories of captures.
+
+    Returns:
+        Capture files, those of each directory in name (and so time) order.
+    """
+    captures = []
+    for path in paths:
+        if not os.path.isdir(path):
+            captures.append(path)
+            continue
+        for dirpath, _, filenames in sorted(os.walk(path)):
+            captures.extend(
+                os.path.join(dirpath, filename)
+                for filename in sorted(filenames)
+                if filename.endswith((".cap", ".cap.gz"))
+            )
+    return captures
+
+
+def list_captures(args: argparse.Namespace) -> None:
+    """
+    Print the captures with their chunk count, size and length.
+    """
+    print(f"{'capture':<60} {'chunks':>8} {'bytes':>12} {'seconds':>10}")
+    for path in find_captures(args.paths):
+        try:
+            _, chunks = read_capture(path)
+        except (OSError, ValueError) as e:
+            print(f"[capture] Skipped {path}: {e}")
+            continue
+        print(
+            f"{path:<60} {len(chunks):>8} {sum(len(data) for _, data in chunks):>12,}"
+            f" {chunks[-1][0] if chunks else 0.0:>10.1f}"
+        )
+
+
+def cat_captures(args: argparse.Namespace) -> None:
+    """
+    Print the chunks of captures with their receive time.
+    """
+    for path in find_captures(args.paths):
+        metadata, chunks = read_capture(path)
+        print(f"==> {path}: {metadata.get('machine')} from {metadata.get('peer')} <==")
+        for elapsed, data in chunks:
+            print(f"--- {elapsed:.3f}s, {len(data)} bytes ---")
+            print(data.decode("utf-8", errors="replace"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Haas CNC Data Logger - Inspect recordings of machine connections",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python haas_capture.py list                          # Every capture in captures/
+    python haas_capture.py cat captures/st30l            # Chunks of one machine's captures
+
+Notes:
+    - Start haas_logger2.py or haas_fleet.py with --record to capture every connection
+    - Replay captures with haas_simulator.py --replay, at real time (--speed 1), faster, or as fast as possible (--speed 0)
+        """,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, func, help_text in (
+        ("list", list_captures, "Captures with their chunk count, size and length"),
+        ("cat", cat_captures, "Print the chunks of captures"),
+    ):
+        command = subparsers.add_parser(name, help=help_text)
+        command.add_argument(
+            "paths",
+            nargs="*",
+            default=["captures"],
+            help="Capture files or directories (default: captures)",
+        )
+        command.set_defaults(func=func)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,179 @@
+"""
+Compact the one-row CSV files of NEW FILE mode into daily files.
+
+# Merge every per-cycle file from before today into <machine>_<part>_<YYYYmmdd>.csv
+python haas_compact.py
+
+# Show what would be merged
+python haas_compact.py --dry-run
+"""
+
+import argparse
+import csv
+import os
+import re
+from collections import Counter
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+from haas_storage import read_csv_rows
+
+# <machine>_<part>_<YYYYmmdd>_<HHMMSS>.csv, written per cycle without -a
+CYCLE_FILE_RE = re.compile(r"^(?P<base>.+)_(?P<day>\d{8})_\d{6}\.csv$")
+
+
+def find_cycle_files(
+    directory: str, today: Optional[str] = None
+) -> Dict[Tuple[str, str, str], List[str]]:
+    """
+    Find the per-cycle files from before today.
+
+    Args:
+        directory: Directory holding the CSV files, searched with its subdirectories.
+        today: Day as YYYYmmdd whose files are still being written and are left
+        alone. Defaults to the current day.
+
+    Returns:
+        File paths in time order, grouped by (directory, machine_part, YYYYmmdd).
+    """
+    today = today or date.today().strftime("%Y%m%d")
+    groups: Dict[Tuple[str, str, str], List[str]] = {}
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            match = CYCLE_FILE_RE.match(filename)
+            if match and match.group("day") < today:
+                key = (dirpath, match.group("base"), match.group("day"))
+                groups.setdefault(key, []).append(os.path.join(dirpath, filename))
+    return groups
+
+
+def _row_identity(row: Dict[str, str]) -> frozenset:
+    """
+    Identity of a row that does not depend on the columns of the file it is in.
+
+    Files of one day can have different columns (a schema was added), so empty
+    columns are left out.
+    """
+    return frozenset((name, value) for name, value in row.items() if value)
+
+
+def compact_files(daily_path: str, paths: List[str]) -> int:
+    """
+    Merge per-cycle files into one daily file, then delete them.
+
+    The daily file is rewritten through a temp file and an atomic rename, so a
+    reader sees either the old or the new version. The per-cycle files are only
+    deleted after the rename, and a file whose rows the daily file already holds
+    is skipped, so a run that was interrupted can simply be run again. Identical
+    rows are kept otherwise: cycles received in the same second share one file
+    and can be equal.
+
+    Args:
+        daily_path: Daily file to merge into, created if missing.
+        paths: Per-cycle files, in time order.
+
+    Returns:
+        Number of rows added to the daily file.
+    """
+    fieldnames, rows = read_csv_rows(daily_path)
+    fieldnames = list(fieldnames)
+    # Rows of the daily file no merged file has been matched to yet
+    unmatched = Counter(_row_identity(row) for row in rows)
+    added = 0
+
+    for path in paths:
+        file_fieldnames, file_rows = read_csv_rows(path)
+        counts = Counter(_row_identity(row) for row in file_rows)
+        if counts and all(unmatched[key] >= n for key, n in counts.items()):
+            # Merged by an earlier run that was interrupted before deleting it
+            unmatched -= counts
+            continue
+        for name in file_fieldnames:
+            if name not in fieldnames:
+                fieldnames.append(name)
+        rows.extend(file_rows)
+        added += len(file_rows)
+
+    directory, filename = os.path.split(daily_path)
+    temp_path = os.path.join(directory, f".{filename}.tmp")
+    with open(temp_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, restval="")
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(temp_path, daily_path)
+
+    for path in paths:
+        os.remove(path)
+    return added
+
+
+def compact_directory(
+    directory: str = "cnc_logs", today: Optional[str] = None, dry_run: bool = False
+) -> int:
+    """
+    Merge the per-cycle files of every finished day into daily files.
+
+    <machine>_<part>_<YYYYmmdd>_<HHMMSS>.csv files are merged into
+    <machine>_<part>_<YYYYmmdd>.csv in the same directory. Files from today are
+    left alone. A group that cannot be merged (a file is locked) is reported and
+    tried again next time.
+
+    This rewrites files in the logger's output directory, so inside the logger it
+    runs on the writer thread (CycleWriter.add_task).
+
+    Args:
+        directory: Directory holding the CSV files.
+        today: Day as YYYYmmdd to leave alone. Defaults to the current day.
+        dry_run: Only report what would be merged.
+
+    Returns:
+        Number of per-cycle files merged.
+    """
+    merged = 0
+    for (dirpath, base, day), paths in find_cycle_files(directory, today).items():
+        daily_path = os.path.join(dirpath, f"{base}_{day}.csv")
+        if dry_run:
+            print(f"[compact] {len(paths)} file(s) -> {daily_path}")
+            merged += len(paths)
+            continue
+        try:
+            added = compact_files(daily_path, paths)
+        except (IOError, PermissionError) as e:
+            print(f"[compact] ERROR: Could not compact into {daily_path}: {e}")
+            continue
+        merged += len(paths)
+        print(f"[compact] {len(paths)} file(s), {added} row(s) merged into {daily_path}")
+    return merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Haas CNC Data Logger - Merge NEW FILE mode cycle files into daily files",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python haas_compact.py                    # Compact cnc_logs
+    python haas_compact.py -d cnc_store -n    # Show what would be compacted in cnc_store
+
+Notes:
+    - Machine1_TEST-001_20251202_141427.csv and the other files of that day become Machine1_TEST-001_20251202.csv
+    - Files from today are left alone, the logger may still be writing them
+    - Safe to run while the logger is running and to run again after an interruption
+        """,
+    )
+    parser.add_argument(
+        "-d",
+        "--dir",
+        default="cnc_logs",
+        help="Directory with the CSV files (default: cnc_logs)",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Only show what would be merged",
+    )
+    args = parser.parse_args()
+
+    count = compact_directory(args.dir, dry_run=args.dry_run)
+    print(f"[compact] {count} file(s) {'to merge' if args.dry_run else 'merged'}")
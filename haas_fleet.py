@@ -0,0 +1,1055 @@
+import argparse
+import asyncio
+import csv
+import glob
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import zlib
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+
+from haas_archive import CycleArchive
+from haas_capture import CaptureRecorder
+from haas_compact import compact_directory
+from haas_framing import CycleLimits
+from haas_journal import CycleJournal, merge_backups
+from haas_layout import PathLayout
+from haas_logger2 import HaasDataLogger
+from haas_metrics import MetricsServer, merge_metrics
+from haas_net import ConnectionSettings, backoff_delay, enable_keepalive
+from haas_parser import SchemaRegistry
+from haas_profile import StageProfiler
+from haas_server import save_executors
+from haas_sqlite import SqliteStore
+from haas_storage import CsvHandleCache, SnapshotPublisher
+from haas_writer import CycleWriter
+
+
+def load_machines(path: str) -> List[Dict[str, str]]:
+    """
+    Load the machine list from an Excel workbook or a CSV file.
+
+    Uses the same layout as the machines.xlsx file consumed by conf-gen_xlsx_v1.py.
+    The columns "name", "ip_address" and "port" are required. An optional "append"
+    column (yes/true/1) turns on append mode for that machine only.
+
+    Args:
+        path: Path to a .xlsx or .csv file.
+
+    Returns:
+        List of dictionaries, one per machine, with all values as strings.
+
+    Raises:
+        FileNotFoundError: If the file does not exist.
+        ValueError: If a required column is missing.
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"{path} doesn't exist")
+
+    if path.lower().endswith((".xlsx", ".xls")):
+        # pandas is only needed for Excel input, same as conf-gen_xlsx_v1.py
+        import pandas as pd
+
+        df = pd.read_excel(path, dtype=str).fillna("")
+        rows = df.to_dict(orient="records")
+    else:
+        with open(path, newline="") as f:
+            rows = list(csv.DictReader(f))
+
+    machines = []
+    for row in rows:
+        row = {str(k).strip(): str(v).strip() for k, v in row.items() if k}
+        if not any(row.values()):
+            continue
+        for column in ("name", "ip_address", "port"):
+            if not row.get(column):
+                raise ValueError(f"{path}: missing '{column}' in row {row}")
+        machines.append(row)
+    return machines
+
+
+def shard_of(name: str, workers: int) -> int:
+    """
+    The worker process a machine is logged by.
+
+    The assignment only depends on the machine name and the number of workers
+    (CRC-32, which unlike hash() is the same in every process and run), so a
+    machine stays with its worker, and its journal, across restarts, and adding a
+    machine to the list does not move the others.
+
+    Args:
+        name: Machine name.
+        workers: Number of worker processes.
+
+    Returns:
+        The worker, from 0 to workers - 1.
+    """
+    return zlib.crc32(name.encode("utf-8")) % workers
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """
+    Parse the --shard K/N argument a worker process is started with.
+
+    Args:
+        value: Worker number and number of workers, ex. "1/4".
+
+    Returns:
+        (worker, workers).
+
+    Raises:
+        argparse.ArgumentTypeError: If the value is not K/N with 0 <= K < N.
+    """
+    match = re.fullmatch(r"(\d+)/(\d+)", value.strip())
+    if not match or int(match.group(1)) >= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"{value!r} is not K/N with K < N")
+    return int(match.group(1)), int(match.group(2))
+
+
+def machine_of(filename: str, names: List[str]) -> Optional[str]:
+    """
+    The machine a CSV file belongs to, from its name (<machine>_<part>....csv).
+
+    Args:
+        filename: File name without directory.
+        names: Names of every machine in the list.
+
+    Returns:
+        The longest matching machine name, so st30l_... is st30l and not st30, or
+        None if the file belongs to no machine in the list.
+    """
+    found = None
+    for name in names:
+        if filename.startswith(f"{name}_") and (
+            found is None or len(name) > len(found)
+        ):
+            found = name
+    return found
+
+
+def shard_filter(names: List[str], shard: int, workers: int) -> Callable[[str], bool]:
+    """
+    Build the file name filter of a worker's backup merging and publishing.
+
+    Files of machines that are no longer in the list go to worker 0, so they are
+    still merged and published by exactly one worker.
+
+    Args:
+        names: Names of every machine in the list.
+        shard: The worker.
+        workers: Number of worker processes.
+
+    Returns:
+        A function that is True for the file names of the worker's machines.
+    """
+
+    def owns(filename: str) -> bool:
+        machine = machine_of(filename, names)
+        if machine is None:
+            return shard == 0
+        return shard_of(machine, workers) == shard
+
+    return owns
+
+
+def shard_path(path: str, shard: int) -> str:
+    """
+    The file of one worker, ex. journal/fleet.jsonl -> journal/fleet-1.jsonl.
+    """
+    base, ext = os.path.splitext(path)
+    return f"{base}-{shard}{ext}"
+
+
+def stale_journals(path: str, workers: int) -> List[str]:
+    """
+    Find the journals of an earlier run with a different number of workers.
+
+    Args:
+        path: The --journal file.
+        workers: Number of worker processes now, 1 without --workers.
+
+    Returns:
+        The unsharded journal if there are workers now, and the journal of every
+        worker that no longer exists, if they hold anything.
+    """
+    base, ext = os.path.splitext(path)
+    candidates = [path] if workers > 1 else []
+    for candidate in glob.glob(f"{glob.escape(base)}-*{ext}"):
+        suffix = candidate[len(base) : len(candidate) - len(ext)]
+        match = re.fullmatch(r"-(\d+)", suffix)
+        if match and (workers == 1 or int(match.group(1)) >= workers):
+            candidates.append(candidate)
+    return [c for c in sorted(candidates) if os.path.isfile(c) and os.path.getsize(c)]
+
+
+def replay_stale_journals(
+    path: str, workers: int, loggers: List[HaasDataLogger]
+) -> None:
+    """
+    Replay the journals of an earlier run with a different number of workers.
+
+    This runs in one process before any worker starts, so the replayed cycles are
+    never appended to a file at the same time as a worker appends to it.
+
+    Args:
+        path: The --journal file.
+        workers: Number of worker processes now, 1 without --workers.
+        loggers: Loggers of every machine in the list, by which the cycles are
+        written. Cycles of removed machines are written as recover() does.
+    """
+    by_name = {logger.machine_name: logger for logger in loggers}
+    for stale_path in stale_journals(path, workers):
+        print(f"[fleet] Replaying {stale_path} of a run with other workers")
+        stale = CycleJournal(stale_path)
+        stale.recover(by_name)
+        stale.close()
+
+
+def stop_on_sigterm() -> None:
+    """
+    Shut down on SIGTERM (systemctl stop, or the supervising process) the same way
+    as on Ctrl+C. Only the first SIGTERM interrupts, so the clean-up is not cut
+    short by another one.
+    """
+
+    def handler(signum: int, frame: object) -> None:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, handler)
+
+
+def exit_with_parent(parent: int, name: str = "fleet") -> None:
+    """
+    Shut a worker process down when its supervising process is gone, killed
+    with SIGKILL for example, instead of logging on unsupervised.
+
+    Args:
+        parent: Process ID of the supervising process.
+        name: Name printed with the message, ex. "fleet-1".
+    """
+
+    def watch() -> None:
+        while os.getppid() == parent:
+            time.sleep(1)
+        print(f"[{name}] Supervising process is gone, shutting down")
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=watch, name="parent-watch", daemon=True).start()
+
+
+class FleetSupervisor:
+    """
+    Drive client connections to many Haas machines from one asyncio event loop.
+
+    Each machine gets its own HaasDataLogger (for naming, parsing and saving) and its
+    own task that connects, reads and reconnects. A failing or stuck machine only
+    affects its own task; file writes run on the shared writer thread (or a worker
+    thread) so a locked CSV does not block the event loop.
+    """
+
+    def __init__(
+        self,
+        machines: List[Dict[str, str]],
+        append_mode: bool = False,
+        connection: Optional[ConnectionSettings] = None,
+        schemas: Optional[SchemaRegistry] = None,
+        handle_cache: Optional[CsvHandleCache] = None,
+        writer: Optional[CycleWriter] = None,
+        output_dir: str = "cnc_logs",
+        store: Optional[SqliteStore] = None,
+        layout: Optional[PathLayout] = None,
+        archive: Optional[CycleArchive] = None,
+        recorder: Optional[CaptureRecorder] = None,
+        profiler: Optional[StageProfiler] = None,
+        name: str = "fleet",
+        limits: Optional[CycleLimits] = None,
+    ) -> None:
+        """
+        Initialize the fleet supervisor.
+
+        Args:
+            machines: Machine rows as returned by load_machines().
+            append_mode: Default append mode for machines without an "append" column.
+            connection: Timeouts, keepalive and reconnect backoff for every machine.
+            If None, the ConnectionSettings defaults are used.
+            schemas: Per-program DPRNT schemas, compiled once and shared by all machines.
+            handle_cache: Open append-mode files shared by all machines, or None.
+            writer: Writer thread shared by all machines. If None, each machine saves
+            its cycles in a save thread of its own, see save_executors().
+            output_dir: Directory the CSV files are written to.
+            store: SQLite database shared by all machines, used instead of CSV files.
+            layout: Subdirectories of output_dir the files are sorted into, or None.
+            archive: Raw cycle archive shared by all machines, or None.
+            recorder: Records the raw stream of every connection, or None.
+            profiler: Times the stages of every machine, or None.
+            name: Name printed with the fleet messages, "fleet-1" for a worker.
+            limits: Memory, size and age limits of the cycle of every machine. If
+            None, the CycleLimits defaults are used.
+        """
+        self.name = name
+        self.handle_cache = handle_cache
+        self.writer = writer
+        self.connection = connection or ConnectionSettings()
+        self.limits = limits or CycleLimits()
+        self.loggers: List[HaasDataLogger] = []
+
+        for machine in machines:
+            append = machine.get("append", "")
+            self.loggers.append(
+                HaasDataLogger(
+                    port=int(float(machine["port"])),
+                    machine_name=machine["name"],
+                    append_mode=(
+                        append.lower() in ("1", "yes", "true", "y")
+                        if append
+                        else append_mode
+                    ),
+                    target_ip=machine["ip_address"],
+                    schemas=schemas,
+                    handle_cache=handle_cache,
+                    writer=writer,
+                    output_dir=output_dir,
+                    store=store,
+                    layout=layout,
+                    archive=archive,
+                    recorder=recorder,
+                    profiler=profiler,
+                    connection=self.connection,
+                    limits=self.limits,
+                )
+            )
+
+    async def run_machine(self, logger: HaasDataLogger) -> None:
+        """
+        Connect to one machine and keep reconnecting until stopped.
+
+        Args:
+            logger: The logger for this machine.
+        """
+        address = (logger.target_ip, logger.port)
+        settings = self.connection
+        failures = 0
+
+        while logger.running:
+            writer = None
+            received = logger.metrics.bytes_received
+            try:
+                print(
+                    f"[{logger.machine_name}] Attempting to connect to {address[0]}:{address[1]}..."
+                )
+                logger.metrics.connect_attempts += 1
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(*address), settings.connect_timeout or None
+                )
+                sock = writer.get_extra_info("socket")
+                if sock is not None:
+                    enable_keepalive(
+                        sock,
+                        settings.keepalive_idle,
+                        settings.keepalive_interval,
+                        settings.keepalive_count,
+                    )
+                print(f"[{logger.machine_name}] Successfully connected!")
+                await logger.process_stream(reader, address)
+
+            except ConnectionRefusedError:
+                print(
+                    f"[{logger.machine_name}] Connection refused. Machine may be offline or not accepting connections."
+                )
+            except asyncio.TimeoutError:
+                print(f"[{logger.machine_name}] Connection timeout.")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[{logger.machine_name}] Connection error: {e}")
+            finally:
+                if writer is not None:
+                    writer.close()
+
+            # Back off after every failure in a row, with jitter so a network blip
+            # does not make every machine reconnect at the same moment
+            if logger.running:
+                failures = (
+                    1 if logger.metrics.bytes_received > received else failures + 1
+                )
+                delay = backoff_delay(failures, settings)
+                logger.metrics.reconnects += 1
+                logger.metrics.reconnect_delay = delay
+                print(
+                    f"[{logger.machine_name}] Reconnecting in {delay:.1f} seconds... (attempt {failures})"
+                )
+                await asyncio.sleep(delay)
+
+    async def run(self) -> None:
+        """
+        Run one task per machine until all of them finish or are cancelled.
+        """
+        for logger in self.loggers:
+            logger.running = True
+
+        executors = save_executors(self.loggers)
+        tasks = [
+            asyncio.create_task(self.run_machine(logger), name=logger.machine_name)
+            for logger in self.loggers
+        ]
+        if not tasks:
+            # Worker 0 runs the directory-wide tasks even without machines of its own
+            await asyncio.Event().wait()
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Saves already running finish, their cycles are not lost
+            for executor in executors:
+                executor.shutdown()
+
+    def start(self) -> None:
+        """
+        Start the supervisor and block until Ctrl+C.
+        """
+        print(
+            f"[{self.name}] Starting {len(self.loggers)} machine(s) in CLIENT mode"
+        )
+        for logger in self.loggers:
+            mode_str = "APPEND mode" if logger.append_mode else "NEW FILE mode"
+            print(
+                f"[{self.name}]   {logger.machine_name}: {logger.target_ip}:{logger.port} ({mode_str})"
+            )
+        print(f"[{self.name}] Press Ctrl+C to stop")
+
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            print(f"\n[{self.name}] Shutting down...")
+        finally:
+            for logger in self.loggers:
+                logger.running = False
+            if self.writer is not None:
+                self.writer.close()
+            if self.handle_cache is not None:
+                self.handle_cache.close_all()
+
+
+class ShardSupervisor:
+    """
+    Run the fleet as worker processes that each log their share of the machines.
+
+    Parsing and saving cycles is CPU work the GIL keeps on one core, however many
+    machines one event loop serves. Each worker is this script again with
+    --shard K/N: it connects to the machines shard_of() assigns to it, journals to
+    its own file and serves its metrics on a local port of its own. The parent
+    only starts the workers, restarts one that exits, with the same backoff as a
+    reconnect, while the others keep logging, and serves the metrics of every
+    worker, labelled with its shard, on the --metrics-port.
+    """
+
+    def __init__(
+        self,
+        shards: Dict[int, List[str]],
+        workers: int,
+        argv: List[str],
+        metrics_port: int = 0,
+        metrics_host: str = "127.0.0.1",
+    ) -> None:
+        """
+        Initialize the supervisor. Call start() to start the workers.
+
+        Args:
+            shards: Machine names by worker, only these workers are started. Worker
+            0 is expected, it runs the directory-wide tasks.
+            workers: Number of worker processes the machines were divided over.
+            argv: Command line arguments the workers are started with.
+            metrics_port: Port of the merged metrics, the workers use the ports
+            after it. 0 serves no metrics.
+            metrics_host: Address the merged metrics are served on.
+        """
+        self.shards = shards
+        self.workers = workers
+        self.argv = argv
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        # Restarts back off like reconnects: 1 s doubling up to a minute, jittered
+        self.backoff = ConnectionSettings()
+        self.processes: Dict[int, subprocess.Popen] = {}
+        self.started: Dict[int, float] = {}
+        self.failures: Dict[int, int] = {shard: 0 for shard in shards}
+        self.restarts: Dict[int, int] = {shard: 0 for shard in shards}
+        self.restart_at: Dict[int, float] = {}
+
+    def worker_metrics_port(self, shard: int) -> int:
+        """
+        The local port a worker serves its metrics on, 0 if metrics are off.
+        """
+        return self.metrics_port + 1 + shard if self.metrics_port else 0
+
+    def command(self, shard: int) -> List[str]:
+        """
+        The command line of one worker process.
+        """
+        command = [sys.executable, os.path.abspath(__file__)] + self.argv
+        command += ["--shard", f"{shard}/{self.workers}"]
+        port = self.worker_metrics_port(shard)
+        if port:
+            # Only the parent is scraped, the workers listen locally
+            command += ["--metrics-port", str(port), "--metrics-host", "127.0.0.1"]
+        return command
+
+    def spawn(self, shard: int) -> None:
+        """
+        Start one worker process.
+
+        The worker gets a session of its own, so Ctrl+C in the terminal only
+        reaches the parent, which then stops every worker once.
+        """
+        process = subprocess.Popen(
+            self.command(shard), start_new_session=os.name != "nt"
+        )
+        self.processes[shard] = process
+        self.started[shard] = time.monotonic()
+        print(
+            f"[fleet] Worker {shard} started (pid {process.pid}): {', '.join(self.shards[shard]) or 'no machines'}"
+        )
+
+    def check(self) -> None:
+        """
+        Restart the workers that exited, once their backoff delay is over.
+        """
+        now = time.monotonic()
+        for shard, process in list(self.processes.items()):
+            if shard in self.restart_at:
+                if now >= self.restart_at[shard]:
+                    del self.restart_at[shard]
+                    self.restarts[shard] += 1
+                    self.spawn(shard)
+                continue
+            code = process.poll()
+            if code is None:
+                continue
+            uptime = now - self.started[shard]
+            # A worker that ran for a while crashed once, not in a loop
+            self.failures[shard] = 1 if uptime >= 60 else self.failures[shard] + 1
+            delay = backoff_delay(self.failures[shard], self.backoff)
+            print(
+                f"[fleet] Worker {shard} exited with code {code} after {uptime:.0f}s, restarting in {delay:.1f} seconds..."
+            )
+            self.restart_at[shard] = now + delay
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """
+        Stop every worker with SIGTERM and wait for them to save what they hold.
+
+        Args:
+            timeout: Seconds to wait for each worker before it is killed.
+        """
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.terminate()
+        for shard, process in self.processes.items():
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                print(
+                    f"[fleet] Worker {shard} did not stop in {timeout:.0f}s, killing it"
+                )
+                process.kill()
+                process.wait()
+
+    def render_metrics(self) -> str:
+        """
+        Scrape every worker and merge their metrics, plus the state of the workers.
+
+        Returns:
+            The metrics in Prometheus text format.
+        """
+        pages: List[Tuple[str, str]] = []
+        up: Dict[int, int] = {}
+        for shard in sorted(self.shards):
+            url = f"http://127.0.0.1:{self.worker_metrics_port(shard)}/metrics"
+            try:
+                with urllib.request.urlopen(url, timeout=2) as response:
+                    page = response.read().decode("utf-8")
+                pages.append((f'shard="{shard}"', page))
+                up[shard] = 1
+            except OSError:
+                up[shard] = 0
+
+        lines = [
+            "# HELP haas_shard_up Whether the worker process answered the scrape.",
+            "# TYPE haas_shard_up gauge",
+        ]
+        lines += [
+            f'haas_shard_up{{shard="{shard}"}} {up[shard]}' for shard in sorted(up)
+        ]
+        lines += [
+            "# HELP haas_shard_restarts_total Times the worker process was restarted.",
+            "# TYPE haas_shard_restarts_total counter",
+        ]
+        lines += [
+            f'haas_shard_restarts_total{{shard="{shard}"}} {self.restarts[shard]}'
+            for shard in sorted(self.restarts)
+        ]
+        lines += [
+            "# HELP haas_shard_machines Machines assigned to the worker process.",
+            "# TYPE haas_shard_machines gauge",
+        ]
+        lines += [
+            f'haas_shard_machines{{shard="{shard}"}} {len(self.shards[shard])}'
+            for shard in sorted(self.shards)
+        ]
+        return "\n".join(lines) + "\n" + merge_metrics(pages)
+
+    def start(self) -> None:
+        """
+        Start the workers and supervise them until Ctrl+C or SIGTERM.
+        """
+        machines = sum(len(names) for names in self.shards.values())
+        print(
+            f"[fleet] Starting {machines} machine(s) in {len(self.shards)} worker process(es)"
+        )
+        metrics_server = None
+        if self.metrics_port:
+            metrics_server = ShardMetricsServer(
+                self, self.metrics_host, self.metrics_port
+            ).start()
+        stop_on_sigterm()
+        try:
+            for shard in sorted(self.shards):
+                self.spawn(shard)
+            print("[fleet] Press Ctrl+C to stop")
+            while True:
+                time.sleep(1)
+                self.check()
+        except KeyboardInterrupt:
+            print("\n[fleet] Stopping the workers...")
+        finally:
+            self.stop()
+            if metrics_server is not None:
+                metrics_server.close()
+            print("[fleet] Stopped")
+
+
+class ShardMetricsServer(MetricsServer):
+    """
+    Serves the merged metrics of the worker processes of a ShardSupervisor.
+    """
+
+    def __init__(self, supervisor: ShardSupervisor, host: str, port: int) -> None:
+        """
+        Initialize the server. Call start() to start listening.
+
+        Args:
+            supervisor: The supervisor whose workers are scraped.
+            host: Address to listen on.
+            port: Port to listen on.
+        """
+        super().__init__([], None, host, port)
+        self.supervisor = supervisor
+
+    def render(self) -> str:
+        """
+        Scrape the workers on every scrape of the parent.
+
+        Returns:
+            The metrics in Prometheus text format.
+        """
+        return self.supervisor.render_metrics()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Haas CNC Fleet Logger - Collect from every machine in one process",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python haas_fleet.py -f machines.xlsx        # Every machine in the workbook
+    python haas_fleet.py -f machines.csv -a      # Append mode for all machines
+    python haas_fleet.py -f machines.xlsx --workers 4   # Use 4 cores
+
+Notes:
+    - The file needs the columns name, ip_address and port (same as conf-gen_xlsx_v1.py)
+    - An optional append column (yes/no) overrides -a per machine
+    - Each machine reconnects on its own, one offline machine does not affect the others
+    - Reconnects wait longer after each failure (up to --max-reconnect-delay), with jitter so machines don't all retry at once
+    - TCP keepalive notices a machine that was switched off or unplugged within about 25 seconds
+    - A cycle above --max-cycle-memory is spilled to a temp file, above --max-cycle-size it is saved as <part>_INCOMPLETE
+    - Cycles are journaled (journal/fleet.jsonl) before they are written and replayed at the next start
+    - Backup files are merged back into the main file once it is no longer locked
+    - With --publish-interval, files are written to cnc_store and published read-only to cnc_logs, so Excel never locks the logger out
+    - With --db, cycles are saved to an SQLite database and the changed parts are exported to CSV files every minute
+    - With --compact-interval, NEW FILE mode files of earlier days are merged into one file per machine, part and day
+    - With --layout, files are sorted into subdirectories, haas_layout.py moves existing files into the layout
+    - The raw text of every cycle is archived, compressed, in archive/<name>/ so it can be parsed again later, for 90 days (--archive-days)
+    - With --record, the raw stream of every connection is saved to captures/<name>/ for haas_simulator.py --replay
+    - With --metrics-port, counters and timings per machine are served in Prometheus format at http://127.0.0.1:<port>/metrics
+    - With --profile, stage times and stack samples are saved to profile/ on SIGUSR1 (kill -USR1 <pid>) and at exit
+    - With --workers N, the machines are divided over N processes by name, a worker that exits is restarted without stopping the others
+    - Each worker journals to its own file (journal/fleet-<worker>.jsonl), worker N's metrics are served locally on --metrics-port + 1 + N
+        """,
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        required=True,
+        help="Machine list - ex. machines.xlsx or machines.csv",
+    )
+    parser.add_argument(
+        "-a",
+        "--append",
+        action="store_true",
+        dest="append_mode",
+        help="Append mode: Save all cycles for same part number to one file",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=10.0,
+        help="Seconds to wait for a machine to accept the connection (default: 10)",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=0.0,
+        help="Reconnect to a machine that sent nothing for this many seconds (default: 0, never)",
+    )
+    parser.add_argument(
+        "--keepalive",
+        type=int,
+        default=10,
+        help="Seconds of silence before keepalive probes check a connection, 0 disables (default: 10)",
+    )
+    parser.add_argument(
+        "--max-reconnect-delay",
+        type=float,
+        default=60.0,
+        help="Longest wait between reconnect attempts to a machine in seconds (default: 60)",
+    )
+    parser.add_argument(
+        "--max-cycle-memory",
+        type=int,
+        default=1024 * 1024,
+        help="Bytes of a cycle kept in memory, the rest is spilled to a temp file (default: 1048576, 0 never spills)",
+    )
+    parser.add_argument(
+        "--max-cycle-size",
+        type=int,
+        default=4 * 1024 * 1024,
+        help="Bytes after which a cycle without End of Cycle is saved as incomplete (default: 4194304, 0 no limit)",
+    )
+    parser.add_argument(
+        "--max-cycle-age",
+        type=float,
+        default=0.0,
+        help="Seconds after which a cycle without End of Cycle is saved as incomplete when more data arrives (default: 0, no limit)",
+    )
+    parser.add_argument(
+        "--spill-dir",
+        default="",
+        help="Directory of the temp files of spilled cycles (default: the system temp directory)",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--schemas",
+        dest="schema_file",
+        help="JSON file with extra DPRNT fields per program (see dprnt_schemas.json)",
+    )
+
+    parser.add_argument(
+        "--max-open-files",
+        type=int,
+        default=0,
+        help="Append mode: keep up to this many CSV files open between cycles (default: 0, open and close every cycle)",
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=5.0,
+        help="With --max-open-files: flush buffered rows at least this often in seconds (default: 5)",
+    )
+    parser.add_argument(
+        "--flush-every",
+        type=int,
+        default=100,
+        help="With --max-open-files: flush a file after this many cycles (default: 100, --flush-interval flushes the rest)",
+    )
+
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=1000,
+        help="Batches of cycles waiting for the writer thread before reading pauses (default: 1000, 0 writes from a thread per machine)",
+    )
+    parser.add_argument(
+        "--journal",
+        default=os.path.join("journal", "fleet.jsonl"),
+        help="Write-ahead journal file (default: journal/fleet.jsonl)",
+    )
+    parser.add_argument(
+        "--no-journal",
+        action="store_true",
+        help="Do not journal cycles before writing them",
+    )
+    parser.add_argument(
+        "--merge-interval",
+        type=float,
+        default=60.0,
+        help="Seconds between attempts to merge backup files into their main file (default: 60, 0 disables)",
+    )
+    parser.add_argument(
+        "--publish-interval",
+        type=float,
+        default=0.0,
+        help="Write to a private directory and publish read-only copies to cnc_logs every this many seconds (default: 0, write to cnc_logs directly)",
+    )
+    parser.add_argument(
+        "--store-dir",
+        default="cnc_store",
+        help="With --publish-interval: private directory the CSV files are written to (default: cnc_store)",
+    )
+    parser.add_argument(
+        "--db",
+        help="Save cycles to this SQLite database instead of CSV files (see haas_sqlite.py)",
+    )
+    parser.add_argument(
+        "--export-interval",
+        type=float,
+        default=60.0,
+        help="With --db: seconds between exports of the changed parts to CSV files (default: 60, 0 disables)",
+    )
+    parser.add_argument(
+        "--layout",
+        default="",
+        help='Sort the CSV files into subdirectories, ex. "{machine}/{yyyy}/{mm}" (default: all in cnc_logs, see haas_layout.py)',
+    )
+    parser.add_argument(
+        "--archive",
+        default="archive",
+        help="Directory the raw text of every cycle is archived in (default: archive, see haas_archive.py)",
+    )
+    parser.add_argument(
+        "--no-archive",
+        action="store_true",
+        help="Do not archive the raw text of the cycles",
+    )
+    parser.add_argument(
+        "--archive-days",
+        type=int,
+        default=90,
+        help="Delete archived cycles after this many days, 0 keeps them all (default: 90)",
+    )
+    parser.add_argument(
+        "--compact-interval",
+        type=float,
+        default=0.0,
+        help="Seconds between merges of earlier days' NEW FILE mode files into daily files (default: 0, never; see haas_compact.py)",
+    )
+    parser.add_argument(
+        "--record",
+        nargs="?",
+        const="captures",
+        metavar="DIR",
+        help="Record the raw stream of every connection for replay (default directory: captures, see haas_capture.py)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="Serve Prometheus metrics on this port (default: 0, off)",
+    )
+    parser.add_argument(
+        "--metrics-host",
+        default="127.0.0.1",
+        help="Address the metrics are served on (default: 127.0.0.1, local scrapes only)",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="profile",
+        metavar="DIR",
+        help="Time the receive, parse and write stages and sample stacks, saved on SIGUSR1 and at exit (default directory: profile)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes the machines are divided over, up to one per core (default: 1, all in this process)",
+    )
+    # Set by the parent on the command line of each of its worker processes
+    parser.add_argument("--shard", type=parse_shard, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    try:
+        layout = PathLayout(args.layout) if args.layout else None
+    except ValueError as e:
+        parser.error(str(e))
+    if args.publish_interval > 0 and args.queue_size <= 0:
+        parser.error("--publish-interval needs the writer thread (--queue-size > 0)")
+    if args.db and args.export_interval > 0 and args.queue_size <= 0:
+        parser.error("--export-interval needs the writer thread (--queue-size > 0)")
+    if args.compact_interval > 0 and args.queue_size <= 0:
+        parser.error("--compact-interval needs the writer thread (--queue-size > 0)")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    machines = load_machines(args.file)
+    names = [machine["name"] for machine in machines]
+
+    output_dir = args.store_dir if args.publish_interval > 0 else "cnc_logs"
+
+    if args.workers > 1 and args.shard is None:
+        # Worker 0 merges, compacts, exports and publishes the files of removed
+        # machines, so it is started even when no machine hashes to it
+        shards: Dict[int, List[str]] = {0: []}
+        for name in names:
+            shards.setdefault(shard_of(name, args.workers), []).append(name)
+        if args.queue_size > 0 and not args.no_journal:
+            # Replayed before any worker appends to the same files
+            store = SqliteStore(args.db) if args.db else None
+            archive = (
+                None
+                if args.no_archive
+                else CycleArchive(args.archive, keep_days=args.archive_days)
+            )
+            replay_stale_journals(
+                args.journal,
+                args.workers,
+                FleetSupervisor(
+                    machines,
+                    append_mode=args.append_mode,
+                    output_dir=output_dir,
+                    store=store,
+                    layout=layout,
+                    archive=archive,
+                ).loggers,
+            )
+            if store is not None:
+                store.close()
+            if archive is not None:
+                archive.close()
+        ShardSupervisor(
+            shards, args.workers, sys.argv[1:], args.metrics_port, args.metrics_host
+        ).start()
+        sys.exit(0)
+
+    # A worker logs its own machines and runs the directory-wide tasks on their
+    # files only; compaction and the database export run in worker 0. The parent
+    # replayed the journals of an earlier run with other workers.
+    shard, workers = args.shard or (0, 1)
+    owns = None
+    name = "fleet"
+    journal_path = args.journal
+    if args.shard is not None:
+        name = f"fleet-{shard}"
+        stop_on_sigterm()
+        exit_with_parent(os.getppid(), name)
+        machines = [m for m in machines if shard_of(m["name"], workers) == shard]
+        owns = shard_filter(names, shard, workers)
+        journal_path = shard_path(args.journal, shard)
+
+    publisher = None
+    if args.publish_interval > 0:
+        publisher = SnapshotPublisher(args.store_dir, "cnc_logs", owns=owns)
+    store = SqliteStore(args.db) if args.db else None
+    archive = (
+        None
+        if args.no_archive
+        else CycleArchive(args.archive, keep_days=args.archive_days)
+    )
+    profiler = StageProfiler(args.profile, name).start() if args.profile else None
+    recorder = CaptureRecorder(args.record) if args.record else None
+
+    journal = None
+    writer = None
+    if args.queue_size > 0:
+        if not args.no_journal:
+            journal = CycleJournal(journal_path)
+        writer = CycleWriter(args.queue_size, journal=journal)
+        if args.merge_interval > 0:
+            writer.add_task(
+                args.merge_interval, partial(merge_backups, output_dir, owns)
+            )
+        if store is not None and args.export_interval > 0 and shard == 0:
+            writer.add_task(
+                args.export_interval, partial(store.export_new, output_dir, layout)
+            )
+        if args.compact_interval > 0 and shard == 0:
+            writer.add_task(
+                args.compact_interval, partial(compact_directory, output_dir)
+            )
+        if publisher is not None:
+            writer.add_task(args.publish_interval, publisher.publish)
+
+    supervisor = FleetSupervisor(
+        machines,
+        append_mode=args.append_mode,
+        connection=ConnectionSettings(
+            connect_timeout=args.connect_timeout,
+            idle_timeout=args.idle_timeout,
+            keepalive_idle=args.keepalive,
+            max_reconnect_delay=args.max_reconnect_delay,
+        ),
+        schemas=SchemaRegistry.load(args.schema_file) if args.schema_file else None,
+        handle_cache=(
+            CsvHandleCache(args.max_open_files, args.flush_every, args.flush_interval)
+            if args.max_open_files > 0
+            else None
+        ),
+        writer=writer,
+        output_dir=output_dir,
+        store=store,
+        layout=layout,
+        archive=archive,
+        recorder=recorder,
+        profiler=profiler,
+        name=name,
+        limits=CycleLimits(
+            memory_bytes=args.max_cycle_memory,
+            max_bytes=args.max_cycle_size,
+            max_age=args.max_cycle_age,
+            spill_dir=args.spill_dir,
+        ),
+    )
+
+    # Replay cycles a previous run journaled but never wrote, before new ones arrive.
+    # Without --workers, the journals left by a run with workers are replayed too.
+    if journal is not None:
+        if args.shard is None:
+            replay_stale_journals(args.journal, workers, supervisor.loggers)
+        journal.recover({logger.machine_name: logger for logger in supervisor.loggers})
+    if args.merge_interval > 0:
+        merge_backups(output_dir, owns)
+    if publisher is not None:
+        publisher.publish()
+    if writer is not None:
+        writer.start()
+    metrics_server = (
+        MetricsServer(
+            supervisor.loggers, writer, args.metrics_host, args.metrics_port
+        ).start()
+        if args.metrics_port
+        else None
+    )
+    supervisor.start()
+    if metrics_server is not None:
+        metrics_server.close()
+    if profiler is not None:
+        profiler.close()
+    if recorder is not None:
+        recorder.close()
+    if archive is not None:
+        archive.close()
+    if store is not None:
+        if args.export_interval > 0 and shard == 0:
+            store.export_new(output_dir, layout)
+        store.close()
+    if publisher is not None:
+        # Last snapshot, with everything the writer drained on the way out
+        publisher.publish()
@@ -0,0 +1,441 @@
+import re
+import socket
+import tempfile
+import time
+from typing import IO, List, NamedTuple, Optional, Tuple
+
+END_OF_CYCLE = "END OF CYCLE"
+END_OF_CYCLE_RE = re.compile(re.escape(END_OF_CYCLE.encode("ascii")), re.IGNORECASE)
+PART_NUMBER_RE = re.compile(r"PART NUMBER:\s*([^\s,]+)", re.IGNORECASE)
+PART_NUMBER_BYTES_RE = re.compile(rb"PART NUMBER:\s*([^\s,]+)", re.IGNORECASE)
+
+# Longest incomplete line kept for the part number search. A DPRNT line is
+# limited by the control, so this only guards against a stream with no newlines.
+MAX_LINE_LENGTH = 256
+
+# Bytes read by one recv_into()
+CHUNK_SIZE = 4096
+
+# Added to the part number of a cycle that was cut off without its End of Cycle
+INCOMPLETE_SUFFIX = "_INCOMPLETE"
+
+
+class CycleLimits(NamedTuple):
+    """
+    Bounds of the cycle a connection is receiving.
+
+    A program that never prints End of Cycle (aborted, edited, or a device on the
+    wrong port) would otherwise grow its cycle until the Pi runs out of memory.
+    Above memory_bytes, what was received of the cycle is spilled to a temp file
+    in spill_dir (the system temp directory if empty), and only the last line
+    stays in memory. A cycle larger than max_bytes, or older than max_age seconds
+    when more data arrives, is cut off and saved as an incomplete cycle, with
+    INCOMPLETE_SUFFIX added to its part number so it goes to a file of its own,
+    ex. st30l_265-4183_INCOMPLETE.csv. 0 turns a limit off.
+
+    memory_bytes bounds what a connection holds while a cycle is coming in. A
+    cycle is parsed as one string, so a spilled cycle is read back whole when it
+    ends or is cut off: for a moment, a machine then takes up to max_bytes, plus
+    the decoded text.
+    """
+
+    memory_bytes: int = 1024 * 1024
+    max_bytes: int = 4 * 1024 * 1024
+    max_age: float = 0.0
+    spill_dir: str = ""
+
+
+def is_incomplete(part_number: Optional[str]) -> bool:
+    """
+    Whether a framed cycle was cut off by the CycleLimits instead of ending.
+    """
+    return part_number is not None and part_number.endswith(INCOMPLETE_SUFFIX)
+
+
+class CycleFramer:
+    """
+    Incremental framer that splits the DPRNT stream of one connection into cycles.
+
+    The stream is received into one bytearray that is reused for every chunk:
+    recv_into() reads straight into its free space, and the end of cycle marker
+    and the part number are searched on the bytes in place, without copying or
+    decoding them. Only a complete cycle is decoded, in one piece. The marker is
+    ASCII, so a UTF-8 character split across two recv() calls is never cut in
+    half. When the buffer runs out of room, the start of the next cycle is moved
+    to the front, and the buffer only grows when one cycle does not fit. Once it
+    has grown to the largest cycle, receiving a chunk allocates nothing in
+    proportion to its size, only the small view passed to recv_into().
+
+    Every byte is scanned once: the marker is searched in the new bytes plus a
+    short overlap with the previous ones, and the part number in newly completed
+    lines only. The cost per received byte does not depend on how much of the
+    cycle has already been buffered.
+
+    A chunk may hold several cycles when a machine catches up after an outage. Each
+    complete cycle is returned separately, and the bytes after the last marker are
+    kept as the start of the next cycle.
+
+    The limits bound what one cycle can take, see CycleLimits.
+    """
+
+    def __init__(
+        self,
+        size: int = CHUNK_SIZE,
+        chunk_size: int = CHUNK_SIZE,
+        limits: Optional[CycleLimits] = None,
+    ) -> None:
+        """
+        Initialize an empty framer.
+
+        Args:
+            size: Initial size of the receive buffer in bytes. It doubles as
+            needed, so an idle connection only holds one chunk.
+            chunk_size: Bytes read by one recv_into().
+            limits: Memory, size and age limits of a cycle. If None, the
+            CycleLimits defaults are used.
+        """
+        self.chunk_size = chunk_size
+        self.limits = limits or CycleLimits()
+        self.spills = 0
+        self._spill: Optional[IO[bytes]] = None
+        self._spilled = 0
+        self._started: Optional[float] = None
+        self._overlap_length = len(END_OF_CYCLE) - 1
+        self._buffer = bytearray(max(size, chunk_size))
+        self._view = memoryview(self._buffer)
+        self._end = 0
+        self._skip_from: Optional[int] = None
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Discard the buffered cycle and start a new one.
+        """
+        # Start of the current cycle, end of the bytes searched for the marker,
+        # and start of the last incomplete line, all offsets in the buffer
+        self._start = self._end
+        self._scanned = self._end
+        self._line = self._end
+        self.part_number: Optional[str] = None
+        self._close_spill()
+        self._started = None
+
+    @property
+    def spilling(self) -> bool:
+        """
+        Whether the next frame() may write or read the temp file, because the
+        cycle was spilled or the received bytes are above memory_bytes.
+        """
+        memory_bytes = self.limits.memory_bytes
+        return self._spill is not None or (
+            memory_bytes > 0 and self._end - self._start > memory_bytes
+        )
+
+    @property
+    def cycle_size(self) -> int:
+        """
+        Bytes received of the current cycle, in memory and spilled.
+        """
+        return self._spilled + self._end - self._start
+
+    def _close_spill(self) -> None:
+        """
+        Close the temp file of the current cycle, which removes it.
+        """
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self._spilled = 0
+
+    def _spill_to(self, cut: int) -> None:
+        """
+        Move the current cycle up to cut from memory to its temp file.
+
+        Args:
+            cut: Offset up to which the bytes are written out.
+        """
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(
+                prefix="haas_cycle_", dir=self.limits.spill_dir or None
+            )
+            self.spills += 1
+        self._spill.write(self._view[self._start : cut])
+        self._spilled += cut - self._start
+        self._start = cut
+        self._line = max(self._line, cut)
+
+    def _take(self, end: int) -> str:
+        """
+        Decode the current cycle up to end, with its spilled part, and start the
+        next one at end.
+
+        Args:
+            end: Offset where the cycle ends.
+
+        Returns:
+            The text of the cycle.
+        """
+        if self._spill is None:
+            data = str(self._view[self._start : end], "utf-8", "ignore")
+        else:
+            # Decoded in one piece, a character may be split by the spill
+            self._spill.write(self._view[self._start : end])
+            self._spill.seek(0)
+            data = self._spill.read().decode("utf-8", "ignore")
+            self._close_spill()
+        self._start = end
+        self._started = None
+        return data
+
+    def _cut_incomplete(
+        self, end: int, cycles: List[Tuple[str, Optional[str]]]
+    ) -> None:
+        """
+        Cut the current cycle off at end and add it as an incomplete cycle.
+
+        A cycle of blank lines only is dropped.
+
+        Args:
+            end: Offset where the cycle is cut.
+            cycles: The cycles returned by frame(), added to.
+        """
+        data = self._take(end)
+        part_number = self.part_number or "unknown_part"
+        self.part_number = None
+        self._scanned = max(self._scanned, end)
+        self._line = max(self._line, end)
+        if data.strip():
+            cycles.append((data, f"{part_number}{INCOMPLETE_SUFFIX}"))
+
+    @property
+    def capacity(self) -> int:
+        """
+        Size of the receive buffer in bytes.
+        """
+        return len(self._buffer)
+
+    def _reserve(self, size: int) -> None:
+        """
+        Make room for size more bytes after the received ones.
+
+        The current cycle is moved to the front of the buffer if that frees
+        enough room, otherwise the buffer is doubled until it fits.
+
+        Args:
+            size: Bytes about to be received.
+        """
+        if len(self._buffer) - self._end >= size:
+            return
+
+        live = self._end - self._start
+        if len(self._buffer) - live < size:
+            capacity = len(self._buffer)
+            while capacity - live < size:
+                capacity *= 2
+            buffer = bytearray(capacity)
+            buffer[:live] = self._view[self._start : self._end]
+            # A bytearray can't be resized while a memoryview of it exists
+            self._view.release()
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        else:
+            self._view[:live] = self._view[self._start : self._end]
+
+        shift = self._start
+        self._start = 0
+        self._end -= shift
+        self._scanned -= shift
+        self._line -= shift
+        if self._skip_from is not None:
+            self._skip_from -= shift
+
+    def recv_into(self, sock: socket.socket) -> int:
+        """
+        Receive one chunk from a socket straight into the buffer.
+
+        Call frame() afterwards for the cycles it completes.
+
+        Args:
+            sock: Connected socket.
+
+        Returns:
+            Number of bytes received, 0 if the connection was closed.
+
+        Raises:
+            OSError: If the receive fails, socket.timeout on a timeout.
+        """
+        self._reserve(self.chunk_size)
+        received = sock.recv_into(self._view[self._end :], self.chunk_size)
+        self._end += received
+        return received
+
+    def received(self, size: int) -> memoryview:
+        """
+        The last size bytes received, ex. to record them in a capture.
+
+        Args:
+            size: Bytes to return, at most those received since the last frame().
+
+        Returns:
+            A view of the bytes, valid until the next receive.
+        """
+        return self._view[self._end - size : self._end]
+
+    def write(self, data: bytes) -> None:
+        """
+        Copy received bytes into the buffer, for streams that return a bytes object
+        per read (asyncio). Call frame() afterwards for the cycles they complete.
+
+        Args:
+            data: Newly received bytes.
+        """
+        size = len(data)
+        self._reserve(size)
+        self._view[self._end : self._end + size] = data
+        self._end += size
+
+    def feed(self, data: bytes) -> List[Tuple[str, Optional[str]]]:
+        """
+        Add newly received bytes and return every cycle they complete.
+
+        Args:
+            data: Newly received bytes from the machine.
+
+        Returns:
+            The same as frame().
+        """
+        self.write(data)
+        return self.frame()
+
+    def _find_part_number(self, end: int) -> None:
+        """
+        Search the lines completed before end for the part number.
+
+        Args:
+            end: Offset up to which the bytes belong to the current cycle.
+        """
+        if self.part_number is not None:
+            return
+        cut = self._buffer.rfind(b"\n", self._line, end)
+        if cut >= 0:
+            match = PART_NUMBER_BYTES_RE.search(self._buffer, self._line, cut)
+            if match:
+                self.part_number = match.group(1).decode("utf-8", "ignore").strip()
+            self._line = cut + 1
+        self._line = max(self._line, end - MAX_LINE_LENGTH)
+
+    def _search_marker(self, start: int, end: int) -> Optional["re.Match[bytes]"]:
+        """
+        Search the buffer for the end of cycle marker, in any case.
+
+        A case-insensitive regex tests every byte and is several times slower than
+        bytearray.find(). Every spelling of the marker has "f " or "F " at the
+        same place, so those two are found first and the regex only checks them.
+
+        Args:
+            start: Offset to search from.
+            end: Offset to search to.
+
+        Returns:
+            The first match, or None.
+        """
+        buffer = self._buffer
+        offset = END_OF_CYCLE.index("F ")
+        position = start + offset
+        while True:
+            found = buffer.find(b"f ", position, end)
+            # An earlier "F " can only be before the "f ", don't scan past it
+            upper = buffer.find(b"F ", position, found + 1 if found >= 0 else end)
+            if upper >= 0:
+                found = upper
+            if found < 0:
+                return None
+            match = END_OF_CYCLE_RE.match(buffer, found - offset, end)
+            if match:
+                return match
+            position = found + 1
+
+    def _drop_marker_line(self) -> bool:
+        """
+        Drop the rest of the End of Cycle line, up to and including the newline.
+
+        Returns:
+            True once the line is dropped, False while its newline has not arrived.
+        """
+        limit = self._skip_from + MAX_LINE_LENGTH
+        newline = self._buffer.find(b"\n", self._start, min(self._end, limit))
+        if newline >= 0:
+            self._start = newline + 1
+        elif self._end < limit:
+            # The newline has not arrived yet, keep dropping in the next chunk
+            self._start = self._scanned = self._line = self._end
+            return False
+
+        self._scanned = self._line = self._start
+        self._skip_from = None
+        return True
+
+    def frame(self) -> List[Tuple[str, Optional[str]]]:
+        """
+        Return every cycle completed by the bytes received since the last call.
+
+        Returns:
+            List of (data, part_number) tuples, one per "End of Cycle" received, in
+            order. Each cycle ends with its marker. Empty while the current cycle is
+            incomplete. Cycles cut off by the limits are included, their part
+            number ends with INCOMPLETE_SUFFIX.
+        """
+        cycles: List[Tuple[str, Optional[str]]] = []
+        limits = self.limits
+        now = time.monotonic()
+
+        # A cycle that stopped coming, an aborted program for example, is cut off
+        # before the new bytes instead of being glued to the next cycle
+        if (
+            limits.max_age > 0
+            and self._started is not None
+            and self._skip_from is None
+            and now - self._started > limits.max_age
+        ):
+            self._cut_incomplete(self._scanned, cycles)
+
+        while True:
+            if self._skip_from is not None and not self._drop_marker_line():
+                break
+
+            scan_from = max(self._start, self._scanned - self._overlap_length)
+            match = self._search_marker(scan_from, self._end)
+            if match is None:
+                self._find_part_number(self._end)
+                self._scanned = self._end
+                break
+
+            end = match.end()
+            self._find_part_number(end)
+            # The last line may hold the part number if no newline followed it
+            if self.part_number is None:
+                part_match = PART_NUMBER_BYTES_RE.search(self._buffer, self._line, end)
+                if part_match:
+                    self.part_number = (
+                        part_match.group(1).decode("utf-8", "ignore").strip()
+                    )
+
+            cycles.append((self._take(end), self.part_number))
+            self._scanned = self._line = end
+            self.part_number = None
+            self._skip_from = end
+
+        if limits.max_bytes > 0 and self.cycle_size > limits.max_bytes:
+            # Cut at the start of the last line, so the next cycle starts on a line
+            line = self._buffer.rfind(b"\n", self._start, self._end) + 1
+            self._cut_incomplete(line if line > self._start else self._end, cycles)
+        elif limits.memory_bytes > 0 and self._end - self._start > limits.memory_bytes:
+            # The incomplete last line and the marker overlap stay searchable
+            line = self._buffer.rfind(b"\n", self._start, self._end) + 1
+            cut = min(line or self._end, self._end - self._overlap_length)
+            if cut > self._start:
+                self._spill_to(cut)
+
+        if self._started is None and self.cycle_size > 0:
+            self._started = now
+        return cycles
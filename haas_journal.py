@@ -0,0 +1,435 @@
+import csv
+import json
+import os
+import re
+import threading
+from collections import Counter
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set, Tuple
+
+from haas_storage import new_cycle_id, read_csv_rows, row_key
+
+if TYPE_CHECKING:
+    from haas_logger2 import HaasDataLogger
+
+# A parsed cycle: (part_number, parsed_data)
+Record = Tuple[Optional[str], Dict[str, str]]
+
+# <machine>_<part>_<YYYYmmdd_HHMMSS>_BACKUP.csv, written when the main file is locked
+BACKUP_RE = re.compile(r"^(?P<base>.+)_\d{8}_\d{6}_BACKUP\.csv$")
+
+
+class CycleJournal:
+    """
+    Append-only write-ahead journal of parsed cycles.
+
+    Every cycle is written to the journal (one JSON line, with its cycle id and,
+    when there is an archive, its raw text) before it is queued for the CSV writer,
+    and acknowledged once the CSV write succeeded. The journal is flushed
+    on every append and fsync'ed by a background thread at most every sync_interval
+    seconds, so a burst of cycles costs one fsync. If the process is killed in
+    between, recover() replays the cycles that were never acknowledged.
+
+    When the file is larger than max_bytes, it is rewritten with only the entries
+    that still have to be recovered: those waiting to be written, and those whose
+    write failed (kept for the next start). The file then stays small however
+    many cycles are in flight.
+    """
+
+    def __init__(
+        self, path: str, sync_interval: float = 0.2, max_bytes: int = 4 * 1024 * 1024
+    ) -> None:
+        """
+        Open (or create) the journal file.
+
+        Args:
+            path: Journal file.
+            sync_interval: Seconds between fsyncs while there are unsynced entries.
+            max_bytes: Size above which the acknowledged entries are dropped.
+        """
+        self.path = path
+        self.sync_interval = sync_interval
+        self.max_bytes = max_bytes
+        self.pending: Set[int] = set()
+        self.failed: Set[int] = set()
+        self.next_id = 1
+        self._compact_at = max_bytes
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._closed = threading.Event()
+        self._file = open(path, "a", encoding="utf-8")
+        self._syncer = threading.Thread(
+            target=self._sync_loop, name="journal-sync", daemon=True
+        )
+        self._syncer.start()
+
+    def _write(self, lines: List[str]) -> None:
+        """
+        Append lines and flush them to the OS. The lock must be held.
+        """
+        self._file.write("".join(lines))
+        self._file.flush()
+        self._dirty = True
+
+    def _sync_loop(self) -> None:
+        while not self._closed.wait(self.sync_interval):
+            self.sync()
+
+    def sync(self) -> None:
+        """
+        fsync the journal if anything was written since the last sync.
+        """
+        with self._lock:
+            if self._dirty and not self._file.closed:
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    def append(
+        self,
+        logger: "HaasDataLogger",
+        records: List[Record],
+        cycle_ids: Optional[List[str]] = None,
+        raw: Optional[List[Optional[str]]] = None,
+    ) -> List[int]:
+        """
+        Journal parsed cycles before they are written.
+
+        Args:
+            logger: The logger the cycles belong to.
+            records: List of (part_number, parsed_data) tuples.
+            cycle_ids: The id of each record, written again on recovery. If None,
+            recovered cycles get new ids.
+            raw: The raw text of each record. It is journaled when the logger has
+            an archive, so a recovered cycle is archived too.
+
+        Returns:
+            The journal ids of the cycles, to pass to ack() once they are written.
+        """
+        if cycle_ids is None:
+            cycle_ids = [new_cycle_id() for _ in records]
+        if raw is None or logger.archive is None:
+            raw = [None] * len(records)
+        with self._lock:
+            ids = list(range(self.next_id, self.next_id + len(records)))
+            self.next_id += len(records)
+            self._write(
+                [
+                    json.dumps(
+                        {
+                            "id": entry_id,
+                            "cycle": cycle_id,
+                            "machine": logger.machine_name,
+                            "append": logger.append_mode,
+                            "part": part_number,
+                            "record": parsed_data,
+                            "raw": data,
+                        }
+                    )
+                    + "\n"
+                    for entry_id, cycle_id, (part_number, parsed_data), data in zip(
+                        ids, cycle_ids, records, raw
+                    )
+                ]
+            )
+            self.pending.update(ids)
+        return ids
+
+    def ack(self, ids: List[int]) -> None:
+        """
+        Mark cycles as written to their CSV file.
+
+        Args:
+            ids: Journal ids returned by append().
+        """
+        with self._lock:
+            self.pending.difference_update(ids)
+            if self._file.tell() > self._compact_at:
+                self._compact(self.pending | self.failed)
+            else:
+                self._write([json.dumps({"ack": ids}) + "\n"])
+
+    def fail(self, ids: List[int]) -> None:
+        """
+        Mark cycles whose write failed. They stay in the journal and are written
+        by recover() at the next start.
+
+        Args:
+            ids: Journal ids returned by append().
+        """
+        with self._lock:
+            self.pending.difference_update(ids)
+            self.failed.update(ids)
+
+    def _compact(self, keep: Set[int]) -> None:
+        """
+        Rewrite the journal with only the entries of these ids. The lock must be
+        held.
+
+        The entries are written to a temp file that replaces the journal, so a
+        crash in between leaves either journal complete.
+
+        Args:
+            keep: Journal ids of the entries to keep.
+        """
+        self._file.flush()
+        lines = []
+        if keep:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get("id") in keep:
+                        lines.append(line)
+
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(temp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._dirty = False
+        # Entries that stay in flight don't make every later ack rewrite the file
+        self._compact_at = max(self.max_bytes, 2 * self._file.tell())
+
+    def forget(self, ids: List[int]) -> None:
+        """
+        Cancel cycles that were journaled but could not be queued.
+
+        The caller submits them again, which journals them under new ids. The old
+        entries are acknowledged without being written, so recover() never
+        replays them next to their new copy.
+
+        Args:
+            ids: Journal ids returned by append().
+        """
+        with self._lock:
+            self.pending.difference_update(ids)
+            self._write([json.dumps({"ack": ids}) + "\n"])
+
+    def unacknowledged(self) -> List[Dict]:
+        """
+        Read the journal and return the entries that were never acknowledged.
+
+        A partly written last line (the process was killed mid-write) is ignored.
+
+        Returns:
+            Journal entries in the order they were written.
+        """
+        entries: Dict[int, Dict] = {}
+        with self._lock:
+            self._file.flush()
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "ack" in entry:
+                        for entry_id in entry["ack"]:
+                            entries.pop(entry_id, None)
+                    elif "id" in entry:
+                        entries[entry["id"]] = entry
+                        self.next_id = max(self.next_id, entry["id"] + 1)
+        return list(entries.values())
+
+    def recover(self, loggers: Dict[str, "HaasDataLogger"]) -> int:
+        """
+        Write the cycles that were journaled but never acknowledged, then reset.
+
+        Rows that already made it into their CSV file (the process died after the
+        write but before the acknowledgement) are skipped, so nothing is counted
+        twice; the database backend ignores the stored cycle ids itself. Cycles of
+        machines that are not in loggers are written with a logger built from the
+        journaled machine name and file mode, saving to the same place as the
+        others. The raw text of the cycles is archived as the writer would have.
+
+        Args:
+            loggers: Loggers by machine name.
+
+        Returns:
+            Number of cycles written.
+        """
+        # Imported here to avoid a circular import, haas_logger2 uses this module
+        from haas_logger2 import HaasDataLogger
+
+        grouped: Dict[Tuple[str, bool], List[Dict]] = {}
+        for entry in self.unacknowledged():
+            grouped.setdefault((entry["machine"], entry["append"]), []).append(entry)
+
+        template = next(iter(loggers.values()), None)
+        written = 0
+        failed: List[Dict] = []
+        for (machine, append), entries in grouped.items():
+            logger = loggers.get(machine)
+            if logger is None or logger.append_mode != append:
+                logger = HaasDataLogger(
+                    machine_name=machine,
+                    append_mode=append,
+                    output_dir=template.output_dir if template else "cnc_logs",
+                    store=template.store if template else None,
+                    layout=template.layout if template else None,
+                    archive=template.archive if template else None,
+                )
+
+            if logger.store is None:
+                entries = unwritten(logger, entries)
+            if not entries:
+                continue
+            records = [(entry["part"], entry["record"]) for entry in entries]
+            raw = [entry.get("raw") for entry in entries]
+            # Entries journaled without an id get a new one
+            cycle_ids = [entry.get("cycle") or new_cycle_id() for entry in entries]
+            cache = logger.handle_cache if logger.append_mode else None
+            lost_rows = cache.lost_rows if cache is not None else 0
+            try:
+                logger.write_records(records, raw, cycle_ids)
+                if cache is not None:
+                    # The journal is reset below, so the rows must be in the file
+                    cache.flush_all(force=True)
+                    if cache.lost_rows != lost_rows:
+                        raise IOError("rows may not have reached their file")
+                written += len(records)
+                print(f"[{machine}] Recovered {len(records)} cycle(s) from the journal")
+            except Exception as e:
+                print(f"[{machine}] ERROR: Could not recover cycles: {e}")
+                failed.extend(entries)
+
+        # Start over, keeping only the cycles that still could not be written
+        with self._lock:
+            self.pending = set()
+            self.failed = {entry["id"] for entry in failed}
+            self._compact(self.failed)
+        return written
+
+    def close(self) -> None:
+        """
+        fsync and close the journal.
+        """
+        self._closed.set()
+        self.sync()
+        with self._lock:
+            self._file.close()
+
+
+def unwritten(logger: "HaasDataLogger", entries: List[Dict]) -> List[Dict]:
+    """
+    Drop the journal entries whose cycle is already in the CSV file it would be
+    written to.
+
+    Rows are counted, not just looked up: two cycles with identical values in the
+    same second are two cycles, so a row in the file only accounts for one entry.
+    If the file holds one such row and the journal two, one entry is written.
+
+    Args:
+        logger: Logger that decides the target file of each cycle.
+        entries: Journal entries from unacknowledged().
+
+    Returns:
+        The entries whose cycle is not in its target file yet.
+    """
+    # Rows of each file and column set that no entry has been matched to yet
+    existing: Dict[Tuple[str, Tuple[str, ...]], Counter] = {}
+    result = []
+    for entry in entries:
+        part_number, parsed_data = entry["part"], entry["record"]
+        timestamp = (
+            parsed_data["Timestamp"].replace("-", "").replace(":", "").replace(" ", "_")
+        )
+        _, filepath, _ = logger.columns_target(
+            part_number, timestamp, list(parsed_data)
+        )
+        fieldnames = tuple(parsed_data)
+        if (filepath, fieldnames) not in existing:
+            _, rows = read_csv_rows(filepath)
+            existing[filepath, fieldnames] = Counter(
+                row_key(row, fieldnames) for row in rows
+            )
+        unmatched = existing[filepath, fieldnames]
+        key = row_key(parsed_data, fieldnames)
+        if unmatched[key] > 0:
+            unmatched[key] -= 1
+        else:
+            result.append(entry)
+    return result
+
+
+def merge_backups(
+    directory: str = "cnc_logs", owns: Optional[Callable[[str], bool]] = None
+) -> int:
+    """
+    Fold *_BACKUP.csv rows back into their main per-part file, in directory and
+    every subdirectory of the layout.
+
+    A backup is written when the main file was locked (usually open in Excel). Once
+    the main file can be opened again, the backup rows are appended and the backup
+    file is deleted. A backup whose rows the main file already holds, counting
+    identical rows, was merged by a run interrupted before deleting it and is
+    only deleted; identical rows are kept otherwise, cycles received in the same
+    second can be equal. Backups whose main file is still locked, or has different
+    columns, are left for a later run.
+
+    This appends to the same files as HaasDataLogger.write_records, so it runs on
+    the writer thread (CycleWriter.add_task) rather than on its own.
+
+    Args:
+        directory: Directory holding the CSV files.
+        owns: Only merge the backups whose file name this accepts, ex. those of the
+        machines of one fleet worker process. If None, every backup is merged.
+
+    Returns:
+        Number of rows merged.
+    """
+    if not os.path.isdir(directory):
+        return 0
+
+    merged = 0
+    backups = []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            match = BACKUP_RE.match(filename)
+            if match and (owns is None or owns(filename)):
+                backups.append((dirpath, filename, match))
+
+    for dirpath, filename, match in backups:
+        backup_path = os.path.join(dirpath, filename)
+        main_path = os.path.join(dirpath, f"{match.group('base')}.csv")
+        try:
+            fieldnames, rows = read_csv_rows(backup_path)
+            main_fieldnames, main_rows = read_csv_rows(main_path)
+            if main_fieldnames and main_fieldnames != fieldnames:
+                print(
+                    f"[merge] {filename}: columns differ from {main_path}, merge it by hand"
+                )
+                continue
+
+            existing = Counter(row_key(row, fieldnames) for row in main_rows)
+            counts = Counter(row_key(row, fieldnames) for row in rows)
+            if all(existing[key] >= n for key, n in counts.items()):
+                # Merged by an earlier run that was interrupted before deleting it
+                missing = []
+            else:
+                missing = rows
+
+            if missing:
+                with open(main_path, "a", newline="") as f:
+                    writer = csv.DictWriter(f, fieldnames=fieldnames)
+                    if f.tell() == 0:
+                        writer.writeheader()
+                    writer.writerows(missing)
+
+            os.remove(backup_path)
+            merged += len(missing)
+            print(f"[merge] {len(missing)} row(s) from {filename} merged into {main_path}")
+        except (IOError, PermissionError):
+            # Main file still locked, try again on the next run
+            continue
+
+    return merged
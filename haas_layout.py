@@ -0,0 +1,231 @@
+"""
+Directory layout of the CSV files.
+
+# Move the files in cnc_logs into cnc_logs/<machine>/<yyyy>/<mm>/
+python haas_layout.py --layout "{machine}/{yyyy}/{mm}"
+
+# Move them back into one flat directory
+python haas_layout.py --layout ""
+"""
+
+import argparse
+import csv
+import os
+import re
+import string
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+# Placeholders a layout can use
+LAYOUT_FIELDS = ("machine", "part", "yyyy", "mm", "dd")
+
+# Suffixes after <machine>_<part> in the filenames the logger writes:
+# _<YYYYmmdd>_<HHMMSS> (NEW FILE mode), _<YYYYmmdd> (compacted),
+# _<YYYYmmdd>_<HHMMSS>_BACKUP (locked file backup), nothing (append mode)
+FILENAME_SUFFIX_RE = re.compile(r"_(?P<day>\d{8})(?:_\d{6})?(?:_BACKUP)?$")
+
+
+class PathLayout:
+    """
+    Subdirectory of the output directory a cycle is saved in.
+
+    The layout is a template such as "{machine}/{yyyy}/{mm}" with the placeholders
+    {machine}, {part}, {yyyy}, {mm} and {dd}. The date is the day the cycle was
+    received. The filenames stay the same, only the directory changes, so a
+    directory never holds more than one machine's (or month's) files. An empty
+    template keeps every file directly in the output directory.
+
+    In append mode a date placeholder starts a new file for each period, for example
+    one file per part and month with "{machine}/{yyyy}/{mm}".
+    """
+
+    def __init__(self, template: str = "") -> None:
+        """
+        Check and store the template.
+
+        Args:
+            template: Layout template, "" for a flat directory.
+
+        Raises:
+            ValueError: If the template uses an unknown placeholder or leaves the
+            output directory.
+        """
+        self.template = template.strip("/")
+        for _, field, _, _ in string.Formatter().parse(self.template):
+            if field is not None and field not in LAYOUT_FIELDS:
+                raise ValueError(
+                    f"Unknown layout field {{{field}}}, use {', '.join('{' + f + '}' for f in LAYOUT_FIELDS)}"
+                )
+        if os.path.isabs(self.template) or ".." in self.template.split("/"):
+            raise ValueError(f"Layout {template} must stay inside the output directory")
+
+    def directory(self, machine: str, part: str, timestamp: str) -> str:
+        """
+        Relative directory of a file.
+
+        Args:
+            machine: Machine name.
+            part: Part number as used in the filename.
+            timestamp: Receive time as YYYYmmdd_HHMMSS (or at least YYYYmmdd).
+
+        Returns:
+            The directory relative to the output directory, "" for a flat layout.
+        """
+        if not self.template:
+            return ""
+        return self.template.format(
+            machine=machine,
+            part=part,
+            yyyy=timestamp[:4],
+            mm=timestamp[4:6],
+            dd=timestamp[6:8],
+        )
+
+
+def describe_file(path: str) -> Optional[Tuple[str, str, str]]:
+    """
+    Find the machine, part and day of a CSV file written by the logger.
+
+    The machine comes from the first row (machine names and part numbers can both
+    contain underscores, so the filename alone is ambiguous). The day comes from
+    the filename, or from the first row for append mode files.
+
+    Args:
+        path: CSV file.
+
+    Returns:
+        Tuple of (machine, part, YYYYmmdd), or None if the file was not written by
+        the logger.
+    """
+    with open(path, newline="") as f:
+        first_row = next(csv.DictReader(f), None)
+    if not first_row or not first_row.get("Machine"):
+        return None
+
+    machine = first_row["Machine"]
+    stem = os.path.basename(path)[: -len(".csv")]
+    if not stem.startswith(f"{machine}_"):
+        return None
+
+    match = FILENAME_SUFFIX_RE.search(stem)
+    if match and match.start() > len(machine):
+        part = stem[len(machine) + 1 : match.start()]
+        day = match.group("day")
+    else:
+        part = stem[len(machine) + 1 :]
+        try:
+            day = datetime.strptime(
+                first_row.get("Timestamp", ""), "%Y-%m-%d %H:%M:%S"
+            ).strftime("%Y%m%d")
+        except ValueError:
+            day = datetime.fromtimestamp(os.path.getmtime(path)).strftime("%Y%m%d")
+    return machine, part, day
+
+
+def plan_migration(directory: str, layout: PathLayout) -> List[Tuple[str, str]]:
+    """
+    Work out where every CSV file under directory belongs in a layout.
+
+    Args:
+        directory: Output directory.
+        layout: Layout to move the files into.
+
+    Returns:
+        (current path, new path) pairs of the files that have to move.
+    """
+    moves = []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            if not filename.endswith(".csv") or filename.startswith("."):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                described = describe_file(path)
+            except (OSError, UnicodeDecodeError, csv.Error):
+                described = None
+            if described is None:
+                print(f"[layout] Skipped {path}: not written by the logger")
+                continue
+            machine, part, day = described
+            target = os.path.join(
+                directory, layout.directory(machine, part, day), filename
+            )
+            if os.path.normpath(target) != os.path.normpath(path):
+                moves.append((path, target))
+    return moves
+
+
+def migrate(directory: str, layout: PathLayout, dry_run: bool = False) -> int:
+    """
+    Move the files under directory into a layout in one pass.
+
+    Works from any layout to any other, including back to a flat directory. A
+    file whose new path is already taken is left where it is and reported. Stop
+    the logger first, an append mode file it has open would be written to its old
+    path until the next cycle.
+
+    Args:
+        directory: Output directory.
+        layout: Layout to move the files into.
+        dry_run: Only show what would be moved.
+
+    Returns:
+        Number of files moved.
+    """
+    moved = 0
+    for path, target in plan_migration(directory, layout):
+        if os.path.exists(target):
+            print(f"[layout] Skipped {path}: {target} already exists")
+            continue
+        if dry_run:
+            print(f"[layout] {path} -> {target}")
+            moved += 1
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+        moved += 1
+
+    if not dry_run:
+        # Remove the directories the old layout leaves empty
+        for dirpath, _, _ in sorted(os.walk(directory), reverse=True):
+            if dirpath != directory and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Haas CNC Data Logger - Move existing CSV files into a directory layout",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python haas_layout.py --layout "{machine}/{yyyy}/{mm}"          # cnc_logs/Mill_1/2025/12/...
+    python haas_layout.py --layout "{machine}/{part}" -n            # Show what would move
+    python haas_layout.py --layout ""                               # Back to one flat directory
+
+Notes:
+    - Placeholders: {machine}, {part}, {yyyy}, {mm}, {dd}
+    - Use the same --layout when starting haas_logger2.py or haas_fleet.py
+    - Stop the logger before moving files
+        """,
+    )
+    parser.add_argument(
+        "-l", "--layout", required=True, help='Directory layout, ex. "{machine}/{yyyy}/{mm}"'
+    )
+    parser.add_argument(
+        "-d",
+        "--dir",
+        default="cnc_logs",
+        help="Directory with the CSV files (default: cnc_logs)",
+    )
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true", help="Only show what would be moved"
+    )
+    args = parser.parse_args()
+
+    try:
+        target_layout = PathLayout(args.layout)
+    except ValueError as e:
+        parser.error(str(e))
+    count = migrate(args.dir, target_layout, args.dry_run)
+    print(f"[layout] {count} file(s) {'to move' if args.dry_run else 'moved'}")
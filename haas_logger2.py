@@ -1,12 +1,40 @@
 import argparse
+import asyncio
 import csv
 import os
-import re
+import queue
 import socket
 import threading
 import time
+from concurrent.futures import Executor
 from datetime import datetime
-from typing import Dict, Optional, Tuple
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from haas_compact import compact_directory
+from haas_archive import CycleArchive
+from haas_capture import CaptureRecorder
+from haas_framing import PART_NUMBER_RE, CycleFramer, CycleLimits, is_incomplete
+from haas_journal import CycleJournal, merge_backups
+from haas_layout import PathLayout
+from haas_metrics import MachineMetrics, MetricsServer
+from haas_net import (
+    ConnectionSettings,
+    ServerSettings,
+    backoff_delay,
+    enable_keepalive,
+)
+from haas_parser import SchemaRegistry
+from haas_profile import StageProfiler
+from haas_server import MachineServer, parse_port_map
+from haas_sqlite import SqliteStore
+from haas_storage import (
+    CsvHandleCache,
+    SnapshotPublisher,
+    new_cycle_id,
+    read_csv_header,
+)
+from haas_writer import CycleWriter
 
 
 class HaasDataLogger:
@@ -25,6 +53,18 @@ class HaasDataLogger:
         machine_name: Optional[str] = None,
         append_mode: bool = False,
         target_ip: Optional[str] = None,
+        schemas: Optional[SchemaRegistry] = None,
+        handle_cache: Optional[CsvHandleCache] = None,
+        writer: Optional[CycleWriter] = None,
+        output_dir: str = "cnc_logs",
+        store: Optional[SqliteStore] = None,
+        layout: Optional[PathLayout] = None,
+        archive: Optional[CycleArchive] = None,
+        recorder: Optional[CaptureRecorder] = None,
+        profiler: Optional[StageProfiler] = None,
+        connection: Optional[ConnectionSettings] = None,
+        server: Optional[ServerSettings] = None,
+        limits: Optional[CycleLimits] = None,
     ) -> None:
         """
         Initialize the Haas Data Logger.
@@ -37,6 +77,29 @@ class HaasDataLogger:
                         If False, create new file for each cycle.
             target_ip: If provided, connect to this IP address (client mode) instead of
             listening for connections (server mode).
+            schemas: Per-program DPRNT schemas. If None, only the built-in fields
+            are parsed.
+            handle_cache: Keeps append-mode files open across cycles. If None, each
+            cycle opens and closes its file.
+            writer: Writer thread that saves parsed cycles, so file locks never
+            block the socket. If None, cycles are saved in the receive loop.
+            output_dir: Directory the CSV files are written to.
+            store: SQLite database the cycles are saved to instead of CSV files.
+            If None, cycles are saved to CSV files.
+            layout: Subdirectories of output_dir the files are sorted into. If None,
+            every file is saved directly in output_dir.
+            archive: Archive the raw text of every cycle is kept in, so it can be
+            parsed again later. If None, the raw text is discarded after parsing.
+            recorder: Records the raw stream of every connection for replay with
+            haas_simulator.py. If None, nothing is recorded.
+            profiler: Times the receive, parse and write stages (--profile). If
+            None, nothing is timed beyond the metrics.
+            connection: Timeouts, keepalive and reconnect backoff. If None, the
+            ConnectionSettings defaults are used.
+            server: Server mode backlog and connection limits. If None, the
+            ServerSettings defaults are used.
+            limits: Memory, size and age limits of a cycle being received. If
+            None, the CycleLimits defaults are used.
         """
         self.host = host
         self.port = port
@@ -44,6 +107,23 @@ class HaasDataLogger:
         self.running = False
         self.append_mode = append_mode
         self.target_ip = target_ip
+        self.schemas = schemas or SchemaRegistry()
+        self.handle_cache = handle_cache
+        self.writer = writer
+        self.output_dir = output_dir
+        self.store = store
+        self.layout = layout
+        self.archive = archive
+        self.recorder = recorder
+        # Runs the saves of process_stream without a writer thread, set by the
+        # event loop that runs it (haas_server.save_executors). None uses the
+        # loop's default executor.
+        self.save_executor: Optional[Executor] = None
+        self.metrics = MachineMetrics()
+        self.profiler = profiler
+        self.connection = connection or ConnectionSettings()
+        self.server = server or ServerSettings()
+        self.limits = limits or CycleLimits()
 
     def extract_part_number(self, data: str) -> Optional[str]:
         """
@@ -58,173 +138,436 @@ class HaasDataLogger:
             The extracted part number string if found, None otherwise.
         """
         # Look for pattern like "PART NUMBER: 265-4183"
-        match = re.search(r"PART NUMBER:\s*([^\s,]+)", data, re.IGNORECASE)
+        match = PART_NUMBER_RE.search(data)
         if match:
             return match.group(1).strip()
         return None
 
-    def parse_data_to_dict(self, data: str) -> Dict[str, str]:
+    def parse_data_to_dict(
+        self, data: str, timestamp: Optional[str] = None
+    ) -> Dict[str, str]:
         """
         Parse the CNC data into a dictionary for CSV output.
 
         Extracts structured information including part number, revision, date, time,
-        parts counter, and last part timer from the raw CNC machine data string.
+        parts counter, and last part timer from the raw CNC machine data string. The
+        fields are extracted by the compiled DprntParser of the cycle's program, which
+        adds the fields of its schema if one is registered.
 
         Args:
             data: Raw data string received from the CNC machine.
+            timestamp: Receive time as YYYY-mm-dd HH:MM:SS, for cycles parsed again
+            from the archive. Defaults to now.
 
         Returns:
             Dictionary containing parsed fields including Machine, Timestamp, Part_Number,
-            Revision, Date_YYMMDD, Time_HHMMSS, Parts_Counter, and Last_Part_Time_Seconds.
+            Revision, Date_YYMMDD, Time_HHMMSS, Parts_Counter, Last_Part_Time_Seconds,
+            and any schema fields.
         """
         result = {
             "Machine": self.machine_name,
-            "Timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "Part_Number": "",
-            "Revision": "",
-            "Date_YYMMDD": "",
-            "Time_HHMMSS": "",
-            "Parts_Counter": "",
-            "Last_Part_Time_Seconds": "",
+            "Timestamp": timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         }
+        result.update(self.schemas.parse(data))
+        return result
 
-        # Extract part number and revision
-        part_match = re.search(
-            r"PART NUMBER:\s*([^\s,]+)(?:,\s*REV\.\s*([^\]]+))?", data, re.IGNORECASE
-        )
-        if part_match:
-            result["Part_Number"] = part_match.group(1).strip()
-            if part_match.group(2):
-                result["Revision"] = part_match.group(2).strip()
-
-        # Extract date
-        date_match = re.search(r"DATE YYMMDD:\s*(\d+)", data, re.IGNORECASE)
-        if date_match:
-            result["Date_YYMMDD"] = date_match.group(1).strip()
-
-        # Extract time
-        time_match = re.search(r"TIME HHMMSS:\s*(\d+)", data, re.IGNORECASE)
-        if time_match:
-            result["Time_HHMMSS"] = time_match.group(1).strip()
-
-        # Extract parts counter (PARTS MADE: ###)
-        parts_match = re.search(r"PARTS\s*MADE:\s*(\d+)", data, re.IGNORECASE)
-        if parts_match:
-            result["Parts_Counter"] = parts_match.group(1).strip()
-
-        # Extract last part timer (TIME, LAST PART: ### SECONDS)
-        timer_match = re.search(
-            r"TIME,\s*LAST\s*PART:\s*(\d+(?:\.\d+)?)\s*SECONDS", data, re.IGNORECASE
-        )
-        if timer_match:
-            result["Last_Part_Time_Seconds"] = timer_match.group(1).strip()
+    def cycle_filepath(self, part_number: Optional[str], timestamp: str) -> str:
+        """
+        Build the CSV path a cycle is saved to.
 
-        return result
+        Args:
+            part_number: Part number of the cycle, or None if not found.
+            timestamp: Receive time as YYYYmmdd_HHMMSS, used in non-append mode.
 
-    def save_to_file(self, data: str, part_number: Optional[str]) -> str:
+        Returns:
+            Path of the CSV file in the output directory.
         """
-        Save data to CSV file with part number and timestamp.
+        part = part_number or "unknown_part"
+        if self.append_mode:
+            # Append mode: Use same file for each part number
+            filename = f"{self.machine_name}_{part}.csv"
+        else:
+            # Normal mode: Create new file for each cycle with timestamp
+            filename = f"{self.machine_name}_{part}_{timestamp}.csv"
+        if self.layout is not None:
+            return os.path.join(
+                self.output_dir,
+                self.layout.directory(self.machine_name, part, timestamp),
+                filename,
+            )
+        return os.path.join(self.output_dir, filename)
 
-        Creates a CSV file in the cnc_logs directory with parsed machine data.
-        In append mode, cycles for the same part number are added to one file.
-        In non-append mode, each cycle creates a new timestamped file.
-        Includes retry logic and backup file creation if the target file is locked.
+    def columns_target(
+        self,
+        part_number: Optional[str],
+        timestamp: str,
+        fieldnames: List[str],
+    ) -> Tuple[Optional[str], str, List[str]]:
+        """
+        Find the file rows with these fields are appended to.
+
+        A file keeps the columns it was started with. Rows of another schema (a
+        field was added to dprnt_schemas.json) whose fields are not all in its
+        header go to a file of their own, with _COLUMNS2, _COLUMNS3... after the
+        part number, ex. st30l_265-4183_COLUMNS2.csv.
 
         Args:
-            data: Raw data string to be saved.
-            part_number: Part number extracted from the data, or None if not found.
+            part_number: Part number of the rows, or None if not found.
+            timestamp: Receive time as YYYYmmdd_HHMMSS, used in non-append mode.
+            fieldnames: Every field of the rows.
 
         Returns:
-            Full filepath where the data was saved.
-
-        Raises:
-            IOError: If the file cannot be written in non-append mode.
+            Tuple of (part_number, filepath, columns): the part number to save the
+            rows under, its file, and the columns to write them in.
+        """
+        part = part_number
+        variant = 1
+        while True:
+            filepath = self.cycle_filepath(part, timestamp)
+            try:
+                if self.handle_cache is not None and self.append_mode:
+                    header = self.handle_cache.header(
+                        (self.machine_name, part), filepath
+                    )
+                else:
+                    header = read_csv_header(filepath)
+            except OSError:
+                # Locked, append_rows retries and falls back to a backup file
+                header = []
+            if not header:
+                return part, filepath, fieldnames
+            if set(fieldnames) <= set(header):
+                return part, filepath, header
+            variant += 1
+            part = f"{part_number or 'unknown_part'}_COLUMNS{variant}"
+
+    def append_rows(
+        self,
+        filepath: str,
+        rows: List[Dict[str, str]],
+        part_number: Optional[str],
+        fieldnames: Optional[List[str]] = None,
+    ) -> str:
         """
-        # Create logs directory if it doesn't exist
-        os.makedirs("cnc_logs", exist_ok=True)
+        Append parsed cycles to a CSV file, writing the header if the file is new.
 
-        # Parse data into structured format
-        parsed_data = self.parse_data_to_dict(data)
+        In append mode a locked file is retried 3 times, then the rows are saved to
+        a timestamped backup file instead.
 
-        if self.append_mode:
-            # Append mode: Use same file for each part number
-            if part_number:
-                filename = f"{self.machine_name}_{part_number}.csv"
-            else:
-                filename = f"{self.machine_name}_unknown_part.csv"
+        Args:
+            filepath: Target CSV file.
+            rows: Parsed cycles. Fields a row does not have are left empty.
+            part_number: Part number of the cycles, used for the backup filename.
+            fieldnames: Columns of the file, see columns_target(). If None, every
+            field of the rows in the order they appear.
 
-            filepath = os.path.join("cnc_logs", filename)
+        Returns:
+            Full filepath where the rows were saved.
 
-            # Check if file exists to determine if we need to write header
-            file_exists = os.path.isfile(filepath)
+        Raises:
+            IOError: If the file cannot be written in non-append mode.
+        """
+        if fieldnames is None:
+            fieldnames = list(dict.fromkeys(name for row in rows for name in row))
+        count = f"{len(rows)} cycles" if len(rows) > 1 else "Data"
 
-            # Try to append to CSV with retry logic
-            max_retries = 3
-            retry_delay = 1  # seconds
+        if not self.append_mode:
+            try:
+                file_exists = os.path.isfile(filepath)
+                with open(filepath, "a", newline="") as f:
+                    writer = csv.DictWriter(f, fieldnames=fieldnames, restval="")
+                    if not file_exists:
+                        writer.writeheader()
+                    writer.writerows(rows)
+
+                print(f"[{self.machine_name}] {count} saved to: {filepath}")
+            except (IOError, PermissionError) as e:
+                print(
+                    f"[{self.machine_name}] ERROR: Could not write to {filepath}: {e}"
+                )
+                raise
+            return filepath
 
-            for attempt in range(max_retries):
-                try:
+        # Try to append to CSV with retry logic
+        max_retries = 3
+        retry_delay = 1  # seconds
+
+        for attempt in range(max_retries):
+            try:
+                if self.handle_cache is not None:
+                    # Reuses the open file, reopens it if the last write failed
+                    self.handle_cache.write_rows(
+                        (self.machine_name, part_number), filepath, rows
+                    )
+                else:
+                    # Check if file exists to determine if we need to write header
+                    file_exists = os.path.isfile(filepath)
                     with open(filepath, "a", newline="") as f:
-                        writer = csv.DictWriter(f, fieldnames=parsed_data.keys())
+                        writer = csv.DictWriter(f, fieldnames=fieldnames, restval="")
                         if not file_exists:
                             writer.writeheader()
-                        writer.writerow(parsed_data)
+                        writer.writerows(rows)
 
-                    print(f"[{self.machine_name}] Data appended to: {filepath}")
-                    break  # Success, exit retry loop
+                print(f"[{self.machine_name}] {count} appended to: {filepath}")
+                break  # Success, exit retry loop
 
-                except (IOError, PermissionError) as e:
-                    if attempt < max_retries - 1:
-                        print(
-                            f"[{self.machine_name}] Warning: File locked or inaccessible, retrying in {retry_delay}s... (Attempt {attempt + 1}/{max_retries})"
-                        )
-                        time.sleep(retry_delay)
-                    else:
-                        # Final attempt failed, create backup file with timestamp
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        backup_filename = (
-                            f"{self.machine_name}_{part_number}_{timestamp}_BACKUP.csv"
-                        )
-                        backup_filepath = os.path.join("cnc_logs", backup_filename)
-
-                        with open(backup_filepath, "w", newline="") as f:
-                            writer = csv.DictWriter(f, fieldnames=parsed_data.keys())
+            except (IOError, PermissionError) as e:
+                if attempt < max_retries - 1:
+                    print(
+                        f"[{self.machine_name}] Warning: File locked or inaccessible, retrying in {retry_delay}s... (Attempt {attempt + 1}/{max_retries})"
+                    )
+                    time.sleep(retry_delay)
+                else:
+                    # Final attempt failed, create backup file with timestamp
+                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    # Named like the main file, so merge_backups finds it again
+                    part = part_number or "unknown_part"
+                    backup_filename = (
+                        f"{self.machine_name}_{part}_{timestamp}_BACKUP.csv"
+                    )
+                    backup_filepath = os.path.join(
+                        os.path.dirname(filepath), backup_filename
+                    )
+
+                    with open(backup_filepath, "a", newline="") as f:
+                        writer = csv.DictWriter(f, fieldnames=fieldnames, restval="")
+                        if f.tell() == 0:
                             writer.writeheader()
-                            writer.writerow(parsed_data)
-
-                        print(
-                            f"[{self.machine_name}] ERROR: Could not write to {filepath} (file may be open in Excel)"
-                        )
-                        print(
-                            f"[{self.machine_name}] Data saved to backup file: {backup_filepath}"
-                        )
-                        filepath = backup_filepath
+                        writer.writerows(rows)
+
+                    self.metrics.backup_files += 1
+                    print(
+                        f"[{self.machine_name}] ERROR: Could not write to {filepath} (file may be open in Excel)"
+                    )
+                    print(
+                        f"[{self.machine_name}] Data saved to backup file: {backup_filepath}"
+                    )
+                    filepath = backup_filepath
+
+        return filepath
+
+    def parse_cycles(
+        self, cycles: List[Tuple[str, Optional[str]]]
+    ) -> List[Tuple[Optional[str], Dict[str, str]]]:
+        """
+        Parse a batch of complete cycles.
+
+        The Timestamp of each record is the time it was parsed, which is when the
+        cycle was received, however long the write takes afterwards.
+
+        Args:
+            cycles: List of (data, part_number) tuples as returned by CycleFramer.
+
+        Returns:
+            List of (part_number, parsed_data) tuples for write_records.
+        """
+        records = []
+        clock = time.perf_counter
+        profiler = self.profiler
+        for data, part_number in cycles:
+            token = profiler.start_stage("parse_data_to_dict") if profiler else None
+            start = clock()
+            records.append((part_number, self.parse_data_to_dict(data)))
+            self.metrics.parse_seconds.observe(clock() - start)
+            if token is not None:
+                profiler.end_stage("parse_data_to_dict", token)
+        self.metrics.cycles += len(cycles)
+        self.metrics.last_cycle = time.time()
+        return records
+
+    def write_records(
+        self,
+        records: List[Tuple[Optional[str], Dict[str, str]]],
+        raw: Optional[List[Optional[str]]] = None,
+        cycle_ids: Optional[List[str]] = None,
+    ) -> List[str]:
+        """
+        Save a batch of parsed cycles to CSV files, or to the database if there is one,
+        and archive their raw text if there is an archive.
+
+        Cycles that go to the same file are written with one open, so a backlog that
+        arrives in one burst costs one write per file rather than one per cycle. In
+        non-append mode, cycles of the same part received in the same second share
+        one timestamped file instead of overwriting each other.
+
+        This runs on the writer thread when there is one, so compressing the raw
+        text for the archive never holds up the receive loop.
+
+        Args:
+            records: List of (part_number, parsed_data) tuples from parse_cycles.
+            raw: The raw text of each record, None for a record without it. If
+            None, nothing is archived.
+            cycle_ids: The id each record was given when it was received, see
+            haas_storage.new_cycle_id. If None, new ids are given.
+
+        Returns:
+            The filepath each cycle was saved to, in the order of records.
+
+        Raises:
+            IOError: If a file cannot be written in non-append mode.
+            sqlite3.Error: If the cycles cannot be saved to the database.
+        """
+        if cycle_ids is None:
+            cycle_ids = [new_cycle_id() for _ in records]
+        if self.archive is not None and raw is not None:
+            # Archived first, so the raw text is kept even if the write fails
+            self.archive.append(
+                self.machine_name,
+                [
+                    (parsed_data["Timestamp"], part_number, data, cycle_id)
+                    for (part_number, parsed_data), data, cycle_id in zip(
+                        records, raw, cycle_ids
+                    )
+                    if data is not None
+                ],
+            )
+
+        profiler = self.profiler
+        token = profiler.start_stage("write_records") if profiler else None
+        start = time.perf_counter()
+        if self.store is not None:
+            self.store.write_records(records, cycle_ids)
+            count = f"{len(records)} cycles" if len(records) > 1 else "Data"
+            print(f"[{self.machine_name}] {count} saved to: {self.store.path}")
+            self.metrics.write_seconds.observe(time.perf_counter() - start)
+            if token is not None:
+                profiler.end_stage("write_records", token)
+            return [self.store.path] * len(records)
+
+        targets: List[str] = []
+        batches: Dict[str, Tuple[Optional[str], str, List[Dict[str, str]]]] = {}
+
+        for part_number, parsed_data in records:
+            # "2025-12-09 15:13:58" -> "20251209_151358"
+            timestamp = (
+                parsed_data["Timestamp"]
+                .replace("-", "")
+                .replace(":", "")
+                .replace(" ", "_")
+            )
+            filepath = self.cycle_filepath(part_number, timestamp)
+            targets.append(filepath)
+            batches.setdefault(filepath, (part_number, timestamp, []))[2].append(
+                parsed_data
+            )
+
+        # Create the logs directories if they don't exist (the handle cache does
+        # this itself when it opens a file)
+        if self.handle_cache is None or not self.append_mode:
+            for directory in {os.path.dirname(filepath) for filepath in batches}:
+                os.makedirs(directory, exist_ok=True)
+
+        saved = {}
+        for filepath, (part_number, timestamp, rows) in batches.items():
+            # Cycles of one part can have been parsed with different schemas
+            fieldnames = list(dict.fromkeys(name for row in rows for name in row))
+            part, target, columns = self.columns_target(
+                part_number, timestamp, fieldnames
+            )
+            saved[filepath] = self.append_rows(target, rows, part, columns)
+        self.metrics.write_seconds.observe(time.perf_counter() - start)
+        if token is not None:
+            profiler.end_stage("write_records", token)
+        return [saved[filepath] for filepath in targets]
+
+    def save_cycles(self, cycles: List[Tuple[str, Optional[str]]]) -> List[str]:
+        """
+        Parse a batch of complete cycles and save them to CSV files.
+
+        Args:
+            cycles: List of (data, part_number) tuples as returned by CycleFramer.
+
+        Returns:
+            The filepath each cycle was saved to, in the order of cycles.
+
+        Raises:
+            IOError: If a file cannot be written in non-append mode.
+        """
+        return self.write_records(
+            self.parse_cycles(cycles), [data for data, _ in cycles]
+        )
+
+    def submit_cycles(self, cycles: List[Tuple[str, Optional[str]]]) -> None:
+        """
+        Parse complete cycles and hand them to the writer thread.
+
+        Without a writer the cycles are saved before returning, as before.
+
+        Args:
+            cycles: List of (data, part_number) tuples as returned by CycleFramer.
+        """
+        if self.writer is None:
+            self.save_cycles(cycles)
         else:
-            # Normal mode: Create new file for each cycle with timestamp
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            self.writer.submit(
+                self, self.parse_cycles(cycles), raw=[data for data, _ in cycles]
+            )
 
-            if part_number:
-                filename = f"{self.machine_name}_{part_number}_{timestamp}.csv"
-            else:
-                filename = f"{self.machine_name}_unknown_part_{timestamp}.csv"
+    def save_to_file(self, data: str, part_number: Optional[str]) -> str:
+        """
+        Save data to CSV file with part number and timestamp.
+
+        Creates a CSV file in the output directory with parsed machine data.
+        In append mode, cycles for the same part number are added to one file.
+        In non-append mode, each cycle creates a new timestamped file.
+        Includes retry logic and backup file creation if the target file is locked.
 
-            filepath = os.path.join("cnc_logs", filename)
+        Args:
+            data: Raw data string to be saved.
+            part_number: Part number extracted from the data, or None if not found.
 
-            # Write to CSV
-            try:
-                with open(filepath, "w", newline="") as f:
-                    writer = csv.DictWriter(f, fieldnames=parsed_data.keys())
-                    writer.writeheader()
-                    writer.writerow(parsed_data)
+        Returns:
+            Full filepath where the data was saved.
 
-                print(f"[{self.machine_name}] Data saved to: {filepath}")
-            except (IOError, PermissionError) as e:
+        Raises:
+            IOError: If the file cannot be written in non-append mode.
+        """
+        return self.save_cycles([(data, part_number)])[0]
+
+    def handle_received(self, framer: CycleFramer) -> List[Tuple[str, Optional[str]]]:
+        """
+        Frame the bytes the connection's framer received and report progress.
+
+        This holds the framing logic shared by the blocking socket loop in
+        process_data and the asyncio fleet supervisor, so both detect part
+        numbers and cycle ends the same way.
+
+        Args:
+            framer: The CycleFramer of the connection, holding the newly
+            received bytes.
+
+        Returns:
+            List of (data, part_number) tuples ready for save_cycles, one per
+            "End of Cycle" seen. Empty if no cycle was completed.
+        """
+        known_part = framer.part_number
+        spills = framer.spills
+        cycles = framer.frame()
+
+        for data, part_number in cycles:
+            if is_incomplete(part_number):
+                self.metrics.incomplete_cycles += 1
                 print(
-                    f"[{self.machine_name}] ERROR: Could not write to {filepath}: {e}"
+                    f"[{self.machine_name}] Cycle without End of Cycle cut off after {len(data)} characters, saved as {part_number}"
                 )
-                raise
+                known_part = None
+                continue
+            if part_number and not known_part:
+                print(f"[{self.machine_name}] Part number detected: {part_number}")
+            print(f"[{self.machine_name}] End of cycle detected!")
+            known_part = None
+
+        if framer.spills > spills:
+            self.metrics.spilled_cycles += 1
+            print(
+                f"[{self.machine_name}] Cycle larger than {self.limits.memory_bytes} bytes, spilling it to a temp file"
+            )
 
-        return filepath
+        if framer.part_number and not known_part:
+            print(f"[{self.machine_name}] Part number detected: {framer.part_number}")
+        if len(cycles) > 1:
+            print(f"[{self.machine_name}] {len(cycles)} cycles received in one burst")
+        return cycles
 
     def process_data(
         self, client_socket: socket.socket, address: Tuple[str, int]
@@ -232,8 +575,11 @@ class HaasDataLogger:
         """
         Process data from a connected socket.
 
-        Receives data from a connected CNC machine, buffers it, extracts part numbers,
-        and saves complete cycles to files when "End of Cycle" is detected.
+        Receives data from a connected CNC machine straight into the buffer of a
+        CycleFramer, which extracts part numbers incrementally, and saves complete
+        cycles to files when "End of Cycle" is detected. Several cycles received at
+        once are saved as one batch, and any text after the last one starts the
+        next cycle.
 
         Args:
             client_socket: The connected socket.
@@ -241,42 +587,149 @@ class HaasDataLogger:
         """
         print(f"[{self.machine_name}] Connected to {address}")
 
-        buffer = ""
-        part_number = None
+        framer = CycleFramer(limits=self.limits)
+        capture = (
+            self.recorder.open(self.machine_name, address, self.port)
+            if self.recorder is not None
+            else None
+        )
+        self.metrics.connections += 1
+        self.metrics.connected += 1
+        profiler = self.profiler
+        last_data = time.monotonic()
 
         try:
             while self.running:
-                data = client_socket.recv(4096)
-                if not data:
+                received = framer.recv_into(client_socket)
+                if not received:
                     print(f"[{self.machine_name}] Connection closed by remote host")
                     break
+                last_data = time.monotonic()
+                self.metrics.bytes_received += received
+                if capture is not None:
+                    capture.write(framer.received(received))
+
+                token = profiler.start_stage("process_data") if profiler else None
+                cycles = self.handle_received(framer)
+                if token is not None:
+                    profiler.end_stage("process_data", token)
+                if cycles:
+                    self.submit_cycles(cycles)
+
+        except (socket.timeout, TimeoutError):
+            # The idle timeout, or keepalive probes that went unanswered
+            self.connection_dead(time.monotonic() - last_data)
+        except Exception as e:
+            print(f"[{self.machine_name}] Error processing data from {address}: {e}")
+        finally:
+            self.metrics.connected -= 1
+            # A partial cycle is dropped, with its temp file if it was spilled
+            framer.reset()
+            if capture is not None:
+                capture.close()
+            client_socket.close()
+            print(f"[{self.machine_name}] Connection closed")
 
-                # Decode received data
-                received = data.decode("utf-8", errors="ignore")
-                buffer += received
+    async def process_stream(
+        self, reader: asyncio.StreamReader, address: Tuple[str, int]
+    ) -> None:
+        """
+        Process data from a connection of an asyncio event loop.
 
-                # Extract part number if we haven't found it yet
-                if not part_number:
-                    part_number = self.extract_part_number(buffer)
-                    if part_number:
-                        print(
-                            f"[{self.machine_name}] Part number detected: {part_number}"
-                        )
+        The same as process_data, for the fleet supervisor and server mode, which
+        run every connection in one event loop. Saving cycles never blocks the
+        loop: cycles go to the writer thread, or to a save thread without one,
+        and only this connection waits when the writer queue is full.
 
-                # Check for end of cycle
-                if "End of Cycle" in buffer or "END OF CYCLE" in buffer.upper():
-                    print(f"[{self.machine_name}] End of cycle detected!")
-                    self.save_to_file(buffer, part_number)
+        Args:
+            reader: Stream reader of the open connection.
+            address: Tuple containing the remote IP address and port.
+        """
+        loop = asyncio.get_running_loop()
+        framer = CycleFramer(limits=self.limits)
+        capture = (
+            self.recorder.open(self.machine_name, address, self.port)
+            if self.recorder is not None
+            else None
+        )
+        self.metrics.connections += 1
+        self.metrics.connected += 1
+        profiler = self.profiler
+        idle_timeout = self.connection.idle_timeout or None
+        last_data = loop.time()
+        try:
+            while self.running:
+                try:
+                    if idle_timeout is None:
+                        data = await reader.read(4096)
+                    else:
+                        data = await asyncio.wait_for(reader.read(4096), idle_timeout)
+                except (asyncio.TimeoutError, TimeoutError):
+                    # The idle timeout, or keepalive probes that went unanswered
+                    self.connection_dead(loop.time() - last_data)
+                    break
+                if not data:
+                    print(f"[{self.machine_name}] Connection closed by remote host")
+                    break
+                last_data = loop.time()
+                self.metrics.bytes_received += len(data)
+                if capture is not None:
+                    # Only queued, the recorder thread writes the file
+                    capture.write(data)
+
+                # StreamReader returns a new bytes object per read, copy it into
+                # the framer's buffer and decode complete cycles only
+                token = profiler.start_stage("process_data") if profiler else None
+                framer.write(data)
+                if framer.spilling:
+                    # The temp file of a large cycle is written and read off the loop
+                    cycles = await loop.run_in_executor(
+                        None, self.handle_received, framer
+                    )
+                else:
+                    cycles = self.handle_received(framer)
+                if token is not None:
+                    profiler.end_stage("process_data", token)
+                if not cycles:
+                    continue
 
-                    # Reset for next cycle
-                    buffer = ""
-                    part_number = None
+                if self.writer is None:
+                    # Retries on a locked file sleep, keep them off the event loop
+                    await loop.run_in_executor(
+                        self.save_executor, self.save_cycles, cycles
+                    )
+                    continue
 
-        except Exception as e:
-            print(f"[{self.machine_name}] Error processing data from {address}: {e}")
+                records = self.parse_cycles(cycles)
+                raw: List[Optional[str]] = [data for data, _ in cycles]
+                try:
+                    self.writer.submit(self, records, timeout=0, raw=raw)
+                except queue.Full:
+                    # Only this connection waits for the writer to catch up
+                    await loop.run_in_executor(
+                        None, partial(self.writer.submit, self, records, raw=raw)
+                    )
         finally:
-            client_socket.close()
-            print(f"[{self.machine_name}] Connection closed")
+            self.metrics.connected -= 1
+            # A partial cycle is dropped, with its temp file if it was spilled
+            framer.reset()
+            if capture is not None:
+                capture.close()
+
+    def connection_dead(self, silent_for: float) -> None:
+        """
+        Report a connection that timed out without being closed by the machine.
+
+        Args:
+            silent_for: Seconds since the last data was received, which is how
+            long it took to notice the machine was gone.
+        """
+        self.metrics.dead_connections += 1
+        self.metrics.last_detection_seconds = silent_for
+        print(
+            f"[{self.machine_name}] Connection dead, nothing received for {silent_for:.1f}s"
+            " (machine off or network down)"
+        )
 
     def handle_client(
         self, client_socket: socket.socket, address: Tuple[str, int]
@@ -306,16 +759,27 @@ class HaasDataLogger:
             )
         print(f"[{self.machine_name}] Press Ctrl+C to stop")
 
-        reconnect_delay = 5  # seconds
+        settings = self.connection
+        failures = 0
 
         while self.running:
             client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            received = self.metrics.bytes_received
 
             try:
                 print(
                     f"[{self.machine_name}] Attempting to connect to {self.target_ip}:{self.port}..."
                 )
+                self.metrics.connect_attempts += 1
+                client_socket.settimeout(settings.connect_timeout or None)
                 client_socket.connect((self.target_ip, self.port))
+                client_socket.settimeout(settings.idle_timeout or None)
+                enable_keepalive(
+                    client_socket,
+                    settings.keepalive_idle,
+                    settings.keepalive_interval,
+                    settings.keepalive_count,
+                )
                 print(f"[{self.machine_name}] Successfully connected!")
 
                 # Process data from the connection
@@ -335,36 +799,61 @@ class HaasDataLogger:
                 except:
                     pass
 
-            # Wait before attempting to reconnect
+            # Wait before attempting to reconnect, longer after every failure in a
+            # row. A connection that delivered data starts the count again.
             if self.running:
+                failures = 1 if self.metrics.bytes_received > received else failures + 1
+                delay = backoff_delay(failures, settings)
+                self.metrics.reconnects += 1
+                self.metrics.reconnect_delay = delay
                 print(
-                    f"[{self.machine_name}] Reconnecting in {reconnect_delay} seconds..."
+                    f"[{self.machine_name}] Reconnecting in {delay:.1f} seconds... (attempt {failures})"
                 )
-                time.sleep(reconnect_delay)
+                time.sleep(delay)
+
+    def announce_server(self) -> None:
+        """
+        Print that server mode is listening, once the port is bound.
+        """
+        mode_str = "APPEND mode" if self.append_mode else "NEW FILE mode"
+        print(
+            f"[{self.machine_name}] Haas CNC Data Logger started on {self.host}:{self.port} ({mode_str})"
+        )
+        print(f"[{self.machine_name}] Waiting for connections...")
+        if self.append_mode:
+            print(
+                f"[{self.machine_name}] TIP: Close CSV files in Excel to avoid file lock issues"
+            )
+        print(f"[{self.machine_name}] Press Ctrl+C to stop")
 
     def start_server_mode(self) -> None:
         """
         Start in server mode - listen for incoming connections.
 
+        Every connection is served by one asyncio event loop (see haas_server.py),
+        within the backlog and connection limits of the server settings. With
+        the threads setting, each connection gets a thread of its own instead.
+        """
+        if self.server.threads:
+            self.start_threaded_server_mode()
+        else:
+            MachineServer([self], self.server).start()
+
+    def start_threaded_server_mode(self) -> None:
+        """
+        Start in server mode with a thread per connection.
+
         Binds to the configured host and port, then listens for incoming connections
-        from CNC machines. Each connection is handled in a separate daemon thread.
+        from CNC machines. Each connection is handled in a separate daemon thread,
+        without a limit on their number.
         """
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
         try:
             server_socket.bind((self.host, self.port))
-            server_socket.listen(5)
-            mode_str = "APPEND mode" if self.append_mode else "NEW FILE mode"
-            print(
-                f"[{self.machine_name}] Haas CNC Data Logger started on {self.host}:{self.port} ({mode_str})"
-            )
-            print(f"[{self.machine_name}] Waiting for connections...")
-            if self.append_mode:
-                print(
-                    f"[{self.machine_name}] TIP: Close CSV files in Excel to avoid file lock issues"
-                )
-            print(f"[{self.machine_name}] Press Ctrl+C to stop")
+            server_socket.listen(self.server.backlog)
+            self.announce_server()
 
             while self.running:
                 try:
@@ -432,13 +921,29 @@ Examples:
     python haas_logger.py                          # Listen on default port 5062
     python haas_logger.py -p 5063 -a               # Listen on port 5063 with append mode
     python haas_logger.py -H 0.0.0.0 -p 5062       # Listen on all interfaces
+    python haas_logger2.py --ports 5050=st30l 5051=st40 -a   # One process for the machines on ports 5050 and 5051
 
 Notes:
     - Use -t to connect to a Haas machine (client mode)
     - Without -t, the script waits for the machine to connect (server mode)
     - In append mode (-a), close CSV files on PCs before production runs to avoid file locks
     - If a file is locked, the script will retry 3 times then create a backup file
-    - In client mode, the script will auto-reconnect if the connection is lost
+    - Files are written by a separate thread, so a locked file never stops the script reading from the machine
+    - Cycles are journaled (journal/<name>.jsonl) before they are written and replayed at the next start if the script was killed
+    - Backup files are merged back into the main file once it is no longer locked
+    - With --publish-interval, files are written to cnc_store and published read-only to cnc_logs, so Excel never locks the logger out
+    - With --db, cycles are saved to an SQLite database and the changed parts are exported to CSV files every minute
+    - With --compact-interval, NEW FILE mode files of earlier days are merged into one file per machine, part and day
+    - With --layout, files are sorted into subdirectories, haas_layout.py moves existing files into the layout
+    - The raw text of every cycle is archived, compressed, in archive/<name>/ so it can be parsed again later, for 90 days (--archive-days)
+    - With --record, the raw stream of every connection is saved to captures/<name>/ for haas_simulator.py --replay
+    - With --metrics-port, counters and timings are served in Prometheus format at http://127.0.0.1:<port>/metrics
+    - With --profile, stage times and stack samples are saved to profile/ on SIGUSR1 (kill -USR1 <pid>) and at exit
+    - In client mode, the script will auto-reconnect if the connection is lost, waiting longer after each failure (up to --max-reconnect-delay)
+    - TCP keepalive notices a machine that was switched off or unplugged within about 25 seconds
+    - In server mode, every connection is served by one event loop, up to --max-connections at once
+    - With --ports, one process listens for every machine on its own port, a connection belongs to the machine of its port
+    - A cycle above --max-cycle-memory is spilled to a temp file, above --max-cycle-size it is saved as <part>_INCOMPLETE
         """,
     )
 
@@ -474,19 +979,353 @@ Notes:
         dest="target_ip",
         help="Target IP address to connect to (client mode). If not specified, runs in server mode.",
     )
+    parser.add_argument(
+        "--ports",
+        nargs="+",
+        metavar="PORT=NAME",
+        help="Server mode: listen for several machines, each on its own port, instead of -p and -n",
+    )
+
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=10.0,
+        help="Client mode: seconds to wait for the machine to accept the connection (default: 10)",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=0.0,
+        help="Reconnect (client mode) or hang up (server mode) when nothing was received for this many seconds (default: 0, never)",
+    )
+    parser.add_argument(
+        "--keepalive",
+        type=int,
+        default=10,
+        help="Seconds of silence before keepalive probes check a connection, 0 disables (default: 10)",
+    )
+    parser.add_argument(
+        "--max-reconnect-delay",
+        type=float,
+        default=60.0,
+        help="Client mode: longest wait between reconnect attempts in seconds (default: 60)",
+    )
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        default=128,
+        help="Server mode: connections the system queues while others are accepted (default: 128)",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=64,
+        help="Server mode: connections served at once, more are closed (default: 64)",
+    )
+    parser.add_argument(
+        "--buffer-limit",
+        type=int,
+        default=64 * 1024,
+        help="Server mode: bytes read ahead per connection before reading pauses (default: 65536)",
+    )
+    parser.add_argument(
+        "--threaded",
+        action="store_true",
+        help="Server mode: a thread per connection instead of one event loop, without --max-connections",
+    )
+    parser.add_argument(
+        "--max-cycle-memory",
+        type=int,
+        default=1024 * 1024,
+        help="Bytes of a cycle kept in memory, the rest is spilled to a temp file (default: 1048576, 0 never spills)",
+    )
+    parser.add_argument(
+        "--max-cycle-size",
+        type=int,
+        default=4 * 1024 * 1024,
+        help="Bytes after which a cycle without End of Cycle is saved as incomplete (default: 4194304, 0 no limit)",
+    )
+    parser.add_argument(
+        "--max-cycle-age",
+        type=float,
+        default=0.0,
+        help="Seconds after which a cycle without End of Cycle is saved as incomplete when more data arrives (default: 0, no limit)",
+    )
+    parser.add_argument(
+        "--spill-dir",
+        default="",
+        help="Directory of the temp files of spilled cycles (default: the system temp directory)",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--schemas",
+        dest="schema_file",
+        help="JSON file with extra DPRNT fields per program (see dprnt_schemas.json)",
+    )
+
+    parser.add_argument(
+        "--max-open-files",
+        type=int,
+        default=0,
+        help="Append mode: keep up to this many CSV files open between cycles (default: 0, open and close every cycle)",
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=5.0,
+        help="With --max-open-files: flush buffered rows at least this often in seconds (default: 5)",
+    )
+    parser.add_argument(
+        "--flush-every",
+        type=int,
+        default=100,
+        help="With --max-open-files: flush a file after this many cycles (default: 100, --flush-interval flushes the rest)",
+    )
+
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=1000,
+        help="Batches of cycles waiting for the writer thread before reading pauses (default: 1000, 0 writes in the receive loop)",
+    )
+    parser.add_argument(
+        "--journal",
+        help="Write-ahead journal file (default: journal/<name>.jsonl)",
+    )
+    parser.add_argument(
+        "--no-journal",
+        action="store_true",
+        help="Do not journal cycles before writing them",
+    )
+    parser.add_argument(
+        "--merge-interval",
+        type=float,
+        default=60.0,
+        help="Seconds between attempts to merge backup files into their main file (default: 60, 0 disables)",
+    )
+    parser.add_argument(
+        "--publish-interval",
+        type=float,
+        default=0.0,
+        help="Write to a private directory and publish read-only copies to cnc_logs every this many seconds (default: 0, write to cnc_logs directly)",
+    )
+    parser.add_argument(
+        "--store-dir",
+        default="cnc_store",
+        help="With --publish-interval: private directory the CSV files are written to (default: cnc_store)",
+    )
+    parser.add_argument(
+        "--db",
+        help="Save cycles to this SQLite database instead of CSV files (see haas_sqlite.py)",
+    )
+    parser.add_argument(
+        "--export-interval",
+        type=float,
+        default=60.0,
+        help="With --db: seconds between exports of the changed parts to CSV files (default: 60, 0 disables)",
+    )
+    parser.add_argument(
+        "--layout",
+        default="",
+        help='Sort the CSV files into subdirectories, ex. "{machine}/{yyyy}/{mm}" (default: all in cnc_logs, see haas_layout.py)',
+    )
+    parser.add_argument(
+        "--archive",
+        default="archive",
+        help="Directory the raw text of every cycle is archived in (default: archive, see haas_archive.py)",
+    )
+    parser.add_argument(
+        "--no-archive",
+        action="store_true",
+        help="Do not archive the raw text of the cycles",
+    )
+    parser.add_argument(
+        "--archive-days",
+        type=int,
+        default=90,
+        help="Delete archived cycles after this many days, 0 keeps them all (default: 90)",
+    )
+    parser.add_argument(
+        "--compact-interval",
+        type=float,
+        default=0.0,
+        help="Seconds between merges of earlier days' NEW FILE mode files into daily files (default: 0, never; see haas_compact.py)",
+    )
+    parser.add_argument(
+        "--record",
+        nargs="?",
+        const="captures",
+        metavar="DIR",
+        help="Record the raw stream of every connection for replay (default directory: captures, see haas_capture.py)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="Serve Prometheus metrics on this port (default: 0, off)",
+    )
+    parser.add_argument(
+        "--metrics-host",
+        default="127.0.0.1",
+        help="Address the metrics are served on (default: 127.0.0.1, local scrapes only)",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="profile",
+        metavar="DIR",
+        help="Time the receive, parse and write stages and sample stacks, saved on SIGUSR1 and at exit (default directory: profile)",
+    )
 
     args = parser.parse_args()
+    try:
+        layout = PathLayout(args.layout) if args.layout else None
+    except ValueError as e:
+        parser.error(str(e))
+    if args.publish_interval > 0 and args.queue_size <= 0:
+        parser.error("--publish-interval needs the writer thread (--queue-size > 0)")
+    if args.db and args.export_interval > 0 and args.queue_size <= 0:
+        parser.error("--export-interval needs the writer thread (--queue-size > 0)")
+    if args.compact_interval > 0 and args.queue_size <= 0:
+        parser.error("--compact-interval needs the writer thread (--queue-size > 0)")
+
+    output_dir = "cnc_logs"
+    publisher = None
+    if args.publish_interval > 0:
+        output_dir = args.store_dir
+        publisher = SnapshotPublisher(args.store_dir, "cnc_logs")
+    store = SqliteStore(args.db) if args.db else None
+    archive = (
+        None
+        if args.no_archive
+        else CycleArchive(args.archive, keep_days=args.archive_days)
+    )
+    recorder = CaptureRecorder(args.record) if args.record else None
 
-    # Create and start the logger
-    logger = HaasDataLogger(
-        host=args.host,
-        port=args.port,
-        machine_name=args.machine_name,
-        append_mode=args.append_mode,
-        target_ip=args.target_ip,
+    handle_cache = (
+        CsvHandleCache(args.max_open_files, args.flush_every, args.flush_interval)
+        if args.max_open_files > 0
+        else None
+    )
+    try:
+        machines = parse_port_map(args.ports) if args.ports else {}
+    except ValueError as e:
+        parser.error(f"--ports: {e}")
+    if machines and args.target_ip:
+        parser.error("--ports is for server mode, it can't be used with -t")
+    if machines and args.threaded:
+        parser.error("--threaded serves a single port, it can't be used with --ports")
+    # With --ports, -n only names the journal and the profile of the process
+    machine_name = args.machine_name or (
+        "server" if machines else f"Machine_Port{args.port}"
+    )
+    machines = machines or {args.port: machine_name}
+    profiler = StageProfiler(args.profile, machine_name).start() if args.profile else None
+
+    journal = None
+    writer = None
+    if args.queue_size > 0:
+        if not args.no_journal:
+            journal = CycleJournal(
+                args.journal or os.path.join("journal", f"{machine_name}.jsonl")
+            )
+        writer = CycleWriter(args.queue_size, journal=journal)
+        if args.merge_interval > 0:
+            writer.add_task(args.merge_interval, partial(merge_backups, output_dir))
+        if store is not None and args.export_interval > 0:
+            writer.add_task(
+                args.export_interval, partial(store.export_new, output_dir, layout)
+            )
+        if args.compact_interval > 0:
+            writer.add_task(
+                args.compact_interval, partial(compact_directory, output_dir)
+            )
+        if publisher is not None:
+            writer.add_task(args.publish_interval, publisher.publish)
+
+    # Create the loggers, one per machine, sharing the writer and the stores
+    schemas = SchemaRegistry.load(args.schema_file) if args.schema_file else None
+    connection = ConnectionSettings(
+        connect_timeout=args.connect_timeout,
+        idle_timeout=args.idle_timeout,
+        keepalive_idle=args.keepalive,
+        max_reconnect_delay=args.max_reconnect_delay,
+    )
+    server = ServerSettings(
+        backlog=args.backlog,
+        max_connections=args.max_connections,
+        buffer_limit=args.buffer_limit,
+        threads=args.threaded,
+    )
+    limits = CycleLimits(
+        memory_bytes=args.max_cycle_memory,
+        max_bytes=args.max_cycle_size,
+        max_age=args.max_cycle_age,
+        spill_dir=args.spill_dir,
+    )
+    loggers = [
+        HaasDataLogger(
+            host=args.host,
+            port=port,
+            machine_name=name,
+            append_mode=args.append_mode,
+            target_ip=args.target_ip,
+            schemas=schemas,
+            handle_cache=handle_cache,
+            writer=writer,
+            output_dir=output_dir,
+            store=store,
+            layout=layout,
+            archive=archive,
+            recorder=recorder,
+            profiler=profiler,
+            connection=connection,
+            server=server,
+            limits=limits,
+        )
+        for port, name in machines.items()
+    ]
+
+    # Replay cycles a previous run journaled but never wrote, before new ones arrive
+    if journal is not None:
+        journal.recover({logger.machine_name: logger for logger in loggers})
+    if args.merge_interval > 0:
+        merge_backups(output_dir)
+    if publisher is not None:
+        publisher.publish()
+    if writer is not None:
+        writer.start()
+    metrics_server = (
+        MetricsServer(loggers, writer, args.metrics_host, args.metrics_port).start()
+        if args.metrics_port
+        else None
     )
 
     try:
-        logger.start()
+        if len(loggers) > 1:
+            MachineServer(loggers, server).start()
+        else:
+            loggers[0].start()
     except KeyboardInterrupt:
         print("\nShutting down...")
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        if writer is not None:
+            writer.close()
+        if profiler is not None:
+            profiler.close()
+        if recorder is not None:
+            recorder.close()
+        if handle_cache is not None:
+            handle_cache.close_all()
+        if archive is not None:
+            archive.close()
+        if store is not None:
+            if args.export_interval > 0:
+                store.export_new(output_dir, layout)
+            store.close()
+        if publisher is not None:
+            # Last snapshot, with everything the writer drained on the way out
+            publisher.publish()
@@ -0,0 +1,440 @@
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from haas_logger2 import HaasDataLogger
+    from haas_writer import CycleWriter
+
+# Upper bounds in seconds of the parse and write time buckets
+TIME_BUCKETS: Tuple[float, ...] = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# Writer thread metrics: (name, type, help, key of CycleWriter.stats())
+WRITER_METRICS: Tuple[Tuple[str, str, str, str], ...] = (
+    (
+        "haas_writer_queue_depth",
+        "gauge",
+        "Batches waiting for the writer thread.",
+        "queue_depth",
+    ),
+    (
+        "haas_writer_max_queue_depth",
+        "gauge",
+        "Deepest the write queue has been.",
+        "max_queue_depth",
+    ),
+    (
+        "haas_writer_queue_full_total",
+        "counter",
+        "Batches that had to wait for room in the write queue.",
+        "queue_full_count",
+    ),
+    (
+        "haas_writer_cycles_written_total",
+        "counter",
+        "Cycles saved by the writer thread.",
+        "cycles_written",
+    ),
+    (
+        "haas_writer_errors_total",
+        "counter",
+        "Batches the writer thread could not save.",
+        "write_errors",
+    ),
+    (
+        "haas_writer_max_latency_seconds",
+        "gauge",
+        "Longest time from submit to saved.",
+        "max_latency",
+    ),
+    (
+        "haas_writer_avg_latency_seconds",
+        "gauge",
+        "Average time from submit to saved.",
+        "avg_latency",
+    ),
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram, rendered as a Prometheus histogram.
+
+    observe() is one bisect and three additions, cheap enough for every cycle.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = TIME_BUCKETS) -> None:
+        """
+        Initialize an empty histogram.
+
+        Args:
+            buckets: Sorted upper bounds of the buckets, +Inf is added.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """
+        Record one value.
+
+        Args:
+            value: The value, in seconds for the time histograms.
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: str) -> List[str]:
+        """
+        The cumulative bucket, sum and count lines of the histogram.
+
+        Args:
+            name: Metric name.
+            labels: Rendered labels without braces, ex. 'machine="st30l"'.
+
+        Returns:
+            Lines in Prometheus text format.
+        """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum!r}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class MachineMetrics:
+    """
+    Counters of one machine, kept by its HaasDataLogger.
+
+    Every counter is plain attribute arithmetic without a lock. Receive counters
+    are only updated by the receive loop and write counters only by the writer
+    thread, so nothing is lost. The exception is two connections from the same
+    machine at once in server mode, which can be off by a few bytes.
+    """
+
+    def __init__(self) -> None:
+        """
+        Initialize every counter at zero.
+        """
+        self.bytes_received = 0
+        self.cycles = 0
+        self.connections = 0
+        self.connected = 0
+        self.reconnects = 0
+        self.connect_attempts = 0
+        self.rejected_connections = 0
+        self.dead_connections = 0
+        self.last_detection_seconds = 0.0
+        self.reconnect_delay = 0.0
+        self.backup_files = 0
+        self.incomplete_cycles = 0
+        self.spilled_cycles = 0
+        self.last_cycle = 0.0
+        self.parse_seconds = Histogram()
+        self.write_seconds = Histogram()
+
+
+def _label(value: str) -> str:
+    """
+    Escape a label value for the Prometheus text format.
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics(
+    loggers: Iterable["HaasDataLogger"], writer: Optional["CycleWriter"] = None
+) -> str:
+    """
+    Render the metrics of every machine and of the writer thread.
+
+    Args:
+        loggers: The loggers of the process, one per machine.
+        writer: The shared writer thread, or None.
+
+    Returns:
+        The metrics in Prometheus text format.
+    """
+    now = time.time()
+    machines = [
+        (f'machine="{_label(logger.machine_name)}"', logger.metrics)
+        for logger in loggers
+    ]
+    lines: List[str] = []
+
+    def family(
+        name: str, kind: str, help_text: str, value: Callable[[MachineMetrics], float]
+    ) -> None:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, metrics in machines:
+            lines.append(f"{name}{{{labels}}} {value(metrics)!r}")
+
+    family(
+        "haas_bytes_received_total",
+        "counter",
+        "Bytes received from the machine.",
+        lambda m: m.bytes_received,
+    )
+    family(
+        "haas_cycles_total",
+        "counter",
+        "Cycles received, incomplete ones included.",
+        lambda m: m.cycles,
+    )
+    family(
+        "haas_incomplete_cycles_total",
+        "counter",
+        "Cycles without End of Cycle saved as incomplete by the size or age limit.",
+        lambda m: m.incomplete_cycles,
+    )
+    family(
+        "haas_spilled_cycles_total",
+        "counter",
+        "Cycles above the memory limit that were spilled to a temp file.",
+        lambda m: m.spilled_cycles,
+    )
+    family(
+        "haas_connections_total",
+        "counter",
+        "Connections established with the machine.",
+        lambda m: m.connections,
+    )
+    family(
+        "haas_connected",
+        "gauge",
+        "Open connections with the machine.",
+        lambda m: m.connected,
+    )
+    family(
+        "haas_reconnects_total",
+        "counter",
+        "Lost or failed connections that were retried (client mode).",
+        lambda m: m.reconnects,
+    )
+    family(
+        "haas_connect_attempts_total",
+        "counter",
+        "Connection attempts (client mode).",
+        lambda m: m.connect_attempts,
+    )
+    family(
+        "haas_rejected_connections_total",
+        "counter",
+        "Connections closed because the server had too many (server mode).",
+        lambda m: m.rejected_connections,
+    )
+    family(
+        "haas_dead_connections_total",
+        "counter",
+        "Connections dropped by the idle timeout or unanswered keepalive probes.",
+        lambda m: m.dead_connections,
+    )
+    family(
+        "haas_dead_connection_detection_seconds",
+        "gauge",
+        "Silence before the last dead connection was noticed.",
+        lambda m: m.last_detection_seconds,
+    )
+    family(
+        "haas_reconnect_delay_seconds",
+        "gauge",
+        "Current wait before reconnecting, with backoff and jitter.",
+        lambda m: m.reconnect_delay,
+    )
+    family(
+        "haas_backup_files_total",
+        "counter",
+        "Writes that went to a backup file because the main file was locked.",
+        lambda m: m.backup_files,
+    )
+    family(
+        "haas_last_cycle_timestamp_seconds",
+        "gauge",
+        "Unix time of the last complete cycle, 0 if none yet.",
+        lambda m: m.last_cycle,
+    )
+    family(
+        "haas_seconds_since_last_cycle",
+        "gauge",
+        "Seconds since the last complete cycle, -1 if none yet.",
+        lambda m: round(now - m.last_cycle, 3) if m.last_cycle else -1,
+    )
+
+    for name, help_text, attribute in (
+        ("haas_parse_seconds", "Time to parse one cycle.", "parse_seconds"),
+        (
+            "haas_write_seconds",
+            "Time to save one batch of cycles, retries included.",
+            "write_seconds",
+        ),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, metrics in machines:
+            lines.extend(getattr(metrics, attribute).samples(name, labels))
+
+    if writer is not None:
+        stats = writer.stats()
+        for name, kind, help_text, key in WRITER_METRICS:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {stats[key]!r}")
+
+    return "\n".join(lines) + "\n"
+
+
+def merge_metrics(sources: Iterable[Tuple[str, str]]) -> str:
+    """
+    Merge the metrics pages of several processes into one.
+
+    Each family keeps its HELP and TYPE lines once, followed by the samples of
+    every process with a label of that process added, so the same machine counters
+    of different worker processes stay apart.
+
+    Args:
+        sources: (labels, page) per process, the labels rendered without braces,
+        ex. 'shard="1"', and the page in Prometheus text format.
+
+    Returns:
+        The merged metrics in Prometheus text format.
+    """
+    headers: Dict[str, List[str]] = {}
+    samples: Dict[str, List[str]] = {}
+    for labels, page in sources:
+        family = ""
+        for line in page.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                parts = line.split(" ", 3)
+                if len(parts) > 2 and parts[1] in ("HELP", "TYPE"):
+                    family = parts[2]
+                    headers.setdefault(family, [])
+                    if line not in headers[family]:
+                        headers[family].append(line)
+                continue
+            name, brace, rest = line.partition("{")
+            if brace:
+                line = f"{name}{{{labels},{rest}"
+            else:
+                name, _, value = line.partition(" ")
+                line = f"{name}{{{labels}}} {value}"
+            samples.setdefault(family, []).append(line)
+
+    lines: List[str] = []
+    for family in list(headers) + [f for f in samples if f not in headers]:
+        lines.extend(headers.get(family, []))
+        lines.extend(samples.get(family, []))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    HTTP endpoint serving the metrics at /metrics for Prometheus.
+
+    Runs in a daemon thread. The metrics are only rendered when scraped, the
+    receive loops just update their counters.
+    """
+
+    def __init__(
+        self,
+        loggers: List["HaasDataLogger"],
+        writer: Optional["CycleWriter"] = None,
+        host: str = "127.0.0.1",
+        port: int = 9162,
+    ) -> None:
+        """
+        Initialize the server. Call start() to start listening.
+
+        Args:
+            loggers: The loggers of the process, one per machine.
+            writer: The shared writer thread, or None.
+            host: Address to listen on. The default only accepts local scrapes.
+            port: Port to listen on.
+        """
+        self.loggers = loggers
+        self.writer = writer
+        self.host = host
+        self.port = port
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def start(self) -> "MetricsServer":
+        """
+        Start listening in a daemon thread.
+
+        Returns:
+            The server, so it can be created and started in one line.
+
+        Raises:
+            OSError: If the port is in use.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: object) -> None:
+                # Scrapes every few seconds would flood the journal
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=self._server.serve_forever, name="metrics", daemon=True
+        ).start()
+        print(f"[metrics] Serving metrics on http://{self.host}:{self.port}/metrics")
+        return self
+
+    def render(self) -> str:
+        """
+        Render the page served at /metrics, on every scrape.
+
+        Returns:
+            The metrics in Prometheus text format.
+        """
+        return render_metrics(self.loggers, self.writer)
+
+    def close(self) -> None:
+        """
+        Stop the server.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
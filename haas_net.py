@@ -0,0 +1,105 @@
+import random
+import socket
+from typing import Any, NamedTuple
+
+
+class ConnectionSettings(NamedTuple):
+    """
+    How client mode connects to a machine and notices that it is gone.
+
+    A machine that is switched off or unplugged never closes its connection, so
+    without help recv() waits forever on a half-open socket. TCP keepalive probes
+    a quiet connection after keepalive_idle seconds, every keepalive_interval
+    seconds, and gives up after keepalive_count unanswered probes, so a dead
+    machine is noticed within idle + interval x count seconds (25 by default)
+    while a machine that is just between cycles stays connected. idle_timeout
+    additionally drops a connection that sent nothing for that long, for
+    machines that always print within a known time.
+
+    Reconnects back off exponentially from reconnect_delay up to
+    max_reconnect_delay, with random jitter so a network blip does not make every
+    logger reconnect at the same moment.
+    """
+
+    connect_timeout: float = 10.0
+    idle_timeout: float = 0.0
+    keepalive_idle: int = 10
+    keepalive_interval: int = 5
+    keepalive_count: int = 3
+    reconnect_delay: float = 1.0
+    max_reconnect_delay: float = 60.0
+
+
+def enable_keepalive(sock: Any, idle: int = 10, interval: int = 5, count: int = 3) -> None:
+    """
+    Turn on TCP keepalive with short timings.
+
+    The per-socket timings are set where the platform has them (Linux, Windows 10,
+    macOS), otherwise the system defaults apply (probes after two hours).
+
+    Args:
+        sock: Connected socket, or the socket of an asyncio transport.
+        idle: Seconds without traffic before the first probe. 0 turns keepalive off.
+        interval: Seconds between probes.
+        count: Unanswered probes before the connection is dropped.
+    """
+    if idle <= 0:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    elif hasattr(socket, "TCP_KEEPALIVE"):
+        # macOS names the idle time TCP_KEEPALIVE
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+    elif hasattr(sock, "ioctl") and hasattr(socket, "SIO_KEEPALIVE_VALS"):
+        # Older Windows: idle and interval in milliseconds, the count is fixed
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+        return
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+    if hasattr(socket, "TCP_KEEPCNT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+
+def backoff_delay(failures: int, settings: ConnectionSettings) -> float:
+    """
+    Seconds to wait before the next connection attempt.
+
+    The delay doubles with every failure in a row, up to max_reconnect_delay, and
+    a random half of it is dropped ("equal jitter"), so loggers that lost their
+    machines at the same moment spread their attempts out.
+
+    Args:
+        failures: Failed or lost connections in a row, at least 1.
+        settings: Connection settings with the delay limits.
+
+    Returns:
+        The delay in seconds.
+    """
+    delay = min(
+        settings.max_reconnect_delay,
+        settings.reconnect_delay * 2 ** min(max(failures, 1) - 1, 30),
+    )
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class ServerSettings(NamedTuple):
+    """
+    Limits of server mode, where the machines connect to the logger.
+
+    Every connection is served by one event loop instead of a thread each, so a
+    connection costs a few kilobytes. max_connections caps them anyway: a client
+    that keeps connecting and never closes, or a scan of the port, is turned away
+    instead of growing the logger without limit. buffer_limit bounds what is
+    read ahead of the parser per connection; above it reading pauses and TCP
+    slows the sender down. backlog is how many connections the system queues
+    while the logger is busy accepting others.
+
+    threads serves each connection in a thread of its own instead, the design
+    before the event loop, without the connection limit.
+    """
+
+    backlog: int = 128
+    max_connections: int = 64
+    buffer_limit: int = 64 * 1024
+    threads: bool = False
@@ -0,0 +1,358 @@
+import io
+import json
+import re
+from typing import Dict, Iterable, List, Optional, Pattern, Tuple
+
+# Built-in fields: DPRNT label -> value pattern. Each named group is a CSV column.
+DEFAULT_FIELDS: Tuple[Tuple[str, str], ...] = (
+    (
+        "PART NUMBER",
+        r"(?P<Part_Number>[^\s,]+)(?:\s*,\s*REV\.\s*(?P<Revision>[^\]]*))?",
+    ),
+    ("DATE YYMMDD", r"(?P<Date_YYMMDD>\d+)"),
+    ("TIME HHMMSS", r"(?P<Time_HHMMSS>\d+)"),
+    ("PARTS MADE", r"(?P<Parts_Counter>\d+)"),
+    (
+        "TIME, LAST PART",
+        r"(?P<Last_Part_Time_Seconds>\d+(?:\.\d+)?)\s*SECONDS",
+    ),
+)
+
+
+def label_key(label: str) -> str:
+    """
+    Normalize a DPRNT label for lookup.
+
+    DPRNT prints * as a space, so "PARTS*MADE", "PARTS MADE" and "PARTSMADE" all
+    map to the same key. A leading "DPRNT[" from program source is dropped.
+
+    Args:
+        label: Label text in front of the colon.
+
+    Returns:
+        The label upper-cased with spaces, tabs and * removed.
+    """
+    if "[" in label:
+        label = label.rsplit("[", 1)[1]
+    return label.upper().replace(" ", "").replace("*", "").replace("\t", "")
+
+
+def label_pattern(label: str) -> str:
+    """
+    Build the regex that finds a DPRNT label, up to and including its colon.
+
+    The words of the label are matched literally, in upper case, with any spaces,
+    tabs or * between them, so "PARTS MADE" also finds "PARTS*MADE" and "PARTSMADE".
+    Starting with a literal word lets the regex engine skip ahead to it quickly.
+
+    Args:
+        label: Label as configured, e.g. "PARTS MADE".
+
+    Returns:
+        The regex source.
+    """
+    if "[" in label:
+        label = label.rsplit("[", 1)[1]
+    words = re.split(r"[ \t*]+", label.upper().strip(" \t*"))
+    return r"[ \t*]*".join(re.escape(word) for word in words) + r"[ \t*]*:"
+
+
+class DprntParser:
+    """
+    Parser for the DPRNT text of one cycle.
+
+    Each label is found with its own regex search, which starts with a literal word
+    and runs in C, so a missing field costs one fast pass over the text instead of a
+    Python loop over its lines. A hit only counts when the label is the whole text
+    in front of the line's first colon (optionally after "DPRNT["), and only then is
+    the value matched, up to the end of the line. When a field appears more than
+    once, the first line whose value matches wins.
+
+    Labels are searched in upper case first. Fields that are not found, or that have
+    lower case in front of them, are searched again in the upper-cased text, so
+    lower-case labels still match.
+    """
+
+    def __init__(self, fields: Iterable[Tuple[str, str]] = DEFAULT_FIELDS) -> None:
+        """
+        Compile the field patterns.
+
+        Args:
+            fields: (label, pattern) pairs. Each named group in a pattern is a column.
+        """
+        # label_key -> (label regex, value regex). A later field with the same label
+        # replaces the earlier one.
+        self.fields: Dict[str, Tuple[Pattern[str], Pattern[str]]] = {}
+        self.columns: Tuple[str, ...] = ()
+
+        for label, pattern in fields:
+            # The value regex skips all the padding in front of the value first
+            value = re.compile(rf"[ \t*]*(?![ \t*])(?:{pattern})", re.IGNORECASE)
+            self.fields[label_key(label)] = (re.compile(label_pattern(label)), value)
+            self.columns += tuple(
+                name for name in value.groupindex if name not in self.columns
+            )
+
+    @staticmethod
+    def find(
+        text: str, data: str, label: Pattern[str], value: Pattern[str]
+    ) -> Optional[Tuple[int, "re.Match[str]"]]:
+        """
+        Find the first line with the label whose value matches.
+
+        Args:
+            text: Text to search, data itself or data upper-cased.
+            data: Raw data string of one cycle, the same length as text.
+            label: Compiled label regex.
+            value: Compiled value regex.
+
+        Returns:
+            Offset of the label and the value match, or None if there is none.
+        """
+        position = 0
+        while True:
+            hit = label.search(text, position)
+            if hit is None:
+                return None
+            begin, position = hit.span()
+            # The label must be the whole text in front of the line's first colon
+            prefix = text[text.rfind("\n", 0, begin) + 1 : begin]
+            if prefix and (":" in prefix or prefix.rsplit("[", 1)[-1].strip(" \t*")):
+                continue
+            # The value stops at the end of its line
+            end = text.find("\n", position)
+            match = value.match(data, position, len(data) if end < 0 else end + 1)
+            if match:
+                return begin, match
+
+    def parse(self, data: str) -> Dict[str, str]:
+        """
+        Extract every known field from the cycle text.
+
+        Args:
+            data: Raw data string of one cycle.
+
+        Returns:
+            Dictionary with every column of the parser. Fields that were not found
+            are empty strings.
+        """
+        result = dict.fromkeys(self.columns, "")
+
+        if "\n" not in data:
+            # The control can be set to end DPRNT lines with CR only
+            data = data.replace("\r", "\n")
+
+        found = []
+        missing = []
+        for label, value in self.fields.values():
+            hit = self.find(data, data, label, value)
+            if hit is not None:
+                # A lower-case label can only come first if there is lower case before
+                head = data[: hit[0]]
+                if head == head.upper():
+                    found.append(hit)
+                    continue
+            missing.append((label, value))
+
+        if missing:
+            text = data.upper()
+            # Upper-casing can change the offsets (ß is SS), then ignore case instead
+            same = len(text) == len(data)
+            for label, value in missing:
+                if not same:
+                    text, label = data, re.compile(label.pattern, re.IGNORECASE)
+                hit = self.find(text, data, label, value)
+                if hit is not None:
+                    found.append(hit)
+
+        # A column shared by several fields takes the value of the earliest line
+        found.sort(key=lambda hit: hit[0])
+        for _, match in found:
+            for name, text in match.groupdict().items():
+                if text is not None and not result[name]:
+                    result[name] = text.strip()
+
+        return result
+
+
+default_parser = DprntParser()
+
+
+# The program number, either in program source ("O03020 (DPRNT PART DATA)") or
+# printed by the program as "PROGRAM: O03020" / "PROGRAM NUMBER: 3020".
+PROGRAM_RE = re.compile(
+    r"^[ \t*]*(?:DPRNT\[[ \t*]*)?"
+    r"(?:PROGRAM[ \t*]*(?:NUMBER)?[ \t*]*:[ \t*]*O?|O)(\d{1,5})\b",
+    re.IGNORECASE,
+)
+
+# Only the start of a cycle is searched for the program number or header line
+IDENTIFY_LINES = 20
+
+
+def program_key(program: str) -> str:
+    """
+    Normalize a program number so O3020, o03020 and 3020 are the same key.
+
+    Args:
+        program: Program number with or without the leading O.
+
+    Returns:
+        The program number as O followed by five digits.
+    """
+    return f"O{int(program.strip().upper().lstrip('O') or 0):05d}"
+
+
+def header_key(line: str) -> str:
+    """
+    Normalize a header line for lookup.
+
+    Args:
+        line: A DPRNT line, from program source or as printed by the control.
+
+    Returns:
+        The line upper-cased, without DPRNT[ ], with * and runs of spaces as one space.
+    """
+    line = line.strip()
+    if line.upper().startswith("DPRNT["):
+        line = line[6:].rstrip("]")
+    return " ".join(line.replace("*", " ").upper().split())
+
+
+class SchemaRegistry:
+    """
+    DPRNT schemas per program, loaded from a JSON file.
+
+    A schema adds named fields to the built-in ones for cycles of one program,
+    identified by its O-number or by its first (header) line. Every schema is
+    compiled into its own DprntParser when the registry is loaded, and a cycle is
+    matched to its schema with one dictionary lookup, so parsing does not get slower
+    as schemas are added. Cycles that match no schema use the built-in fields.
+
+    File layout:
+
+        {
+          "programs": {
+            "O03020": [
+              {"label": "SPINDLE LOAD", "column": "Spindle_Load", "pattern": "\\d+(?:\\.\\d+)?"}
+            ]
+          },
+          "headers": {
+            "PROBE REPORT": [{"label": "X ERROR", "column": "X_Error"}]
+          }
+        }
+
+    "pattern" is optional and defaults to the rest of the line.
+    """
+
+    def __init__(
+        self,
+        programs: Optional[Dict[str, List[Dict[str, str]]]] = None,
+        headers: Optional[Dict[str, List[Dict[str, str]]]] = None,
+    ) -> None:
+        """
+        Compile the schemas.
+
+        Args:
+            programs: Field lists keyed by program number.
+            headers: Field lists keyed by header line.
+
+        Raises:
+            ValueError: If a field has no label or column, or an invalid pattern.
+        """
+        self.programs: Dict[str, DprntParser] = {
+            program_key(program): self.compile(fields, program)
+            for program, fields in (programs or {}).items()
+        }
+        self.headers: Dict[str, DprntParser] = {
+            header_key(header): self.compile(fields, header)
+            for header, fields in (headers or {}).items()
+        }
+
+    @staticmethod
+    def compile(fields: List[Dict[str, str]], name: str) -> DprntParser:
+        """
+        Build the parser for one schema: the built-in fields plus the schema's.
+
+        Args:
+            fields: Field definitions with "label", "column" and optional "pattern".
+            name: Program number or header, for error messages.
+
+        Returns:
+            The compiled parser.
+
+        Raises:
+            ValueError: If a field has no label or column, or an invalid pattern.
+        """
+        extra = []
+        for field in fields:
+            if not field.get("label") or not field.get("column"):
+                raise ValueError(f"Schema {name}: every field needs a label and a column")
+            pattern = field.get("pattern", r"[^\]]*")
+            extra.append((field["label"], f"(?P<{field['column']}>{pattern})"))
+        try:
+            return DprntParser(DEFAULT_FIELDS + tuple(extra))
+        except re.error as e:
+            raise ValueError(f"Schema {name}: invalid pattern: {e}") from e
+
+    @classmethod
+    def load(cls, path: str) -> "SchemaRegistry":
+        """
+        Load and compile the schemas from a JSON file.
+
+        Args:
+            path: Path to the schema file.
+
+        Returns:
+            The compiled registry.
+
+        Raises:
+            FileNotFoundError: If the file does not exist.
+            ValueError: If the file is not valid JSON or a schema is invalid.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        return cls(config.get("programs"), config.get("headers"))
+
+    def parser_for(self, data: str) -> DprntParser:
+        """
+        Find the parser for a cycle from its program number or header line.
+
+        Args:
+            data: Raw data string of one cycle.
+
+        Returns:
+            The schema's parser, or the built-in parser if no schema matches.
+        """
+        if not self.programs and not self.headers:
+            return default_parser
+
+        header_seen = False
+        for number, line in enumerate(io.StringIO(data)):
+            if number >= IDENTIFY_LINES:
+                break
+            if self.programs:
+                match = PROGRAM_RE.match(line)
+                if match:
+                    parser = self.programs.get(program_key(match.group(1)))
+                    if parser is not None:
+                        return parser
+            if self.headers and not header_seen and line.strip(" \t\r\n*"):
+                header_seen = True
+                parser = self.headers.get(header_key(line))
+                if parser is not None:
+                    return parser
+
+        return default_parser
+
+    def parse(self, data: str) -> Dict[str, str]:
+        """
+        Extract the fields of a cycle with the schema of its program.
+
+        Args:
+            data: Raw data string of one cycle.
+
+        Returns:
+            Dictionary with every column of the matching schema.
+        """
+        return self.parser_for(data).parse(data)
@@ -0,0 +1,251 @@
+import linecache
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+# Stages timed by the loggers, in pipeline order
+STAGES = ("process_data", "parse_data_to_dict", "write_records")
+
+# Started stage: (wall clock, CPU time of the thread)
+Token = Tuple[float, float]
+
+
+class StageTotals:
+    """
+    Call count and sampled wall and CPU time of one stage.
+    """
+
+    def __init__(self) -> None:
+        """
+        Initialize the totals at zero.
+        """
+        self.calls = 0
+        self.timed = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+
+
+class StageProfiler:
+    """
+    Low-overhead profiler for the hot path of the logger.
+
+    Two things are recorded:
+
+    - Stage times. Every call of a stage is counted, and one call in sample_every
+      is timed with the wall clock and the CPU time of its thread, so the timing
+      costs a fraction of a microsecond per call on average. Totals are the timed
+      averages times the call count. Wall time well above CPU time means waiting,
+      on a locked file or a slow SMB share for example.
+    - Stacks. A daemon thread samples the stack of every thread every interval
+      seconds with sys._current_frames(), and counts them folded (one line per
+      stack, "thread;outer;...;inner count"), the input of flamegraph.pl and
+      speedscope. Frames are "function (file:line)" with the line being run.
+      Threads blocked in recv() or a file write show up too, on the line that
+      called it, so the flame graph shows where the time goes, not just the CPU.
+
+    dump() writes both to files. It runs when the logger stops, and on SIGUSR1
+    in the sampler thread, since the signal handler runs in the main thread and
+    could interrupt it while it holds the lock.
+    """
+
+    def __init__(
+        self,
+        directory: str = "profile",
+        name: str = "logger",
+        sample_every: int = 10,
+        interval: float = 0.01,
+    ) -> None:
+        """
+        Initialize the profiler. Call start() to start sampling stacks.
+
+        Args:
+            directory: Directory the summary and stack files are written to.
+            name: Name used in the file names, the machine name or "fleet".
+            sample_every: Time one call in this many of each stage.
+            interval: Seconds between stack samples.
+        """
+        self.directory = directory
+        self.name = name
+        self.sample_every = max(1, sample_every)
+        self.interval = interval
+        self.stages: Dict[str, StageTotals] = {
+            stage: StageTotals() for stage in STAGES
+        }
+        self.stacks: Dict[str, int] = {}
+        self.paths: Dict[str, str] = {}
+        self.samples = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._dump = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    def start_stage(self, stage: str) -> Optional[Token]:
+        """
+        Count a call of a stage and start timing it if it is sampled.
+
+        Args:
+            stage: One of STAGES.
+
+        Returns:
+            The token to pass to end_stage, or None if this call is not timed.
+        """
+        totals = self.stages[stage]
+        # The writer thread and the receive threads call the same stages
+        with self._lock:
+            totals.calls += 1
+            calls = totals.calls
+        if calls % self.sample_every:
+            return None
+        return time.perf_counter(), time.thread_time()
+
+    def end_stage(self, stage: str, token: Optional[Token]) -> None:
+        """
+        Stop timing a stage call started with start_stage.
+
+        Args:
+            stage: The stage passed to start_stage.
+            token: The token returned by start_stage.
+        """
+        if token is None:
+            return
+        wall = time.perf_counter() - token[0]
+        cpu = time.thread_time() - token[1]
+        totals = self.stages[stage]
+        with self._lock:
+            totals.timed += 1
+            totals.wall += wall
+            totals.cpu += cpu
+
+    def start(self) -> "StageProfiler":
+        """
+        Start the stack sampler thread and the SIGUSR1 handler.
+
+        Returns:
+            The profiler, so it can be created and started in one line.
+        """
+        if self._sampler is None:
+            self._sampler = threading.Thread(
+                target=self._sample_loop, name="profiler", daemon=True
+            )
+            self._sampler.start()
+        # Signal handlers can only be set from the main thread, and not on Windows
+        if (
+            hasattr(signal, "SIGUSR1")
+            and threading.current_thread() is threading.main_thread()
+        ):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self._dump.set())
+        print(
+            f"[profile] Profiling, 1 in {self.sample_every} calls timed, stacks every"
+            f" {self.interval * 1000:.0f} ms"
+        )
+        print(f"[profile] Saved to {self.directory}/ on SIGUSR1 and at exit")
+        return self
+
+    def _sample_loop(self) -> None:
+        """
+        Sample the stack of every other thread until close() is called, and dump
+        the profile when SIGUSR1 asked for it.
+        """
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            if self._dump.is_set():
+                self._dump.clear()
+                self.dump()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    filename = os.path.basename(code.co_filename)
+                    self.paths[filename] = code.co_filename
+                    stack.append(f"{code.co_name} ({filename}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).replace(";", ":"))
+                key = ";".join(reversed(stack))
+                with self._lock:
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def summary(self) -> List[str]:
+        """
+        Summarize the stage times and the functions the threads were in most.
+
+        Returns:
+            The lines of the summary.
+        """
+        elapsed = time.monotonic() - self.started
+        lines = [
+            f"Profile of {self.name}, {elapsed:.0f}s, 1 in {self.sample_every} calls timed,"
+            f" {self.samples} stack samples",
+            "",
+            f"{'stage':<20} {'calls':>10} {'wall s':>10} {'cpu s':>10}"
+            f" {'wall us/call':>13} {'cpu us/call':>12}",
+        ]
+        with self._lock:
+            for stage, totals in self.stages.items():
+                wall = totals.wall / totals.timed if totals.timed else 0.0
+                cpu = totals.cpu / totals.timed if totals.timed else 0.0
+                lines.append(
+                    f"{stage:<20} {totals.calls:>10,} {wall * totals.calls:>10.3f}"
+                    f" {cpu * totals.calls:>10.3f} {wall * 1e6:>13.1f} {cpu * 1e6:>12.1f}"
+                )
+            leaves: Dict[str, int] = {}
+            for stack, count in self.stacks.items():
+                leaf = stack.rsplit(";", 1)[-1]
+                leaves[leaf] = leaves.get(leaf, 0) + count
+
+        total = sum(leaves.values()) or 1
+        lines += [
+            "",
+            "Functions the threads were in (share of stack samples, waiting included):",
+        ]
+        for leaf, count in sorted(leaves.items(), key=lambda item: -item[1])[:15]:
+            # The source line shows what a thread was waiting for, ex. recv()
+            filename, _, lineno = leaf.rpartition(" (")[2].rstrip(")").partition(":")
+            source = linecache.getline(self.paths.get(filename, filename), int(lineno))
+            lines.append(f"{count / total:7.1%}  {leaf:<45} {source.strip()}")
+        return lines
+
+    def dump(self) -> Optional[str]:
+        """
+        Write the summary and the folded stacks, and print the summary.
+
+        Returns:
+            Path of the summary file, or None if it could not be written.
+        """
+        lines = self.summary()
+        for line in lines:
+            print(f"[profile] {line}")
+
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        base = os.path.join(self.directory, f"{self.name}_{timestamp}")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(f"{base}.txt", "w") as f:
+                f.write("\n".join(lines) + "\n")
+            with self._lock:
+                stacks = sorted(self.stacks.items())
+            with open(f"{base}.folded", "w") as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in stacks)
+        except OSError as e:
+            print(f"[profile] ERROR: Could not write the profile: {e}")
+            return None
+        print(f"[profile] Saved to {base}.txt and {base}.folded")
+        return f"{base}.txt"
+
+    def close(self) -> None:
+        """
+        Stop sampling and write the final profile.
+        """
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+        self.dump()
@@ -0,0 +1,227 @@
+"""
+Server mode on one event loop: the machines connect to the logger.
+
+# Listen on port 5062 for one machine
+python haas_logger2.py -p 5062 -n st30l
+
+# Listen for three machines on their own ports, from one process
+python haas_logger2.py --ports 5050=st30l 5051=st40 5052=vf2ss -a
+
+# Connections per second and memory per connection against a thread per connection
+python haas_benchmark.py server --connections 500
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from haas_net import ServerSettings, enable_keepalive
+
+if TYPE_CHECKING:
+    from haas_logger2 import HaasDataLogger
+
+
+def parse_port_map(values: List[str]) -> Dict[int, str]:
+    """
+    Parse the machines of a multi-port server, given as PORT=NAME.
+
+    Args:
+        values: PORT=NAME items, ex. ["5050=st30l", "5051=st40"]. A port without
+        a name gets the default name Machine_Port<port>.
+
+    Returns:
+        Machine name by port, in the given order.
+
+    Raises:
+        ValueError: If a port is not a number or is given twice.
+    """
+    machines: Dict[int, str] = {}
+    for value in values:
+        port_text, _, name = value.partition("=")
+        try:
+            port = int(port_text)
+        except ValueError:
+            raise ValueError(f"{value!r} is not PORT=NAME") from None
+        if port in machines:
+            raise ValueError(f"port {port} is given twice")
+        machines[port] = name.strip() or f"Machine_Port{port}"
+    return machines
+
+
+def save_executors(loggers: List["HaasDataLogger"]) -> List[ThreadPoolExecutor]:
+    """
+    Give every logger without a writer thread a save thread of its own.
+
+    Without the writer, process_stream saves cycles in a worker thread, where a
+    file locked by Excel sleeps through its retries. In the default executor of the
+    event loop, a few locked files would hold up the saves of every other machine.
+    With one thread per machine, the saves of a machine only wait for each other,
+    and the threads are bounded by the number of machines.
+
+    Args:
+        loggers: The loggers of one event loop.
+
+    Returns:
+        The executors, to shut down when the loop ends. Empty if every logger has
+        a writer.
+    """
+    executors = []
+    for logger in loggers:
+        if logger.writer is None:
+            logger.save_executor = ThreadPoolExecutor(
+                1, thread_name_prefix=f"save-{logger.machine_name}"
+            )
+            executors.append(logger.save_executor)
+    return executors
+
+
+class MachineServer:
+    """
+    Accepts and reads the connections of machines on non-blocking sockets.
+
+    Every connection is a task of one asyncio event loop instead of a thread, so
+    an idle connection costs its socket and read buffer. Each logger listens on
+    its own port, and a connection belongs to the machine of the port it came in
+    on, so one process serves a port per machine. The settings bound what the
+    connections can hold on to: reading pauses when buffer_limit bytes wait for
+    the parser, and connections above max_connections, counted over all ports,
+    are closed as soon as they are accepted.
+    """
+
+    def __init__(
+        self,
+        loggers: List["HaasDataLogger"],
+        settings: Optional[ServerSettings] = None,
+    ) -> None:
+        """
+        Initialize the server. Call start() to start listening.
+
+        Args:
+            loggers: One logger per machine, on different ports. Their host and
+            port are listened on, their idle timeout and keepalive apply to
+            their connections.
+            settings: Backlog and limits. If None, the ServerSettings defaults are
+            used.
+        """
+        self.loggers = loggers
+        self.settings = settings or ServerSettings()
+        self.active = 0
+
+    async def handle_connection(
+        self,
+        logger: "HaasDataLogger",
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        """
+        Read one accepted connection until it closes.
+
+        Args:
+            logger: The logger of the port the connection came in on.
+            reader: Stream reader of the connection.
+            writer: Stream writer of the connection, only used to close it.
+        """
+        peer = writer.get_extra_info("peername")
+        address: Tuple[str, int] = (peer[0], peer[1]) if peer else ("unknown", 0)
+
+        if self.active >= self.settings.max_connections:
+            logger.metrics.rejected_connections += 1
+            print(
+                f"[{logger.machine_name}] Too many connections ({self.active}), closed the connection from {address}"
+            )
+            writer.close()
+            return
+
+        self.active += 1
+        print(f"[{logger.machine_name}] Connection established from {address}")
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            # Machines switched off while connected would hold a slot forever
+            settings = logger.connection
+            enable_keepalive(
+                sock,
+                settings.keepalive_idle,
+                settings.keepalive_interval,
+                settings.keepalive_count,
+            )
+        try:
+            await logger.process_stream(reader, address)
+        except Exception as e:
+            print(f"[{logger.machine_name}] Error processing data from {address}: {e}")
+        finally:
+            self.active -= 1
+            writer.close()
+            print(f"[{logger.machine_name}] Connection closed")
+
+    async def run(self) -> None:
+        """
+        Listen on every port and serve connections until cancelled.
+
+        A port that can't be listened on, in use by another logger for example,
+        is reported and the other machines are served anyway.
+
+        Raises:
+            OSError: If none of the ports can be listened on.
+        """
+        servers: List[asyncio.AbstractServer] = []
+        for logger in self.loggers:
+            logger.running = True
+            try:
+                servers.append(
+                    await asyncio.start_server(
+                        partial(self.handle_connection, logger),
+                        logger.host,
+                        logger.port,
+                        backlog=self.settings.backlog,
+                        limit=self.settings.buffer_limit,
+                        reuse_address=True,
+                    )
+                )
+            except OSError as e:
+                if len(self.loggers) == 1:
+                    raise
+                print(
+                    f"[{logger.machine_name}] Server error: can't listen on {logger.host}:{logger.port}: {e}"
+                )
+                continue
+            if len(self.loggers) == 1:
+                logger.announce_server()
+            else:
+                mode_str = "APPEND mode" if logger.append_mode else "NEW FILE mode"
+                print(
+                    f"[server]   {logger.machine_name}: {logger.host}:{logger.port} ({mode_str})"
+                )
+        if not servers:
+            raise OSError("none of the ports could be listened on")
+        if len(self.loggers) > 1:
+            print(
+                f"[server] Waiting for connections on {len(servers)} port(s), press Ctrl+C to stop"
+            )
+
+        executors = save_executors(self.loggers)
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
+            # Saves already running finish, their cycles are not lost
+            for executor in executors:
+                executor.shutdown()
+
+    def start(self) -> None:
+        """
+        Serve connections and block until Ctrl+C.
+
+        Raises:
+            KeyboardInterrupt: On Ctrl+C, after every connection was closed.
+        """
+        name = self.loggers[0].machine_name if len(self.loggers) == 1 else "server"
+        try:
+            asyncio.run(self.run())
+        except OSError as e:
+            print(f"[{name}] Server error: {e}")
+        finally:
+            for logger in self.loggers:
+                logger.running = False
+            print(f"[{name}] Server stopped")
@@ -15,8 +15,14 @@ python haas_simulator.py -H localhost -p “265-4183” --delay 2
 import socket
 import time
 import argparse
+import asyncio
+import csv
+import os
+import random
 from datetime import datetime
 
+from haas_capture import find_captures, read_capture
+
 class HaasCNCSimulator:
     def __init__(self, host, port, delay=1.0):
         self.host = host
@@ -99,6 +105,305 @@ M30
         except Exception as e:
             print(f"Error: {e}")
 
+class LoadGenerator:
+    """Simulate a fleet of machines producing cycles and measure the logger
+
+    Each simulated machine sends a DPRNT cycle every interval seconds, either by
+    connecting to a server mode logger or by listening on its own port for a
+    client mode logger (haas_fleet.py). The send time is printed as the revision
+    (REV.), so watching the logger's output directory gives the end-to-end
+    latency from send to row on disk.
+    """
+
+    def __init__(self, host, port, machines=10, interval=5.0, size=300, burst=1,
+                 disconnect_rate=0.0, duration=60.0, port_step=1, listen=False,
+                 watch_dir=None):
+        self.host = host
+        self.port = port
+        self.machines = machines
+        self.interval = interval
+        self.size = size
+        self.burst = max(1, burst)
+        self.disconnect_rate = disconnect_rate
+        self.duration = duration
+        self.port_step = port_step
+        self.listen = listen
+        self.watch_dir = watch_dir
+
+        self.sent = 0
+        self.disconnects = 0
+        self.connect_errors = 0
+        self.latencies = []
+        self.counters = [0] * machines
+        self.offsets = {}
+        self.headers = {}
+
+    def machine_port(self, index):
+        """Port of a simulated machine, port_step 0 puts every machine on one port"""
+        return self.port + index * self.port_step
+
+    def make_cycle(self, index):
+        """Build one cycle as the control prints it, padded to the payload size"""
+        self.counters[index] += 1
+        now = datetime.now()
+        lines = [
+            f" PART NUMBER: LOAD-{index:03d}, REV. {time.time():.3f}\r\n",
+            f" DATE YYMMDD: {now:%y%m%d}\r\n",
+            f" TIME HHMMSS: {now:%H%M%S}\r\n",
+            f" PARTS MADE: {self.counters[index]}\r\n",
+            f" TIME, LAST PART: {self.interval:.0f} SECONDS\r\n",
+        ]
+        length = sum(len(line) for line in lines)
+        n = 0
+        while length < self.size:
+            line = f" PROBE {n:05d} X: {random.uniform(-0.01, 0.01):+.4f} Z: 0.0000\r\n"
+            lines.append(line)
+            length += len(line)
+            n += 1
+        lines.append(" End of Cycle\r\n")
+        return "".join(lines).encode('utf-8')
+
+    async def stream(self, index, writer, deadline):
+        """Send cycles on one connection until the deadline or an injected disconnect"""
+        loop = asyncio.get_running_loop()
+        # Spread the machines out instead of sending all at the same moment
+        await asyncio.sleep(random.uniform(0, self.interval * self.burst))
+        while loop.time() < deadline:
+            data = b"".join(self.make_cycle(index) for _ in range(self.burst))
+            if random.random() < self.disconnect_rate:
+                # Drop the connection halfway through a cycle
+                writer.write(data[:len(data) // 2])
+                await writer.drain()
+                self.disconnects += 1
+                return False
+            writer.write(data)
+            await writer.drain()
+            self.sent += self.burst
+            await asyncio.sleep(self.interval * self.burst)
+        return True
+
+    async def run_client(self, index, deadline):
+        """Connect to a server mode logger as one machine, reconnecting after a drop"""
+        loop = asyncio.get_running_loop()
+        while loop.time() < deadline:
+            try:
+                _, writer = await asyncio.open_connection(self.host, self.machine_port(index))
+            except OSError:
+                self.connect_errors += 1
+                await asyncio.sleep(1.0)
+                continue
+            try:
+                if await self.stream(index, writer, deadline):
+                    return
+            except OSError:
+                self.connect_errors += 1
+            finally:
+                writer.close()
+
+    async def run_server(self, index, deadline):
+        """Listen as one machine for a client mode logger"""
+        loop = asyncio.get_running_loop()
+
+        async def handle(reader, writer):
+            try:
+                await self.stream(index, writer, deadline)
+            except OSError:
+                self.connect_errors += 1
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, self.host, self.machine_port(index))
+        async with server:
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+    def read_new_rows(self, path):
+        """Read the rows appended to a CSV file since the last poll"""
+        offset = self.offsets.get(path, 0)
+        try:
+            with open(path, newline='') as f:
+                f.seek(offset)
+                text = f.read()
+        except OSError:
+            return []
+        # Only complete lines, the rest is read on the next poll
+        end = text.rfind('\n') + 1
+        if not end:
+            return []
+        self.offsets[path] = offset + len(text[:end].encode('utf-8'))
+        rows = list(csv.reader(text[:end].splitlines()))
+        if offset == 0 and rows:
+            self.headers[path] = rows.pop(0)
+        header = self.headers.get(path, [])
+        return [dict(zip(header, row)) for row in rows]
+
+    async def watch(self, start, sending_until, deadline):
+        """Poll the logger's output directory and record send-to-disk latencies"""
+        loop = asyncio.get_running_loop()
+        while loop.time() < deadline:
+            if loop.time() > sending_until and len(self.latencies) >= self.sent:
+                break
+            now = time.time()
+            for dirpath, _, filenames in os.walk(self.watch_dir):
+                for filename in filenames:
+                    if not filename.endswith('.csv') or filename.startswith('.'):
+                        continue
+                    for row in self.read_new_rows(os.path.join(dirpath, filename)):
+                        if not row.get('Part_Number', '').startswith('LOAD-'):
+                            continue
+                        try:
+                            sent = float(row.get('Revision', ''))
+                        except ValueError:
+                            continue
+                        if sent >= start:
+                            self.latencies.append(now - sent)
+            await asyncio.sleep(0.1)
+
+    async def report_progress(self, start, deadline):
+        """Print the cycle rate every 5 seconds"""
+        loop = asyncio.get_running_loop()
+        while loop.time() < deadline:
+            await asyncio.sleep(5.0)
+            elapsed = time.time() - start
+            print(f"[load] {elapsed:5.0f}s sent {self.sent} ({self.sent / elapsed:.1f}/s), "
+                  f"on disk {len(self.latencies)}, disconnects {self.disconnects}, "
+                  f"connect errors {self.connect_errors}")
+
+    async def run(self):
+        """Run every simulated machine for the configured duration"""
+        loop = asyncio.get_running_loop()
+        start = time.time()
+        deadline = loop.time() + self.duration
+        run_machine = self.run_server if self.listen else self.run_client
+        tasks = [run_machine(index, deadline) for index in range(self.machines)]
+        helpers = [asyncio.ensure_future(self.report_progress(start, deadline))]
+        if self.watch_dir:
+            # Keep watching a little longer for the last cycles to be written
+            helpers.append(asyncio.ensure_future(self.watch(start, deadline, deadline + 10.0)))
+        await asyncio.gather(*tasks)
+        await asyncio.gather(*helpers)
+        return time.time() - start
+
+    def report(self, elapsed):
+        """Print the achieved rate and the latency percentiles"""
+        sending = min(elapsed, self.duration)
+        print(f"\n[load] {self.machines} machine(s), {self.duration:.0f}s")
+        print(f"[load] Sent: {self.sent} cycles, {self.sent / sending:.1f} cycles/s")
+        print(f"[load] Injected disconnects: {self.disconnects}, connect errors: {self.connect_errors}")
+        if not self.watch_dir:
+            return
+        print(f"[load] On disk: {len(self.latencies)} cycles ({self.sent - len(self.latencies)} missing)")
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            def percentile(p):
+                return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+            print(f"[load] Send to disk latency: p50 {percentile(0.5) * 1000:.0f} ms, "
+                  f"p95 {percentile(0.95) * 1000:.0f} ms, p99 {percentile(0.99) * 1000:.0f} ms, "
+                  f"max {latencies[-1] * 1000:.0f} ms (+/- 100 ms polling)")
+
+
+class CaptureReplayer:
+    """Play captures recorded by the logger (--record) back to it
+
+    Every recorded chunk is sent with its own write, at the recorded time divided
+    by the speed, or back to back with speed 0. The captures of one machine are
+    played one after the other, each on a new connection like the original,
+    different machines play at the same time. As with the load test, each machine
+    either connects to the logger (port + index x port_step) or listens there for
+    a client mode logger.
+    """
+
+    def __init__(self, host, port, paths, speed=1.0, port_step=1, listen=False):
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.port_step = port_step
+        self.listen = listen
+
+        # machine -> [(path, chunks)], in recording order
+        self.machines = {}
+        for path in find_captures(paths):
+            metadata, chunks = read_capture(path)
+            self.machines.setdefault(metadata.get('machine', ''), []).append((path, chunks))
+        self.recorded = sum(chunks[-1][0] for captures in self.machines.values()
+                            for _, chunks in captures if chunks)
+
+        self.chunks = 0
+        self.bytes = 0
+        self.connect_errors = 0
+
+    async def play(self, path, chunks, writer):
+        """Send the chunks of one capture on an open connection"""
+        loop = asyncio.get_running_loop()
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            # Send each chunk in its own segment instead of waiting to fill one
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print(f"[replay] {path}: {len(chunks)} chunks")
+        start = loop.time()
+        for elapsed, data in chunks:
+            if self.speed > 0:
+                delay = start + elapsed / self.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            writer.write(data)
+            await writer.drain()
+            self.chunks += 1
+            self.bytes += len(data)
+
+    async def run_client(self, index, captures):
+        """Replay the captures of one machine to a server mode logger"""
+        for path, chunks in captures:
+            while True:
+                try:
+                    _, writer = await asyncio.open_connection(self.host, self.port + index * self.port_step)
+                    break
+                except OSError:
+                    self.connect_errors += 1
+                    await asyncio.sleep(1.0)
+            try:
+                await self.play(path, chunks, writer)
+            finally:
+                writer.close()
+
+    async def run_server(self, index, captures):
+        """Replay the captures of one machine to a client mode logger, one per connection"""
+        remaining = list(captures)
+        done = asyncio.Event()
+
+        async def handle(reader, writer):
+            if not remaining:
+                writer.close()
+                return
+            path, chunks = remaining.pop(0)
+            try:
+                await self.play(path, chunks, writer)
+            finally:
+                writer.close()
+                if not remaining:
+                    done.set()
+
+        server = await asyncio.start_server(handle, self.host, self.port + index * self.port_step)
+        async with server:
+            await done.wait()
+
+    async def run(self):
+        """Replay every machine's captures"""
+        start = time.time()
+        run_machine = self.run_server if self.listen else self.run_client
+        await asyncio.gather(*(run_machine(index, captures)
+                               for index, captures in enumerate(self.machines.values())))
+        return time.time() - start
+
+    def report(self, elapsed):
+        """Print the replay rate"""
+        elapsed = max(elapsed, 1e-9)
+        print(f"\n[replay] {len(self.machines)} machine(s), {self.chunks} chunks, {self.bytes:,} bytes "
+              f"in {elapsed:.2f}s: {self.chunks / elapsed:,.0f} chunks/s, "
+              f"{self.bytes / elapsed / 1e6:.2f} MB/s")
+        print(f"[replay] {self.recorded:.1f}s of recordings played {self.recorded / elapsed:.1f}x as fast, "
+              f"connect errors: {self.connect_errors}")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Haas CNC Simulator - Send test data to the logger',
@@ -116,6 +421,19 @@ Examples:
 
   # Multiple sends with delay
   python haas_simulator.py -H localhost -p "265-4183" --delay 2
+
+  # Load test: 40 machines on ports 5062-5101, a cycle every 5 seconds each,
+  # against server mode loggers writing to cnc_logs
+  python haas_simulator.py -H localhost --load 40 --interval 5 --watch cnc_logs
+
+  # Load test: listen as 40 machines for haas_fleet.py, drop 1% of connections
+  python haas_simulator.py -H 0.0.0.0 --load 40 --listen --disconnect-rate 0.01
+
+  # Replay what the logger recorded with --record, 10 times as fast
+  python haas_simulator.py -H localhost --replay captures/st30l --speed 10
+
+  # Replay every machine as fast as possible, each to its own port
+  python haas_simulator.py -H localhost --replay captures --speed 0
         '''
     )
 
@@ -159,8 +477,102 @@ Examples:
         help='Delay in seconds after sending data (default: 1.0)'
     )
 
+    load = parser.add_argument_group('load test')
+    load.add_argument(
+        '--load',
+        type=int,
+        metavar='N',
+        help='Simulate N machines sending cycles for --duration seconds'
+    )
+    load.add_argument(
+        '--listen',
+        action='store_true',
+        help='Listen as the machines (for client mode loggers) instead of connecting to the logger, also for --replay'
+    )
+    load.add_argument(
+        '--port-step',
+        type=int,
+        default=1,
+        help='Port difference between machines, 0 sends every machine to --port (default: 1), also for --replay'
+    )
+    load.add_argument(
+        '--interval',
+        type=float,
+        default=5.0,
+        help='Seconds between cycles of one machine (default: 5)'
+    )
+    load.add_argument(
+        '--size',
+        type=int,
+        default=300,
+        help='Cycle size in bytes, padded with probe lines (default: 300)'
+    )
+    load.add_argument(
+        '--burst',
+        type=int,
+        default=1,
+        help='Cycles sent back to back in one write, every burst x interval seconds (default: 1)'
+    )
+    load.add_argument(
+        '--disconnect-rate',
+        type=float,
+        default=0.0,
+        help='Chance per send of dropping the connection halfway through a cycle (default: 0)'
+    )
+    load.add_argument(
+        '--duration',
+        type=float,
+        default=60.0,
+        help='Seconds to run the load test (default: 60)'
+    )
+    load.add_argument(
+        '--watch',
+        metavar='DIR',
+        help="Logger output directory to watch for the cycles, to measure send to disk latency"
+    )
+
+    replay = parser.add_argument_group('replay')
+    replay.add_argument(
+        '--replay',
+        nargs='+',
+        metavar='CAPTURE',
+        help='Replay captures recorded by the logger with --record (files or directories)'
+    )
+    replay.add_argument(
+        '--speed',
+        type=float,
+        default=1.0,
+        help='Replay speed, 1 is real time, 10 is ten times as fast, 0 is as fast as possible (default: 1)'
+    )
+
     args = parser.parse_args()
 
+    if args.replay:
+        replayer = CaptureReplayer(args.host, args.port, args.replay, args.speed,
+                                   args.port_step, args.listen)
+        if not replayer.machines:
+            parser.error('no captures found in ' + ' '.join(args.replay))
+        if args.listen and args.port_step == 0 and len(replayer.machines) > 1:
+            parser.error('--listen needs a different port per machine (--port-step 1)')
+        try:
+            replayer.report(asyncio.run(replayer.run()))
+        except KeyboardInterrupt:
+            print("\nStopped")
+        raise SystemExit(0)
+
+    if args.load:
+        if args.listen and args.port_step == 0 and args.load > 1:
+            parser.error('--listen needs a different port per machine (--port-step 1)')
+        generator = LoadGenerator(
+            args.host, args.port, args.load, args.interval, args.size, args.burst,
+            args.disconnect_rate, args.duration, args.port_step, args.listen, args.watch
+        )
+        try:
+            generator.report(asyncio.run(generator.run()))
+        except KeyboardInterrupt:
+            print("\nStopped")
+        raise SystemExit(0)
+
     simulator = HaasCNCSimulator(args.host, args.port, args.delay)
 
     if args.file:
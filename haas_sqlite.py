@@ -0,0 +1,535 @@
+"""
+SQLite storage for the Haas CNC Data Logger.
+
+# Average cycle time per machine and part since a date
+python haas_sqlite.py stats --since 2025-12-01
+
+# Write the CSV files of one part from the database
+python haas_sqlite.py export --part 265-4183 --out cnc_logs
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from haas_layout import PathLayout
+from haas_storage import read_csv_header, read_csv_rows
+
+# A parsed cycle: (part_number, parsed_data)
+Record = Tuple[Optional[str], Dict[str, str]]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cycles (
+    id INTEGER PRIMARY KEY,
+    cycle_id TEXT,
+    machine TEXT NOT NULL,
+    part_number TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    revision TEXT,
+    parts_counter INTEGER,
+    last_part_seconds REAL,
+    fields TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cycles_machine_part_time
+    ON cycles (machine, part_number, timestamp);
+CREATE UNIQUE INDEX IF NOT EXISTS cycles_cycle_id
+    ON cycles (cycle_id);
+CREATE TABLE IF NOT EXISTS exports (
+    output_dir TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL
+);
+"""
+
+
+def _number(value: str, kind: type) -> Optional[float]:
+    """
+    Convert a parsed field to a number for the indexed columns.
+
+    Args:
+        value: Field value, possibly empty.
+        kind: int or float.
+
+    Returns:
+        The number, or None if the field is empty or not a number.
+    """
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SqliteStore:
+    """
+    Cycle storage in a local SQLite database.
+
+    Every cycle is one row with the machine, part number and receive timestamp in
+    indexed columns, the part counter and last part time as numbers, and the full
+    parsed row (all columns, in order) as JSON. The database runs in WAL mode, so
+    queries and exports read while the logger writes, and each batch of cycles is
+    written in one transaction.
+
+    Each cycle is stored with the id it was given when it was received (see
+    haas_storage.new_cycle_id). A cycle whose id is already stored is ignored, so
+    replaying the journal after a crash never stores a cycle twice, while two
+    cycles with identical values received in the same second are both kept.
+
+    The store is shared by every logger in a process and is thread safe.
+    """
+
+    def __init__(self, path: str = "cnc_data.db") -> None:
+        """
+        Open (or create) the database.
+
+        Args:
+            path: Database file.
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # WAL with synchronous=NORMAL survives a crash of the process; only a
+        # power loss can drop the last transactions, which the journal replays
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        self.conn.executescript(SCHEMA)
+
+    def _migrate(self) -> None:
+        """
+        Add the cycle_id column to a database created without it.
+
+        Such a database made cycles unique by their values, which dropped
+        identical cycles received in the same second. Its unique index is removed
+        and the cycles stored so far keep an empty id.
+        """
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(cycles)")]
+        if columns and "cycle_id" not in columns:
+            with self.conn:
+                self.conn.execute("ALTER TABLE cycles ADD COLUMN cycle_id TEXT")
+                self.conn.execute("DROP INDEX IF EXISTS cycles_unique")
+
+    def write_records(
+        self, records: List[Record], cycle_ids: Optional[List[str]] = None
+    ) -> int:
+        """
+        Store a batch of parsed cycles in one transaction.
+
+        Args:
+            records: List of (part_number, parsed_data) tuples from parse_cycles.
+            cycle_ids: The id of each record. If None, the records are stored
+            without ids and never recognized as already stored.
+
+        Returns:
+            Number of cycles stored. Cycles that were already stored are not counted.
+        """
+        rows = self._rows(records, cycle_ids)
+        with self._lock, self.conn:
+            return self._insert(rows)
+
+    def replace_records(self, records: List[Record], cycle_ids: List[str]) -> int:
+        """
+        Store cycles parsed again from the archive in place of their stored version,
+        in one transaction.
+
+        Each cycle replaces the stored cycle with the same id, and is added if it
+        is missing. Stored cycles that are not in records are kept, so a cycle
+        that never made it into the archive is never lost. The next export_new()
+        rewrites the exported files in full, since appending cannot replace their
+        rows.
+
+        Args:
+            records: List of (part_number, parsed_data) tuples.
+            cycle_ids: The id of each record, from the archive index.
+
+        Returns:
+            Number of cycles stored or replaced.
+        """
+        rows = self._rows(records, cycle_ids)
+        with self._lock, self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT INTO cycles (cycle_id, machine, part_number, timestamp,"
+                " revision, parts_counter, last_part_seconds, fields)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (cycle_id) DO UPDATE SET machine = excluded.machine,"
+                " part_number = excluded.part_number, timestamp = excluded.timestamp,"
+                " revision = excluded.revision, parts_counter = excluded.parts_counter,"
+                " last_part_seconds = excluded.last_part_seconds,"
+                " fields = excluded.fields",
+                rows,
+            )
+            changed = self.conn.total_changes - before
+            if changed:
+                self.conn.execute("DELETE FROM exports")
+            return changed
+
+    @staticmethod
+    def _rows(
+        records: List[Record], cycle_ids: Optional[List[str]] = None
+    ) -> List[Tuple]:
+        """
+        Convert parsed cycles and their ids to table rows.
+        """
+        ids: List[Optional[str]] = (
+            list(cycle_ids) if cycle_ids is not None else [None] * len(records)
+        )
+        return [
+            (
+                cycle_id,
+                parsed_data["Machine"],
+                part_number or "unknown_part",
+                parsed_data["Timestamp"],
+                parsed_data.get("Revision", ""),
+                _number(parsed_data.get("Parts_Counter", ""), int),
+                _number(parsed_data.get("Last_Part_Time_Seconds", ""), float),
+                json.dumps(parsed_data),
+            )
+            for (part_number, parsed_data), cycle_id in zip(records, ids)
+        ]
+
+    def _insert(self, rows: List[Tuple]) -> int:
+        """
+        Insert table rows, skipping cycles whose id is stored. The lock and a
+        transaction must be held.
+
+        Returns:
+            Number of rows inserted.
+        """
+        before = self.conn.total_changes
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO cycles (cycle_id, machine, part_number,"
+            " timestamp, revision, parts_counter, last_part_seconds, fields)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        return self.conn.total_changes - before
+
+    def cycles(
+        self,
+        machine: Optional[str] = None,
+        part_number: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        after_id: int = 0,
+    ) -> Iterator[Tuple[int, str, str, Dict[str, str]]]:
+        """
+        Stored cycles in (machine, part number, timestamp) order.
+
+        Args:
+            machine: Only this machine.
+            part_number: Only this part number.
+            since: Only cycles received at or after this time (YYYY-mm-dd[ HH:MM:SS]).
+            until: Only cycles received before this time.
+            after_id: Only cycles stored after the cycle with this id.
+
+        Yields:
+            Tuples of (id, machine, part_number, parsed_data).
+        """
+        where, params = self._where(machine, part_number, since, until, after_id)
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id, machine, part_number, fields FROM cycles"
+                f" {where} ORDER BY machine, part_number, timestamp, id",
+                params,
+            ).fetchall()
+        for row_id, row_machine, row_part, fields in rows:
+            yield row_id, row_machine, row_part, json.loads(fields)
+
+    @staticmethod
+    def _where(
+        machine: Optional[str],
+        part_number: Optional[str],
+        since: Optional[str],
+        until: Optional[str],
+        after_id: int = 0,
+    ) -> Tuple[str, List]:
+        """
+        Build the WHERE clause for the query filters.
+
+        Returns:
+            Tuple of (clause, parameters). The clause is empty without filters.
+        """
+        conditions = []
+        params: List = []
+        for condition, value in (
+            ("machine = ?", machine),
+            ("part_number = ?", part_number),
+            ("timestamp >= ?", since),
+            ("timestamp < ?", until),
+            ("id > ?", after_id or None),
+        ):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        return ("WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+    def stats(
+        self,
+        machine: Optional[str] = None,
+        part_number: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+    ) -> List[Tuple[str, str, int, Optional[float], str, str]]:
+        """
+        Cycle count and average last part time per machine and part.
+
+        Args:
+            machine: Only this machine.
+            part_number: Only this part number.
+            since: Only cycles received at or after this time.
+            until: Only cycles received before this time.
+
+        Returns:
+            Rows of (machine, part_number, cycles, average seconds, first, last).
+        """
+        where, params = self._where(machine, part_number, since, until)
+        with self._lock:
+            return self.conn.execute(
+                "SELECT machine, part_number, COUNT(*), AVG(last_part_seconds),"
+                " MIN(timestamp), MAX(timestamp) FROM cycles"
+                f" {where} GROUP BY machine, part_number ORDER BY machine, part_number",
+                params,
+            ).fetchall()
+
+    def export_csv(
+        self,
+        output_dir: str = "cnc_logs",
+        machine: Optional[str] = None,
+        part_number: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        layout: Optional[PathLayout] = None,
+    ) -> List[str]:
+        """
+        Write one CSV file per machine and part, named like the append mode files.
+
+        Each file is written to a hidden temp file and renamed over the old one, so
+        a reader never sees a half-written file.
+
+        Args:
+            output_dir: Directory the CSV files are written to.
+            machine: Only this machine.
+            part_number: Only this part number.
+            since: Only cycles received at or after this time.
+            until: Only cycles received before this time.
+            layout: Subdirectories of output_dir the files are sorted into, as
+            the logger does. If None, every file is written to output_dir.
+
+        Returns:
+            Paths of the files written.
+        """
+        groups: Dict[str, List[Dict[str, str]]] = {}
+        for _, row_machine, row_part, parsed_data in self.cycles(
+            machine, part_number, since, until
+        ):
+            filepath = _export_path(
+                output_dir, layout, row_machine, row_part, parsed_data
+            )
+            groups.setdefault(filepath, []).append(parsed_data)
+
+        for filepath, rows in groups.items():
+            _write_csv(filepath, rows)
+        return list(groups)
+
+    def export_new(
+        self, output_dir: str = "cnc_logs", layout: Optional[PathLayout] = None
+    ) -> List[str]:
+        """
+        Append the cycles stored since the last export to their CSV files.
+
+        Meant to run periodically on the writer thread so consumers of the CSV
+        files keep working with the database backend. The id of the last exported
+        cycle is kept in the database per output directory, so the cost is the
+        new cycles, not the history. The first export to a directory, and the
+        first after replace_records(), writes every file in full, and so does a
+        file that was removed or whose columns no longer fit.
+
+        Args:
+            output_dir: Directory the CSV files are written to.
+            layout: Subdirectories of output_dir the files are sorted into, as
+            the logger does. If None, every file is written to output_dir.
+
+        Returns:
+            Paths of the files written.
+        """
+        with self._lock:
+            exported = self.conn.execute(
+                "SELECT last_id FROM exports WHERE output_dir = ?", (output_dir,)
+            ).fetchone()
+            last_id = self.conn.execute("SELECT MAX(id) FROM cycles").fetchone()[0]
+        last_id = last_id or 0
+
+        if exported is None:
+            written = self.export_csv(output_dir, layout=layout)
+        else:
+            groups: Dict[str, Tuple[str, str, List[Dict[str, str]]]] = {}
+            for row_id, machine, part_number, parsed_data in self.cycles(
+                after_id=exported[0]
+            ):
+                # Stored after MAX(id) was read, exported next time
+                if row_id > last_id:
+                    continue
+                filepath = _export_path(
+                    output_dir, layout, machine, part_number, parsed_data
+                )
+                groups.setdefault(filepath, (machine, part_number, []))[2].append(
+                    parsed_data
+                )
+
+            # A removed file is written again from every stored cycle of its part
+            rewrite = {
+                (machine, part_number)
+                for filepath, (machine, part_number, _) in groups.items()
+                if not os.path.isfile(filepath)
+            }
+            written = []
+            for machine, part_number in sorted(rewrite):
+                written.extend(
+                    self.export_csv(output_dir, machine, part_number, layout=layout)
+                )
+            for filepath, (machine, part_number, rows) in groups.items():
+                if (machine, part_number) not in rewrite:
+                    _append_csv(filepath, rows)
+                    written.append(filepath)
+
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO exports (output_dir, last_id) VALUES (?, ?)",
+                (output_dir, last_id),
+            )
+        return written
+
+    def close(self) -> None:
+        """
+        Close the database.
+        """
+        with self._lock:
+            self.conn.close()
+
+
+def _export_path(
+    output_dir: str,
+    layout: Optional[PathLayout],
+    machine: str,
+    part_number: str,
+    parsed_data: Dict[str, str],
+) -> str:
+    """
+    The append mode file of a stored cycle, where the logger would write it.
+    """
+    filename = f"{machine}_{part_number}.csv"
+    if layout is None:
+        return os.path.join(output_dir, filename)
+    # "2025-12-09 15:13:58" -> "20251209_151358"
+    timestamp = (
+        parsed_data["Timestamp"].replace("-", "").replace(":", "").replace(" ", "_")
+    )
+    return os.path.join(
+        output_dir, layout.directory(machine, part_number, timestamp), filename
+    )
+
+
+def _write_csv(filepath: str, rows: List[Dict[str, str]]) -> None:
+    """
+    Write a CSV file through a hidden temp file and a rename.
+    """
+    directory, filename = os.path.split(filepath)
+    os.makedirs(directory or ".", exist_ok=True)
+    # Schemas can add columns, keep the first-seen order of all of them
+    fieldnames = list(dict.fromkeys(name for row in rows for name in row))
+    temp_path = os.path.join(directory, f".{filename}.tmp")
+    with open(temp_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, restval="")
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(temp_path, filepath)
+
+
+def _append_csv(filepath: str, rows: List[Dict[str, str]]) -> None:
+    """
+    Append rows to an exported CSV file, or rewrite it if its header lacks some
+    of their columns.
+    """
+    header = read_csv_header(filepath)
+    fieldnames = list(dict.fromkeys(name for row in rows for name in row))
+    if header and set(fieldnames) <= set(header):
+        with open(filepath, "a", newline="") as f:
+            csv.DictWriter(f, fieldnames=header, restval="").writerows(rows)
+        return
+    _, existing = read_csv_rows(filepath)
+    _write_csv(filepath, existing + rows)
+
+
+def show_stats(store: SqliteStore, args: argparse.Namespace) -> None:
+    """
+    Print the cycle count and average cycle time per machine and part.
+    """
+    rows = store.stats(args.machine, args.part, args.since, args.until)
+    print(
+        f"{'machine':<16} {'part':<20} {'cycles':>8} {'avg s':>8} {'first':>20} {'last':>20}"
+    )
+    for machine, part_number, count, average, first, last in rows:
+        average_str = f"{average:8.1f}" if average is not None else f"{'':>8}"
+        print(
+            f"{machine:<16} {part_number:<20} {count:>8} {average_str} {first:>20} {last:>20}"
+        )
+
+
+def export(store: SqliteStore, args: argparse.Namespace) -> None:
+    """
+    Export the selected cycles to CSV files.
+    """
+    for filepath in store.export_csv(
+        args.out, args.machine, args.part, args.since, args.until
+    ):
+        print(f"Exported: {filepath}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Haas CNC Data Logger - Query and export the SQLite database",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python haas_sqlite.py stats                                  # Every machine and part
+    python haas_sqlite.py stats -m st30l -p 265-4183 --since 2025-12-01
+    python haas_sqlite.py export --out cnc_logs                  # One CSV per machine and part
+
+Notes:
+    - The logger writes to the database with haas_logger2.py --db cnc_data.db
+    - Times are YYYY-mm-dd or YYYY-mm-dd HH:MM:SS, --until is exclusive
+        """,
+    )
+    parser.add_argument(
+        "--db", default="cnc_data.db", help="Database file (default: cnc_data.db)"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, func, help_text in (
+        ("stats", show_stats, "Cycle count and average cycle time per machine and part"),
+        ("export", export, "Write one CSV file per machine and part"),
+    ):
+        command = subparsers.add_parser(name, help=help_text)
+        command.add_argument("-m", "--machine", help="Only this machine")
+        command.add_argument("-p", "--part", help="Only this part number")
+        command.add_argument("--since", help="Only cycles received at or after this time")
+        command.add_argument("--until", help="Only cycles received before this time")
+        command.set_defaults(func=func)
+    subparsers.choices["export"].add_argument(
+        "--out", default="cnc_logs", help="Output directory (default: cnc_logs)"
+    )
+
+    args = parser.parse_args()
+    if not os.path.isfile(args.db):
+        parser.error(f"{args.db} does not exist")
+    store = SqliteStore(args.db)
+    try:
+        args.func(store, args)
+    finally:
+        store.close()
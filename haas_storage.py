@@ -0,0 +1,480 @@
+import csv
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, IO, List, Optional, Sequence, Tuple
+
+
+class _OpenCsv:
+    """
+    One cached CSV file: the open file, its writer and flush bookkeeping.
+    """
+
+    def __init__(self, filepath: str, fieldnames: Sequence[str]) -> None:
+        """
+        Open a CSV file for appending, writing the header if the file is new.
+
+        Args:
+            filepath: CSV file to open.
+            fieldnames: Columns of the header, used only if the file has none yet.
+        """
+        self.filepath = filepath
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        self.file: IO[str] = open(filepath, "a", newline="")
+        # An existing file keeps its columns, rows missing some are padded
+        header = read_csv_header(filepath) if self.file.tell() else []
+        self.fieldnames = header or list(fieldnames)
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames, restval="")
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+        # Rows written since the path was last checked, see CsvHandleCache.flush_all
+        self.written = 0
+
+        if not header:
+            self.writer.writeheader()
+
+    def is_current(self) -> bool:
+        """
+        Check that the path still points to the file we hold open.
+
+        Returns:
+            False if the file was deleted, renamed or replaced since it was opened.
+        """
+        try:
+            return os.stat(self.filepath).st_ino == self.inode
+        except OSError:
+            return False
+
+    def fits(self, fieldnames: Sequence[str]) -> bool:
+        """
+        Check that rows with these fields can be appended under the file's header.
+
+        Args:
+            fieldnames: Fields of the rows to append.
+
+        Returns:
+            True if every field is a column of the file.
+        """
+        return set(fieldnames) <= set(self.fieldnames)
+
+    def flush(self) -> None:
+        """
+        Flush the buffered rows to the OS and reset the flush bookkeeping.
+        """
+        self.file.flush()
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        """
+        Close the file, ignoring errors from a file that went away.
+        """
+        try:
+            self.file.close()
+        except OSError:
+            pass
+
+
+class CsvHandleCache:
+    """
+    Keeps append-mode CSV files open across cycles.
+
+    Writers are cached per (machine, part number) key, so the steady-state cost of a
+    cycle is one buffered write instead of makedirs, isfile, open, header check and
+    close. The header is read once, when the file is opened. Rows are flushed after
+    flush_every rows, and at least every flush_interval seconds by a background
+    thread, so share clients see new cycles promptly. When more than max_open files
+    are open, the least recently used one is closed.
+
+    A file that fails to write is closed and reopened on the next write. Whether a
+    file was deleted or replaced on disk (for example saved over from Excel) is
+    checked on the flush tick rather than on every write; such a file is closed, and
+    the rows written to it since the last check are counted in lost_rows, so the
+    writer thread can keep their cycles in the journal. The cache is shared by every
+    logger in a process and is thread safe.
+    """
+
+    def __init__(
+        self, max_open: int = 32, flush_every: int = 100, flush_interval: float = 5.0
+    ) -> None:
+        """
+        Initialize an empty cache.
+
+        Args:
+            max_open: Most files kept open at once.
+            flush_every: Flush a file after this many rows. 1 flushes every cycle.
+            flush_interval: Flush unflushed rows at least this often, in seconds.
+            0 disables the background flush.
+        """
+        self.max_open = max(1, max_open)
+        self.flush_every = max(1, flush_every)
+        self.flush_interval = flush_interval
+        self._handles: "OrderedDict[Hashable, _OpenCsv]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+        # Rows that may not have reached their file, only ever grows
+        self.lost_rows = 0
+
+    def _evict(self, key: Hashable) -> None:
+        """
+        Close and forget one cached file. The lock must be held.
+
+        Args:
+            key: Cache key of the file.
+        """
+        handle = self._handles.pop(key, None)
+        if handle is not None:
+            try:
+                handle.flush()
+                if handle.written and not handle.is_current():
+                    self.lost_rows += handle.written
+            except OSError:
+                self.lost_rows += handle.written
+            handle.close()
+
+    def _start_flusher(self) -> None:
+        """
+        Start the background flush thread on first use. The lock must be held.
+        """
+        if self._flusher is None and self.flush_interval > 0:
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name="csv-flush", daemon=True
+            )
+            self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        """
+        Background thread: flush the open files every flush interval until closed.
+        """
+        while not self._closed.wait(self.flush_interval):
+            self.flush_all()
+
+    def write_rows(
+        self, key: Hashable, filepath: str, rows: List[Dict[str, str]]
+    ) -> None:
+        """
+        Append rows to a cached file, opening it (and writing the header) if needed.
+
+        Args:
+            key: Cache key, normally (machine name, part number).
+            filepath: CSV file the key maps to.
+            rows: Parsed cycles to append. Fields a row does not have are left
+            empty, every field has to be in the header of an existing file.
+
+        Raises:
+            IOError: If the file cannot be opened or written. The handle is closed so
+            the next attempt reopens it.
+            ValueError: If the file's header lacks fields of the rows, see header().
+        """
+        fieldnames = list(dict.fromkeys(name for row in rows for name in row))
+
+        with self._lock:
+            self._start_flusher()
+            handle = self._handles.get(key)
+            if handle is not None and (
+                handle.filepath != filepath or not handle.fits(fieldnames)
+            ):
+                self._evict(key)
+                handle = None
+
+            try:
+                if handle is None:
+                    handle = _OpenCsv(filepath, fieldnames)
+                    self._handles[key] = handle
+                    while len(self._handles) > self.max_open:
+                        self._evict(next(iter(self._handles)))
+                else:
+                    self._handles.move_to_end(key)
+                if not handle.fits(fieldnames):
+                    self._evict(key)
+                    raise ValueError(f"{filepath} has other columns than the rows")
+
+                handle.writer.writerows(rows)
+                handle.written += len(rows)
+                handle.unflushed += len(rows)
+                if handle.unflushed >= self.flush_every:
+                    handle.flush()
+            except (IOError, PermissionError):
+                self._evict(key)
+                raise
+
+    def header(self, key: Hashable, filepath: str) -> List[str]:
+        """
+        The columns of a CSV file, from its open handle if it is cached.
+
+        The handle's header is the one read when it was opened. A file replaced on
+        disk since then is noticed on the next flush_all.
+
+        Args:
+            key: Cache key, normally (machine name, part number).
+            filepath: CSV file the key maps to.
+
+        Returns:
+            The header of the file, empty if the file does not exist yet.
+        """
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None and handle.filepath == filepath:
+                return handle.fieldnames
+        return read_csv_header(filepath)
+
+    def flush_all(self, force: bool = False) -> None:
+        """
+        Close the files that were deleted or replaced on disk, and flush the others.
+
+        Rows written to a file that went away since the last check are added to
+        lost_rows, and the next write opens the file again.
+
+        Args:
+            force: Flush every file with unflushed rows. By default only rows older
+            than flush_interval are flushed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key, handle in list(self._handles.items()):
+                if not handle.is_current():
+                    self._evict(key)
+                    continue
+                if handle.unflushed and (
+                    force or now - handle.last_flush >= self.flush_interval
+                ):
+                    try:
+                        handle.flush()
+                    except OSError:
+                        self._evict(key)
+                        continue
+                # Rows still buffered are at risk until they are flushed
+                handle.written = handle.unflushed
+
+    def close_all(self) -> None:
+        """
+        Flush and close every cached file and stop the background flush.
+        """
+        self._closed.set()
+        with self._lock:
+            for key in list(self._handles):
+                self._evict(key)
+
+    def __len__(self) -> int:
+        """
+        Count the cached files.
+
+        Returns:
+            The number of files currently held open.
+        """
+        return len(self._handles)
+
+
+def read_csv_rows(filepath: str) -> Tuple[List[str], List[Dict[str, str]]]:
+    """
+    Read a CSV file written by the logger.
+
+    Args:
+        filepath: CSV file to read.
+
+    Returns:
+        Tuple of (fieldnames, rows). Both are empty if the file does not exist.
+    """
+    if not os.path.isfile(filepath):
+        return [], []
+    with open(filepath, newline="") as f:
+        reader = csv.DictReader(f)
+        rows = list(reader)
+        return list(reader.fieldnames or []), rows
+
+
+def read_csv_header(filepath: str) -> List[str]:
+    """
+    Read the header of a CSV file without reading its rows.
+
+    Args:
+        filepath: CSV file to read.
+
+    Returns:
+        The column names, empty if the file does not exist or is empty.
+    """
+    if not os.path.isfile(filepath):
+        return []
+    with open(filepath, newline="") as f:
+        return next(csv.reader(f), [])
+
+
+def new_cycle_id() -> str:
+    """
+    A new id for a received cycle.
+
+    The id stays with the cycle through the journal, the archive and the database,
+    so a cycle that is stored again (replayed after a crash, parsed again from the
+    archive) is recognized by its id, not by its values. Two cycles with identical
+    data received in the same second are two cycles.
+
+    Returns:
+        32 hex digits, unique across processes and restarts.
+    """
+    return uuid.uuid4().hex
+
+
+def row_key(row: Dict[str, str], fieldnames: Sequence[str]) -> Tuple[str, ...]:
+    """
+    Identity of a saved cycle, used to skip rows that were already written.
+
+    Every field is part of the key, including the Timestamp (to the second) the
+    cycle was received at, so two different cycles only compare equal if the
+    machine sent identical data in the same second.
+
+    Args:
+        row: A parsed cycle or a row read back from a CSV file.
+        fieldnames: Columns to compare.
+
+    Returns:
+        Tuple of the row's values.
+    """
+    return tuple(row.get(name) or "" for name in fieldnames)
+
+
+class SnapshotPublisher:
+    """
+    Publishes read-only copies of the logger's CSV files to the share.
+
+    The logger writes to a private directory nobody opens, so Excel never locks a
+    file the logger is writing to. Every publish interval, each file that changed
+    since the last publish is copied to a hidden temp file in the share directory,
+    made read-only and renamed over the published copy. The rename is atomic, so a
+    share client sees either the old or the new snapshot, never a half-written
+    one, and a file open in Excel keeps showing the old snapshot until it is
+    reopened. The share gets one write per changed file per interval instead of
+    one per cycle.
+
+    A published file whose source was removed (merged by compaction, for
+    example) is removed from the share too.
+
+    publish() reads the files the logger appends to, so it runs on the writer
+    thread (CycleWriter.add_task) and never copies a half-written row.
+    """
+
+    def __init__(
+        self,
+        source_dir: str,
+        publish_dir: str,
+        owns: Optional[Callable[[str], bool]] = None,
+    ) -> None:
+        """
+        Initialize the publisher.
+
+        Args:
+            source_dir: Private directory the logger writes to.
+            publish_dir: Share directory the snapshots are published to.
+            owns: Only publish the files whose name this accepts, ex. those of the
+            machines of one fleet worker process. If None, every file is published.
+        """
+        self.source_dir = source_dir
+        self.publish_dir = publish_dir
+        self.owns = owns
+        self.published: Dict[str, Tuple[int, int]] = {}
+        self.publish_count = 0
+        self.publish_errors = 0
+
+    def is_published(self, relpath: str, source: os.stat_result) -> bool:
+        """
+        Check whether the published copy of a file is up to date.
+
+        Args:
+            relpath: Path of the file relative to the source directory.
+            source: stat() of the source file.
+
+        Returns:
+            True if the file has not changed since it was last published.
+        """
+        signature = (source.st_mtime_ns, source.st_size)
+        if relpath not in self.published:
+            # First look since startup, compare with what an earlier run published
+            try:
+                target = os.stat(os.path.join(self.publish_dir, relpath))
+                self.published[relpath] = (target.st_mtime_ns, target.st_size)
+            except OSError:
+                return False
+        return self.published[relpath] == signature
+
+    def publish_file(self, relpath: str, source: os.stat_result) -> None:
+        """
+        Copy one file to the share through a temp file and an atomic rename.
+
+        Args:
+            relpath: Path of the file relative to the source directory.
+            source: stat() of the source file taken before the copy. If the file
+            changes while it is copied, the next publish sees a new signature.
+
+        Raises:
+            OSError: If the file cannot be copied or renamed.
+        """
+        source_path = os.path.join(self.source_dir, relpath)
+        target_path = os.path.join(self.publish_dir, relpath)
+        directory, filename = os.path.split(target_path)
+        os.makedirs(directory or ".", exist_ok=True)
+
+        temp_path = os.path.join(directory, f".{filename}.tmp")
+        try:
+            # copy2 keeps the mtime, which is how the next run knows it is current
+            shutil.copy2(source_path, temp_path)
+            os.chmod(temp_path, 0o444)
+            os.replace(temp_path, target_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+        self.published[relpath] = (source.st_mtime_ns, source.st_size)
+
+    def publish(self) -> int:
+        """
+        Publish every CSV file that changed since the last publish, and remove the
+        published copies of files that are gone.
+
+        A file that cannot be published is reported and tried again next time.
+
+        Returns:
+            Number of files published.
+        """
+        if not os.path.isdir(self.source_dir):
+            return 0
+
+        count = 0
+        seen = set()
+        for directory, _, filenames in os.walk(self.source_dir):
+            for filename in filenames:
+                if not filename.endswith(".csv"):
+                    continue
+                if self.owns is not None and not self.owns(filename):
+                    continue
+                path = os.path.join(directory, filename)
+                relpath = os.path.relpath(path, self.source_dir)
+                seen.add(relpath)
+                try:
+                    source = os.stat(path)
+                    if self.is_published(relpath, source):
+                        continue
+                    self.publish_file(relpath, source)
+                    count += 1
+                except OSError as e:
+                    self.publish_errors += 1
+                    print(f"[publish] ERROR: Could not publish {relpath}: {e}")
+
+        for relpath in set(self.published) - seen:
+            try:
+                os.remove(os.path.join(self.publish_dir, relpath))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"[publish] ERROR: Could not remove {relpath}: {e}")
+                continue
+            del self.published[relpath]
+
+        self.publish_count += count
+        return count
@@ -0,0 +1,355 @@
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+from haas_storage import new_cycle_id
+
+if TYPE_CHECKING:
+    from haas_journal import CycleJournal
+    from haas_logger2 import HaasDataLogger
+    from haas_storage import CsvHandleCache
+
+# A parsed cycle waiting to be written: (part_number, parsed_data)
+Record = Tuple[Optional[str], Dict[str, str]]
+
+# A queued batch: (logger, records, submit time, journal ids, raw text, cycle ids)
+QueueItem = Tuple[
+    "HaasDataLogger",
+    List[Record],
+    float,
+    List[int],
+    Optional[List[Optional[str]]],
+    List[str],
+]
+
+# Writes slower than this are reported, they usually mean a locked file
+SLOW_WRITE_SECONDS = 1.0
+
+
+class CycleWriter:
+    """
+    Writer thread that saves parsed cycles for every logger in the process.
+
+    Receive loops parse complete cycles and put them on a bounded queue; this thread
+    takes them off in batches and calls HaasDataLogger.write_records. A file that is
+    locked by Excel, with its retries and backup file, only delays this thread, never
+    the socket reads, so the control's send buffer keeps draining. The raw text is
+    compressed into the archive on this thread too.
+
+    The queue depth and write latency (time from submit to written) are kept for
+    monitoring. When the queue is full, submit blocks, which slows the receive loop
+    down instead of dropping cycles.
+
+    With a journal, cycles are journaled before they are queued and acknowledged
+    once written. Cycles written to the open files of a CsvHandleCache can still be
+    buffered, so they are acknowledged by flush_files, which flushes the files every
+    flush_interval of the cache. Periodic maintenance that touches the same files
+    (merging backup files and the like) is registered with add_task and runs on this
+    thread between writes, so it never races a write.
+    """
+
+    def __init__(
+        self,
+        max_queue: int = 1000,
+        max_batch: int = 100,
+        journal: Optional["CycleJournal"] = None,
+    ) -> None:
+        """
+        Initialize the writer. Call start() before submitting cycles.
+
+        Args:
+            max_queue: Most batches waiting to be written before submit blocks.
+            max_batch: Most queued batches taken off the queue and written together.
+            journal: Write-ahead journal for the queued cycles, or None.
+        """
+        self.queue: "queue.Queue[Optional[QueueItem]]" = queue.Queue(max_queue)
+        self.max_batch = max_batch
+        self.journal = journal
+        self.thread: Optional[threading.Thread] = None
+        self.tasks: List[List] = []
+        # Caches holding rows of written cycles that may not be flushed yet:
+        # id(cache) -> (cache, journal ids, cache.lost_rows when the first was written)
+        self.unflushed: Dict[int, Tuple["CsvHandleCache", List[int], int]] = {}
+        self.flush_due: Optional[float] = None
+
+        self.cycles_written = 0
+        self.write_errors = 0
+        self.queue_full_count = 0
+        self.max_queue_depth = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def start(self) -> "CycleWriter":
+        """
+        Start the writer thread.
+
+        Returns:
+            The writer, so it can be created and started in one line.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="cycle-writer", daemon=True
+            )
+            self.thread.start()
+        return self
+
+    def add_task(self, interval: float, func: Callable[[], object]) -> None:
+        """
+        Run a function on the writer thread every interval seconds.
+
+        Args:
+            interval: Seconds between runs. The first run is one interval from now.
+            func: Function to run. Exceptions are printed and do not stop the writer.
+        """
+        self.tasks.append([time.monotonic() + interval, interval, func])
+
+    def _run_due_tasks(self) -> Optional[float]:
+        """
+        Run the tasks that are due.
+
+        Returns:
+            Seconds until the next task is due, or None if there are no tasks.
+        """
+        now = time.monotonic()
+        if self.flush_due is not None and self.flush_due <= now:
+            self.flush_files()
+        for task in self.tasks:
+            if task[0] <= now:
+                # The task sees every row written so far
+                self.flush_files()
+                try:
+                    task[2]()
+                except Exception as e:
+                    print(f"[writer] ERROR: {getattr(task[2], '__name__', task[2])}: {e}")
+                task[0] = time.monotonic() + task[1]
+        due = [task[0] for task in self.tasks]
+        if self.flush_due is not None:
+            due.append(self.flush_due)
+        if not due:
+            return None
+        return max(0.0, min(due) - time.monotonic())
+
+    def flush_files(self) -> None:
+        """
+        Flush the cached files written since the last flush and acknowledge their
+        cycles.
+
+        Cycles whose rows may not have reached their file, because it failed to
+        flush or was deleted or replaced on disk in the meantime, are marked failed
+        instead, so the journal replays them on the next start.
+        """
+        unflushed, self.unflushed = self.unflushed, {}
+        self.flush_due = None
+        for cache, ids, lost_rows in unflushed.values():
+            cache.flush_all(force=True)
+            if not self.journal or not ids:
+                continue
+            if cache.lost_rows == lost_rows:
+                self.journal.ack(ids)
+            else:
+                self.journal.fail(ids)
+                print(
+                    f"[writer] ERROR: {cache.lost_rows - lost_rows} row(s) may not have reached their file, {len(ids)} cycle(s) kept in the journal"
+                )
+
+    def submit(
+        self,
+        logger: "HaasDataLogger",
+        records: List[Record],
+        timeout: Optional[float] = None,
+        raw: Optional[List[Optional[str]]] = None,
+        cycle_ids: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Queue parsed cycles of one logger for writing.
+
+        Args:
+            logger: The logger the cycles belong to, which knows where to write them.
+            records: List of (part_number, parsed_data) tuples from parse_cycles.
+            timeout: Seconds to wait if the queue is full. None waits as long as it
+            takes, 0 raises queue.Full immediately.
+            raw: The raw text of each record, archived by write_records. If None,
+            nothing is archived.
+            cycle_ids: The id of each record. If None, new ids are given.
+
+        Raises:
+            queue.Full: If the queue stays full for timeout seconds. Nothing was
+            queued, submit the cycles again.
+        """
+        if timeout == 0 and self.queue.full():
+            # Not counted here, the retry counts it if it still has to wait
+            raise queue.Full
+        if cycle_ids is None:
+            cycle_ids = [new_cycle_id() for _ in records]
+        ids = (
+            self.journal.append(logger, records, cycle_ids, raw) if self.journal else []
+        )
+        item = (logger, records, time.monotonic(), ids, raw, cycle_ids)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            try:
+                if timeout == 0:
+                    raise
+                self.queue_full_count += 1
+                print(
+                    f"[{logger.machine_name}] Warning: write queue is full ({self.queue.maxsize}), waiting for the writer"
+                )
+                self.queue.put(item, timeout=timeout)
+            except queue.Full:
+                # Journaled again when the caller retries, never replayed twice
+                if self.journal:
+                    self.journal.forget(ids)
+                raise
+
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of batches waiting to be written.
+        """
+        return self.queue.qsize()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Snapshot of the writer counters.
+
+        Returns:
+            Dictionary with queue depth, cycles written, errors and latency in seconds.
+        """
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "queue_full_count": self.queue_full_count,
+            "cycles_written": self.cycles_written,
+            "write_errors": self.write_errors,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+            "avg_latency": (
+                self.total_latency / self.cycles_written if self.cycles_written else 0.0
+            ),
+        }
+
+    def _take_batch(self) -> Tuple[List[QueueItem], bool]:
+        """
+        Wait for queued cycles and take up to max_batch of them, running periodic
+        tasks while waiting.
+
+        Returns:
+            Tuple of (items, stop). stop is True once close() was called.
+        """
+        while True:
+            try:
+                item = self.queue.get(timeout=self._run_due_tasks())
+                break
+            except queue.Empty:
+                continue
+        if item is None:
+            return [], True
+
+        items = [item]
+        stop = False
+        while len(items) < self.max_batch:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            items.append(item)
+        return items, stop
+
+    def write(self, items: List[QueueItem]) -> None:
+        """
+        Write a batch of queued cycles, one write_records call per logger.
+
+        Args:
+            items: Queued (logger, records, submit_time, journal_ids, raw,
+            cycle_ids) tuples.
+        """
+        by_logger: Dict[
+            int,
+            Tuple[
+                "HaasDataLogger",
+                List[Record],
+                List[float],
+                List[int],
+                List[Optional[str]],
+                List[str],
+            ],
+        ] = {}
+        for logger, records, submitted, ids, raw, cycle_ids in items:
+            entry = by_logger.setdefault(id(logger), (logger, [], [], [], [], []))
+            entry[1].extend(records)
+            entry[2].extend([submitted] * len(records))
+            entry[3].extend(ids)
+            entry[4].extend(raw if raw is not None else [None] * len(records))
+            entry[5].extend(cycle_ids)
+
+        for logger, records, submitted, ids, raw, cycle_ids in by_logger.values():
+            try:
+                logger.write_records(records, raw, cycle_ids)
+            except Exception as e:
+                # Not acknowledged, the journal replays them on the next start
+                if self.journal and ids:
+                    self.journal.fail(ids)
+                self.write_errors += 1
+                print(f"[{logger.machine_name}] ERROR: Could not save cycles: {e}")
+                continue
+
+            cache = logger.handle_cache if logger.append_mode else None
+            if cache is not None:
+                # Acknowledged by flush_files once the rows are flushed
+                entry = self.unflushed.setdefault(
+                    id(cache), (cache, [], cache.lost_rows)
+                )
+                entry[1].extend(ids)
+                if self.flush_due is None:
+                    self.flush_due = time.monotonic() + cache.flush_interval
+            elif self.journal and ids:
+                self.journal.ack(ids)
+
+            now = time.monotonic()
+            for start in submitted:
+                latency = now - start
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            self.last_latency = now - submitted[-1]
+            self.cycles_written += len(records)
+
+            if now - submitted[0] > SLOW_WRITE_SECONDS:
+                print(
+                    f"[{logger.machine_name}] Slow write: {now - submitted[0]:.1f}s, {self.queue_depth} batch(es) queued"
+                )
+
+    def run(self) -> None:
+        """
+        Writer thread main loop. Runs until close() is called and the queue is empty.
+        """
+        stop = False
+        while not stop:
+            items, stop = self._take_batch()
+            if items:
+                self.write(items)
+                if self.flush_due is not None and self.flush_due <= time.monotonic():
+                    self.flush_files()
+        self.flush_files()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        Write everything still queued, stop the writer thread and close the journal.
+
+        Args:
+            timeout: Seconds to wait for the queue to drain. None waits until done.
+        """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+        if self.journal is not None:
+            self.journal.close()
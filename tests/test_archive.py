@@ -0,0 +1,161 @@
+"""
+Tests for the raw cycle archive in haas_archive.py.
+
+Run from the repository root:
+    python -m pytest -q
+"""
+
+import gzip
+import os
+from typing import Iterator, List
+
+import pytest
+
+from haas_archive import CycleArchive, find_segments, read_cycles, read_index
+
+MACHINE = "VF2"
+
+
+def make_cycle(part: str, counter: int) -> str:
+    """
+    Build the raw text of one cycle.
+    """
+    return f"PART NUMBER: {part}\r\nPARTS COUNTER: {counter}\r\nEND OF CYCLE"
+
+
+def archived(directory: str) -> List[str]:
+    """
+    The raw text of every archived cycle, in archive order.
+    """
+    return [cycle.data for cycle in read_cycles(directory)]
+
+
+@pytest.fixture
+def archive(tmp_path) -> Iterator[CycleArchive]:
+    archive = CycleArchive(str(tmp_path / "archive"))
+    yield archive
+    archive.close()
+
+
+@pytest.fixture
+def segment(archive: CycleArchive) -> str:
+    """
+    Path of a segment holding two cycles, closed as after a clean stop.
+    """
+    archive.append(
+        MACHINE,
+        [
+            ("2025-12-09 15:13:58", "265-1", make_cycle("265-1", 1), "a"),
+            ("2025-12-09 15:14:30", "265-1", make_cycle("265-1", 2), "b"),
+        ],
+    )
+    archive.close()
+    return os.path.join(archive.directory, MACHINE, "20251209_000.gz")
+
+
+def test_roundtrip_with_cycle_ids(archive: CycleArchive, segment: str) -> None:
+    cycles = list(read_cycles(archive.directory))
+    assert [(c.part_number, c.cycle_id) for c in cycles] == [
+        ("265-1", "a"),
+        ("265-1", "b"),
+    ]
+    assert [c.data for c in cycles] == [make_cycle("265-1", 1), make_cycle("265-1", 2)]
+    # The segment is a plain gzip file
+    with gzip.open(segment, "rb") as f:
+        assert f.read().decode("utf-8") == "".join(c.data for c in cycles)
+
+
+def test_index_without_cycle_ids(segment: str) -> None:
+    index_path = segment[: -len(".gz")] + ".idx"
+    with open(index_path, encoding="utf-8") as f:
+        lines = f.readlines()
+    # Written before cycles had ids
+    with open(index_path, "w", encoding="utf-8") as f:
+        f.writelines(line.rsplit("\t", 1)[0] + "\n" for line in lines)
+
+    assert [entry.cycle_id for entry in read_index(segment)] == ["", ""]
+
+
+def test_partial_index_line_is_ignored(segment: str) -> None:
+    with open(segment[: -len(".gz")] + ".idx", "a", encoding="utf-8") as f:
+        f.write("2025-12-09 15:15:00\t265-1\t999")
+
+    assert len(read_index(segment)) == 2
+
+
+def test_reopen_drops_the_partial_cycle(archive: CycleArchive, segment: str) -> None:
+    # Killed while archiving a third cycle: its data is half written, and so is
+    # its index line
+    size = os.path.getsize(segment)
+    with open(segment, "ab") as f:
+        f.write(gzip.compress(make_cycle("265-1", 3).encode("utf-8"))[:20])
+    with open(segment[: -len(".gz")] + ".idx", "a", encoding="utf-8") as f:
+        f.write(f"2025-12-09 15:15:00\t265-1\t{size}")
+
+    archive.append(
+        MACHINE, [("2025-12-09 15:16:00", "265-1", make_cycle("265-1", 4), "d")]
+    )
+    archive.close()
+
+    assert archived(archive.directory) == [
+        make_cycle("265-1", 1),
+        make_cycle("265-1", 2),
+        make_cycle("265-1", 4),
+    ]
+    assert [entry.cycle_id for entry in read_index(segment)] == ["a", "b", "d"]
+    with gzip.open(segment, "rb") as f:
+        assert f.read().count(b"END OF CYCLE") == 3
+
+
+def test_rotates_by_size_and_day(tmp_path) -> None:
+    archive = CycleArchive(str(tmp_path / "archive"), max_segment_bytes=1)
+    archive.append(
+        MACHINE,
+        [
+            ("2025-12-09 15:13:58", "265-1", make_cycle("265-1", 1), "a"),
+            ("2025-12-09 15:14:30", "265-1", make_cycle("265-1", 2), "b"),
+            ("2025-12-10 08:00:00", "265-1", make_cycle("265-1", 3), "c"),
+        ],
+    )
+    archive.close()
+
+    segments = [os.path.basename(path) for _, path in find_segments(archive.directory)]
+    assert segments == ["20251209_000.gz", "20251209_001.gz", "20251210_000.gz"]
+    assert find_segments(archive.directory, until="2025-12-10") == [
+        (MACHINE, os.path.join(archive.directory, MACHINE, "20251209_000.gz")),
+        (MACHINE, os.path.join(archive.directory, MACHINE, "20251209_001.gz")),
+    ]
+
+
+def test_old_segments_are_pruned(tmp_path) -> None:
+    archive = CycleArchive(str(tmp_path / "archive"), keep_days=30)
+    archive.append(
+        MACHINE,
+        [
+            ("2025-10-01 12:00:00", "265-1", make_cycle("265-1", 1), "a"),
+            ("2025-11-15 12:00:00", "265-1", make_cycle("265-1", 2), "b"),
+            ("2025-12-09 12:00:00", "265-1", make_cycle("265-1", 3), "c"),
+        ],
+    )
+    archive.close()
+
+    assert sorted(os.listdir(os.path.join(archive.directory, MACHINE))) == [
+        "20251115_000.gz",
+        "20251115_000.idx",
+        "20251209_000.gz",
+        "20251209_000.idx",
+    ]
+
+
+def test_keep_days_zero_keeps_everything(tmp_path) -> None:
+    archive = CycleArchive(str(tmp_path / "archive"), keep_days=0)
+    archive.append(
+        MACHINE,
+        [
+            ("2020-01-01 12:00:00", "265-1", make_cycle("265-1", 1), "a"),
+            ("2025-12-09 12:00:00", "265-1", make_cycle("265-1", 2), "b"),
+        ],
+    )
+    archive.close()
+
+    assert len(archived(archive.directory)) == 2
@@ -0,0 +1,171 @@
+"""
+Tests for merging cycle and backup files into their main files, in haas_compact.py
+and haas_journal.merge_backups.
+
+Run from the repository root:
+    python -m pytest -q
+"""
+
+import csv
+import os
+from typing import Dict, List
+
+import pytest
+
+import haas_compact
+from haas_compact import compact_directory, compact_files, find_cycle_files
+from haas_journal import merge_backups
+from haas_storage import read_csv_rows
+
+FIELDS = ["Timestamp", "Part_Number", "Parts_Counter"]
+
+
+def make_row(counter: int = 1, second: int = 58) -> Dict[str, str]:
+    """
+    Build one CSV row.
+    """
+    return {
+        "Timestamp": f"2025-12-09 15:13:{second:02d}",
+        "Part_Number": "265-1",
+        "Parts_Counter": str(counter),
+    }
+
+
+def write_csv(
+    path: str, rows: List[Dict[str, str]], fieldnames: List[str] = FIELDS
+) -> str:
+    """
+    Write a CSV file with a header.
+    """
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    return path
+
+
+def counters(path: str) -> List[str]:
+    """
+    Parts_Counter of every row of a CSV file.
+    """
+    return [row["Parts_Counter"] for row in read_csv_rows(path)[1]]
+
+
+def test_identical_rows_are_kept(tmp_path) -> None:
+    # Cycles received in the same second share one file and can be equal
+    first = write_csv(str(tmp_path / "VF2_265-1_20251209_151358.csv"), [make_row()] * 2)
+    second = write_csv(str(tmp_path / "VF2_265-1_20251209_151359.csv"), [make_row()])
+    daily = str(tmp_path / "VF2_265-1_20251209.csv")
+
+    assert compact_files(daily, [first, second]) == 3
+    assert counters(daily) == ["1", "1", "1"]
+    assert not os.path.exists(first) and not os.path.exists(second)
+
+
+def test_interrupted_run_is_not_merged_twice(tmp_path) -> None:
+    first = write_csv(str(tmp_path / "VF2_265-1_20251209_151358.csv"), [make_row(1)])
+    second = write_csv(str(tmp_path / "VF2_265-1_20251209_151359.csv"), [make_row(2)])
+    daily = str(tmp_path / "VF2_265-1_20251209.csv")
+    # The last run renamed the daily file, then died before deleting the files
+    write_csv(daily, [make_row(1), make_row(2)])
+    third = write_csv(str(tmp_path / "VF2_265-1_20251209_151400.csv"), [make_row(2)])
+
+    assert compact_files(daily, [first, second, third]) == 1
+    assert counters(daily) == ["1", "2", "2"]
+
+
+def test_new_columns_are_added(tmp_path) -> None:
+    first = write_csv(str(tmp_path / "VF2_265-1_20251209_151358.csv"), [make_row(1)])
+    row = dict(make_row(2), Spindle_Load="41")
+    second = write_csv(
+        str(tmp_path / "VF2_265-1_20251209_151359.csv"),
+        [row],
+        fieldnames=FIELDS + ["Spindle_Load"],
+    )
+    daily = str(tmp_path / "VF2_265-1_20251209.csv")
+
+    compact_files(daily, [first, second])
+    fieldnames, rows = read_csv_rows(daily)
+    assert list(fieldnames) == FIELDS + ["Spindle_Load"]
+    assert [row["Spindle_Load"] for row in rows] == ["", "41"]
+
+
+def test_today_is_left_alone(tmp_path) -> None:
+    old = write_csv(str(tmp_path / "VF2_265-1_20251209_151358.csv"), [make_row()])
+    new = write_csv(str(tmp_path / "VF2_265-1_20251210_080000.csv"), [make_row()])
+
+    assert find_cycle_files(str(tmp_path), today="20251210") == {
+        (str(tmp_path), "VF2_265-1", "20251209"): [old]
+    }
+    assert compact_directory(str(tmp_path), today="20251210") == 1
+    assert os.path.exists(new)
+    assert os.path.exists(tmp_path / "VF2_265-1_20251209.csv")
+
+
+def test_locked_group_is_retried(tmp_path, monkeypatch) -> None:
+    path = write_csv(str(tmp_path / "VF2_265-1_20251209_151358.csv"), [make_row()])
+
+    def locked(*args, **kwargs):
+        raise PermissionError("file is open in Excel")
+
+    monkeypatch.setattr(haas_compact, "compact_files", locked)
+    assert compact_directory(str(tmp_path), today="20251210") == 0
+    assert os.path.exists(path)
+
+
+@pytest.fixture
+def main_file(tmp_path) -> str:
+    return write_csv(str(tmp_path / "VF2_265-1.csv"), [make_row(1)])
+
+
+def test_backup_is_merged(tmp_path, main_file: str) -> None:
+    backup = write_csv(
+        str(tmp_path / "VF2_265-1_20251209_151359_BACKUP.csv"), [make_row(2)]
+    )
+
+    assert merge_backups(str(tmp_path)) == 1
+    assert counters(main_file) == ["1", "2"]
+    assert not os.path.exists(backup)
+
+
+def test_backup_identical_rows_are_kept(tmp_path, main_file: str) -> None:
+    # The main file holds one copy, the backup two: one of them is new
+    write_csv(
+        str(tmp_path / "VF2_265-1_20251209_151359_BACKUP.csv"), [make_row(1)] * 2
+    )
+
+    assert merge_backups(str(tmp_path)) == 2
+    assert counters(main_file) == ["1", "1", "1"]
+
+
+def test_interrupted_backup_merge_is_only_deleted(tmp_path) -> None:
+    main_file = write_csv(str(tmp_path / "VF2_265-1.csv"), [make_row(1), make_row(2)])
+    # Appended to the main file by a run that died before deleting it
+    backup = write_csv(
+        str(tmp_path / "VF2_265-1_20251209_151359_BACKUP.csv"), [make_row(2)]
+    )
+
+    assert merge_backups(str(tmp_path)) == 0
+    assert counters(main_file) == ["1", "2"]
+    assert not os.path.exists(backup)
+
+
+def test_backup_with_other_columns_is_left(tmp_path, main_file: str) -> None:
+    backup = write_csv(
+        str(tmp_path / "VF2_265-1_20251209_151359_BACKUP.csv"),
+        [dict(make_row(2), Spindle_Load="41")],
+        fieldnames=FIELDS + ["Spindle_Load"],
+    )
+
+    assert merge_backups(str(tmp_path)) == 0
+    assert counters(main_file) == ["1"]
+    assert os.path.exists(backup)
+
+
+def test_backups_of_other_workers_are_left(tmp_path, main_file: str) -> None:
+    backup = write_csv(
+        str(tmp_path / "VF2_265-1_20251209_151359_BACKUP.csv"), [make_row(2)]
+    )
+
+    assert merge_backups(str(tmp_path), owns=lambda name: name.startswith("ST10_")) == 0
+    assert os.path.exists(backup)
@@ -0,0 +1,209 @@
+"""
+Tests for the streaming cycle framer in haas_framing.py.
+
+Run from the repository root:
+    python -m pytest -q
+"""
+
+import random
+from typing import List, Optional, Tuple
+
+import pytest
+
+import haas_framing
+from haas_framing import (
+    END_OF_CYCLE_RE,
+    INCOMPLETE_SUFFIX,
+    PART_NUMBER_BYTES_RE,
+    CycleFramer,
+    CycleLimits,
+)
+
+Cycles = List[Tuple[str, Optional[str]]]
+
+
+def make_cycle(part: str, lines: int, marker: str = "END OF CYCLE") -> bytes:
+    """
+    Build one DPRNT cycle ending with its marker line.
+    """
+    body = [f"PART NUMBER: {part}"]
+    body += [f"X{i:04d} Y{i * 3:05d} Z-{i % 7}.125" for i in range(lines)]
+    body.append(f"{marker}, TIME 12:00")
+    return ("\r\n".join(body) + "\r\n").encode("ascii")
+
+
+def reference_frame(stream: bytes) -> Cycles:
+    """
+    Split a whole stream with plain regex searches, as the framer should.
+    """
+    cycles: Cycles = []
+    position = 0
+    while True:
+        match = END_OF_CYCLE_RE.search(stream, position)
+        if match is None:
+            return cycles
+        data = stream[position : match.end()]
+        part = PART_NUMBER_BYTES_RE.search(data)
+        cycles.append(
+            (data.decode("utf-8"), part.group(1).decode("ascii") if part else None)
+        )
+        # The rest of the marker line is dropped
+        position = stream.index(b"\n", match.end()) + 1
+
+
+def feed_chunks(framer: CycleFramer, stream: bytes, cuts: List[int]) -> Cycles:
+    """
+    Feed a stream to a framer, split at the given offsets.
+    """
+    cycles: Cycles = []
+    bounds = [0] + sorted(cuts) + [len(stream)]
+    for start, end in zip(bounds, bounds[1:]):
+        cycles += framer.feed(stream[start:end])
+    return cycles
+
+
+@pytest.fixture
+def stream() -> bytes:
+    return b"".join(
+        make_cycle(f"265-{i:04d}", lines)
+        for i, lines in enumerate([0, 1, 5, 40, 300, 3, 2000, 12])
+    )
+
+
+def test_one_chunk_matches_reference(stream: bytes) -> None:
+    expected = reference_frame(stream)
+    assert len(expected) == 8
+    assert CycleFramer().feed(stream) == expected
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_chunk_splits(stream: bytes, seed: int) -> None:
+    rng = random.Random(seed)
+    cuts = rng.sample(range(1, len(stream)), rng.randint(1, 200))
+    # A small first buffer makes _reserve() move and grow it many times
+    framer = CycleFramer(size=16, chunk_size=16)
+    assert feed_chunks(framer, stream, cuts) == reference_frame(stream)
+
+
+def test_byte_by_byte(stream: bytes) -> None:
+    framer = CycleFramer(size=1, chunk_size=1)
+    assert feed_chunks(framer, stream, list(range(1, len(stream)))) == (
+        reference_frame(stream)
+    )
+
+
+@pytest.mark.parametrize("cut", range(1, len("END OF CYCLE")))
+def test_marker_split_across_reads(cut: int) -> None:
+    first = make_cycle("A-1", 3)
+    stream = first + make_cycle("B-2", 2)
+    marker = END_OF_CYCLE_RE.search(first)
+    assert marker is not None
+
+    framer = CycleFramer()
+    assert framer.feed(stream[: marker.start() + cut]) == []
+    assert framer.feed(stream[marker.start() + cut :]) == reference_frame(stream)
+
+
+def test_marker_line_split_before_newline() -> None:
+    stream = make_cycle("A-1", 3) + make_cycle("B-2", 3)
+    # Cut inside the rest of the marker line, after the marker itself
+    cut = stream.index(b", TIME") + 3
+
+    framer = CycleFramer()
+    first = framer.feed(stream[:cut])
+    assert [part for _, part in first] == ["A-1"]
+    assert first + framer.feed(stream[cut:]) == reference_frame(stream)
+
+
+@pytest.mark.parametrize(
+    "marker", ["END OF CYCLE", "end of cycle", "End Of Cycle", "eNd oF cYcLe"]
+)
+def test_mixed_case_markers(marker: str) -> None:
+    stream = make_cycle("P-1", 4, marker) + make_cycle("P-2", 1, marker)
+
+    cycles = CycleFramer().feed(stream)
+    assert [part for _, part in cycles] == ["P-1", "P-2"]
+    assert all(data.endswith(marker) for data, _ in cycles)
+    assert cycles == reference_frame(stream)
+
+
+def test_several_cycles_in_one_chunk_keep_the_rest() -> None:
+    stream = make_cycle("A", 1) + make_cycle("B", 1) + b"PART NUMBER: C\r\nX1"
+
+    framer = CycleFramer()
+    assert [part for _, part in framer.feed(stream)] == ["A", "B"]
+    assert framer.cycle_size == len(b"PART NUMBER: C\r\nX1")
+    assert framer.feed(b"\r\nEND OF CYCLE\r\n")[0][1] == "C"
+
+
+def test_spilled_cycle_is_returned_whole(tmp_path) -> None:
+    stream = make_cycle("BIG", 2000) + make_cycle("SMALL", 2)
+    limits = CycleLimits(memory_bytes=1024, max_bytes=0, spill_dir=str(tmp_path))
+    rng = random.Random(7)
+    cuts = rng.sample(range(1, len(stream)), 500)
+
+    framer = CycleFramer(size=64, chunk_size=64, limits=limits)
+    assert feed_chunks(framer, stream, cuts) == reference_frame(stream)
+    assert framer.spills == 1
+    # The temp file is removed once the cycle is taken
+    assert not framer.spilling
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_marker_split_at_spill_cut(tmp_path) -> None:
+    limits = CycleLimits(memory_bytes=256, max_bytes=0, spill_dir=str(tmp_path))
+    stream = make_cycle("SPILL", 100)
+    marker = END_OF_CYCLE_RE.search(stream)
+    assert marker is not None
+
+    framer = CycleFramer(limits=limits)
+    # The spill happens while the marker is only half received
+    assert framer.feed(stream[: marker.start() + 5]) == []
+    assert framer.spilling
+    assert framer.feed(stream[marker.start() + 5 :]) == reference_frame(stream)
+
+
+def test_max_bytes_cuts_at_a_line() -> None:
+    limits = CycleLimits(memory_bytes=0, max_bytes=512)
+    runaway = b"PART NUMBER: LOOP\r\n" + b"".join(
+        b"X%04d Y1.0\r\n" % i for i in range(100)
+    )
+
+    framer = CycleFramer(limits=limits)
+    cycles = feed_chunks(framer, runaway, list(range(100, len(runaway), 100)))
+    assert cycles
+    assert cycles[0][1] == f"LOOP{INCOMPLETE_SUFFIX}"
+    # Each cut ends on a line, and nothing is lost or doubled
+    assert all(data.endswith("\r\n") for data, _ in cycles)
+    rest = framer.feed(b"END OF CYCLE\r\n")
+    text = "".join(data for data, _ in cycles + rest)
+    assert text == runaway.decode("ascii") + "END OF CYCLE"
+
+
+def test_max_bytes_without_newline() -> None:
+    framer = CycleFramer(limits=CycleLimits(memory_bytes=0, max_bytes=100))
+
+    cycles = framer.feed(b"A" * 150)
+    assert cycles == [("A" * 150, f"unknown_part{INCOMPLETE_SUFFIX}")]
+    assert framer.cycle_size == 0
+
+
+def test_max_age_cuts_a_stalled_cycle(monkeypatch) -> None:
+    clock = [1000.0]
+    monkeypatch.setattr(haas_framing.time, "monotonic", lambda: clock[0])
+    framer = CycleFramer(limits=CycleLimits(max_age=60))
+
+    assert framer.feed(b"PART NUMBER: OLD\r\nX1\r\n") == []
+    clock[0] += 61
+    cycles = framer.feed(make_cycle("NEW", 1))
+    assert cycles == [
+        ("PART NUMBER: OLD\r\nX1\r\n", f"OLD{INCOMPLETE_SUFFIX}"),
+        reference_frame(make_cycle("NEW", 1))[0],
+    ]
+
+
+def test_blank_incomplete_cycle_is_dropped() -> None:
+    framer = CycleFramer(limits=CycleLimits(memory_bytes=0, max_bytes=16))
+
+    assert framer.feed(b"\r\n" * 20) == []
+    assert framer.cycle_size < 16
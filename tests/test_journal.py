@@ -0,0 +1,206 @@
+"""
+Tests for the write-ahead cycle journal in haas_journal.py.
+
+Run from the repository root:
+    python -m pytest -q
+"""
+
+import glob
+import json
+import os
+from typing import Dict, Iterator, List, Tuple
+
+import pytest
+
+from haas_journal import CycleJournal, unwritten
+from haas_logger2 import HaasDataLogger
+from haas_storage import CsvHandleCache, read_csv_rows
+
+Record = Tuple[str, Dict[str, str]]
+
+
+def make_record(part: str = "265-1", counter: int = 1) -> Record:
+    """
+    Build one parsed cycle, received at a fixed second.
+    """
+    return (
+        part,
+        {
+            "Timestamp": "2025-12-09 15:13:58",
+            "Part_Number": part,
+            "Parts_Counter": str(counter),
+        },
+    )
+
+
+def csv_rows(directory: str) -> List[Dict[str, str]]:
+    """
+    Read the rows of every CSV file under a directory.
+    """
+    rows: List[Dict[str, str]] = []
+    pattern = os.path.join(directory, "**", "*.csv")
+    for path in sorted(glob.glob(pattern, recursive=True)):
+        rows += read_csv_rows(path)[1]
+    return rows
+
+
+@pytest.fixture
+def logger(tmp_path) -> HaasDataLogger:
+    return HaasDataLogger(
+        machine_name="VF2", append_mode=True, output_dir=str(tmp_path / "logs")
+    )
+
+
+@pytest.fixture
+def journal(tmp_path) -> Iterator[CycleJournal]:
+    journal = CycleJournal(str(tmp_path / "journal.jsonl"), sync_interval=60)
+    yield journal
+    journal.close()
+
+
+def test_ack_removes_entries(journal: CycleJournal, logger: HaasDataLogger) -> None:
+    ids = journal.append(logger, [make_record(counter=1), make_record(counter=2)])
+    assert journal.pending == set(ids)
+
+    journal.ack(ids[:1])
+    entries = journal.unacknowledged()
+    assert [entry["id"] for entry in entries] == ids[1:]
+    assert entries[0]["record"]["Parts_Counter"] == "2"
+    assert journal.pending == set(ids[1:])
+
+
+def test_cycle_ids_are_journaled(journal: CycleJournal, logger: HaasDataLogger) -> None:
+    journal.append(logger, [make_record(), make_record()], cycle_ids=["a", "b"])
+    assert [entry["cycle"] for entry in journal.unacknowledged()] == ["a", "b"]
+
+
+def test_partial_last_line_is_ignored(tmp_path, logger: HaasDataLogger) -> None:
+    path = str(tmp_path / "journal.jsonl")
+    journal = CycleJournal(path)
+    journal.append(logger, [make_record()])
+    journal.close()
+    # The process was killed in the middle of the next line
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"id": 2, "cycle": "x", "mach')
+
+    journal = CycleJournal(path)
+    try:
+        assert [entry["id"] for entry in journal.unacknowledged()] == [1]
+        # New entries don't reuse the ids of the existing ones
+        assert journal.append(logger, [make_record()]) == [2]
+    finally:
+        journal.close()
+
+
+def test_compaction_keeps_pending_and_failed(tmp_path, logger: HaasDataLogger) -> None:
+    path = str(tmp_path / "journal.jsonl")
+    journal = CycleJournal(path, sync_interval=60, max_bytes=2048)
+    try:
+        in_flight = journal.append(logger, [make_record(counter=1)])
+        failed = journal.append(logger, [make_record(counter=2)])
+        journal.fail(failed)
+        for counter in range(3, 200):
+            journal.ack(journal.append(logger, [make_record(counter=counter)]))
+
+        # The acknowledged entries were dropped, so the file stays small
+        assert os.path.getsize(path) < 4 * 2048
+        entries = journal.unacknowledged()
+        assert [entry["id"] for entry in entries] == in_flight + failed
+        assert journal.failed == set(failed)
+    finally:
+        journal.close()
+
+
+def test_forget_is_never_replayed(
+    journal: CycleJournal, logger: HaasDataLogger
+) -> None:
+    old = journal.append(logger, [make_record()])
+    journal.forget(old)
+    new = journal.append(logger, [make_record()])
+
+    assert [entry["id"] for entry in journal.unacknowledged()] == new
+    assert journal.pending == set(new)
+
+
+def test_unwritten_counts_identical_rows(
+    journal: CycleJournal, logger: HaasDataLogger
+) -> None:
+    # Two identical cycles in the same second, only one reached the file
+    logger.write_records([make_record()])
+    journal.append(logger, [make_record(), make_record()])
+
+    entries = journal.unacknowledged()
+    assert unwritten(logger, entries) == entries[1:]
+
+
+def test_recover_writes_only_missing_rows(tmp_path, logger: HaasDataLogger) -> None:
+    path = str(tmp_path / "journal.jsonl")
+    journal = CycleJournal(path)
+    records = [make_record(counter=1), make_record(counter=1), make_record(counter=2)]
+    journal.append(logger, records)
+    # Killed after the first row was written, before the acknowledgement
+    logger.write_records(records[:1])
+    journal.close()
+
+    journal = CycleJournal(path)
+    try:
+        assert journal.recover({"VF2": logger}) == 2
+        assert [row["Parts_Counter"] for row in csv_rows(logger.output_dir)] == [
+            "1",
+            "1",
+            "2",
+        ]
+        assert journal.unacknowledged() == []
+        assert journal.pending == set() and journal.failed == set()
+        # A second start has nothing left to write
+        assert journal.recover({"VF2": logger}) == 0
+    finally:
+        journal.close()
+
+
+def test_recover_builds_logger_for_unknown_machine(
+    journal: CycleJournal, logger: HaasDataLogger
+) -> None:
+    other = HaasDataLogger(
+        machine_name="ST10", append_mode=True, output_dir=logger.output_dir
+    )
+    journal.append(other, [make_record("900-1")])
+
+    assert journal.recover({"VF2": logger}) == 1
+    rows = csv_rows(logger.output_dir)
+    assert [row["Part_Number"] for row in rows] == ["900-1"]
+
+
+def test_recover_flushes_cached_files(tmp_path, journal: CycleJournal) -> None:
+    cache = CsvHandleCache(flush_every=1000, flush_interval=0)
+    logger = HaasDataLogger(
+        machine_name="VF2",
+        append_mode=True,
+        output_dir=str(tmp_path / "logs"),
+        handle_cache=cache,
+    )
+    try:
+        journal.append(logger, [make_record(counter=1), make_record(counter=2)])
+        assert journal.recover({"VF2": logger}) == 2
+        # The rows are on disk before the journal is reset
+        assert len(csv_rows(logger.output_dir)) == 2
+        assert journal.unacknowledged() == []
+    finally:
+        cache.close_all()
+
+
+def test_recover_keeps_failed_writes(
+    journal: CycleJournal, logger: HaasDataLogger, monkeypatch
+) -> None:
+    journal.append(logger, [make_record()])
+
+    def locked(*args, **kwargs):
+        raise PermissionError("file is open in Excel")
+
+    monkeypatch.setattr(logger, "write_records", locked)
+    assert journal.recover({"VF2": logger}) == 0
+    entries = journal.unacknowledged()
+    assert len(entries) == 1
+    assert journal.failed == {entries[0]["id"]}
+    with open(journal.path, encoding="utf-8") as f:
+        assert [json.loads(line)["id"] for line in f] == [entries[0]["id"]]
@@ -0,0 +1,134 @@
+"""
+Tests for the directory layout and file migration in haas_layout.py.
+
+Run from the repository root:
+    python -m pytest -q
+"""
+
+import csv
+import os
+from typing import List, Tuple
+
+import pytest
+
+from haas_layout import PathLayout, describe_file, migrate
+
+FIELDS = ["Machine", "Timestamp", "Part_Number", "Parts_Counter"]
+
+
+def write_cycle_file(
+    directory: str, filename: str, machine: str = "VF2", day: str = "2025-12-09"
+) -> str:
+    """
+    Write a one-row CSV file as the logger does.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, filename)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerow(
+            {
+                "Machine": machine,
+                "Timestamp": f"{day} 15:13:58",
+                "Part_Number": "265_1",
+                "Parts_Counter": "1",
+            }
+        )
+    return path
+
+
+def tree(directory: str) -> List[str]:
+    """
+    Every file under a directory, relative to it.
+    """
+    return sorted(
+        os.path.relpath(os.path.join(dirpath, filename), directory)
+        for dirpath, _, filenames in os.walk(directory)
+        for filename in filenames
+    )
+
+
+@pytest.mark.parametrize("template", ["{shift}", "../{machine}", "{machine}/../{part}"])
+def test_bad_template(template: str) -> None:
+    with pytest.raises(ValueError):
+        PathLayout(template)
+
+
+def test_directory() -> None:
+    layout = PathLayout("/{machine}/{yyyy}/{mm}/")
+    assert layout.directory("VF2", "265-1", "20251209_151358") == "VF2/2025/12"
+    assert PathLayout().directory("VF2", "265-1", "20251209") == ""
+
+
+@pytest.mark.parametrize(
+    "filename, expected",
+    [
+        ("Mill_1_265_1_20251209_151358.csv", ("Mill_1", "265_1", "20251209")),
+        ("Mill_1_265_1_20251208.csv", ("Mill_1", "265_1", "20251208")),
+        ("Mill_1_265_1_20251207_151358_BACKUP.csv", ("Mill_1", "265_1", "20251207")),
+        # Append mode files are dated by their first row
+        ("Mill_1_265_1.csv", ("Mill_1", "265_1", "20251209")),
+    ],
+)
+def test_describe_file(
+    tmp_path, filename: str, expected: Tuple[str, str, str]
+) -> None:
+    path = write_cycle_file(str(tmp_path), filename, machine="Mill_1")
+    assert describe_file(path) == expected
+
+
+def test_migrate_and_back(tmp_path) -> None:
+    out = str(tmp_path)
+    write_cycle_file(out, "VF2_265_1_20251209_151358.csv")
+    write_cycle_file(out, "ST10_265_1.csv", machine="ST10", day="2025-11-30")
+
+    layout = PathLayout("{machine}/{yyyy}/{mm}")
+    assert migrate(out, layout) == 2
+    assert tree(out) == [
+        "ST10/2025/11/ST10_265_1.csv",
+        "VF2/2025/12/VF2_265_1_20251209_151358.csv",
+    ]
+    # Running it again has nothing left to move
+    assert migrate(out, layout) == 0
+
+    # Back to a flat directory, the emptied directories are removed
+    assert migrate(out, PathLayout()) == 2
+    assert sorted(os.listdir(out)) == [
+        "ST10_265_1.csv",
+        "VF2_265_1_20251209_151358.csv",
+    ]
+
+
+def test_taken_target_is_left(tmp_path) -> None:
+    out = str(tmp_path)
+    path = write_cycle_file(out, "VF2_265_1.csv")
+    taken = write_cycle_file(os.path.join(out, "VF2"), "VF2_265_1.csv")
+    with open(taken, "a") as f:
+        f.write("VF2,2025-12-10 08:00:00,265_1,2\r\n")
+
+    assert migrate(out, PathLayout("{machine}")) == 0
+    assert os.path.exists(path)
+    # Neither file was overwritten
+    with open(taken) as f:
+        assert len(f.readlines()) == 3
+
+
+def test_dry_run_moves_nothing(tmp_path) -> None:
+    out = str(tmp_path)
+    write_cycle_file(out, "VF2_265_1.csv")
+
+    assert migrate(out, PathLayout("{machine}"), dry_run=True) == 1
+    assert tree(out) == ["VF2_265_1.csv"]
+
+
+def test_foreign_files_are_skipped(tmp_path) -> None:
+    out = str(tmp_path)
+    with open(os.path.join(out, "notes.csv"), "w") as f:
+        f.write("a,b\r\n1,2\r\n")
+    # A machine name that doesn't match the filename
+    write_cycle_file(out, "VF2_265_1.csv", machine="ST10")
+    (tmp_path / ".VF2_265_1.csv.tmp").write_text("")
+
+    assert migrate(out, PathLayout("{machine}")) == 0
+    assert tree(out) == [".VF2_265_1.csv.tmp", "VF2_265_1.csv", "notes.csv"]
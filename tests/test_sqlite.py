@@ -0,0 +1,156 @@
+"""
+Tests for the SQLite storage backend in haas_sqlite.py.
+
+Run from the repository root:
+    python -m pytest -q
+"""
+
+import os
+import sqlite3
+from typing import Dict, Iterator, List, Tuple
+
+import pytest
+
+from haas_sqlite import SqliteStore
+from haas_storage import read_csv_rows
+
+Record = Tuple[str, Dict[str, str]]
+
+# The schema before cycles had ids: identical cycles in one second were one row
+OLD_SCHEMA = """
+CREATE TABLE cycles (
+    id INTEGER PRIMARY KEY,
+    machine TEXT NOT NULL,
+    part_number TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    revision TEXT,
+    parts_counter INTEGER,
+    last_part_seconds REAL,
+    fields TEXT NOT NULL
+);
+CREATE UNIQUE INDEX cycles_unique ON cycles (machine, timestamp, fields);
+"""
+
+
+def make_record(
+    part: str = "265-1", counter: int = 1, second: int = 58, machine: str = "VF2"
+) -> Record:
+    """
+    Build one parsed cycle.
+    """
+    return (
+        part,
+        {
+            "Machine": machine,
+            "Timestamp": f"2025-12-09 15:13:{second:02d}",
+            "Part_Number": part,
+            "Parts_Counter": str(counter),
+        },
+    )
+
+
+def counters(store: SqliteStore) -> List[str]:
+    """
+    Parts_Counter of every stored cycle, in query order.
+    """
+    return [data["Parts_Counter"] for _, _, _, data in store.cycles()]
+
+
+@pytest.fixture
+def store(tmp_path) -> Iterator[SqliteStore]:
+    store = SqliteStore(str(tmp_path / "cnc_data.db"))
+    yield store
+    store.close()
+
+
+def test_identical_cycles_with_distinct_ids(store: SqliteStore) -> None:
+    assert store.write_records([make_record(), make_record()], ["a", "b"]) == 2
+    assert counters(store) == ["1", "1"]
+
+
+def test_replayed_cycle_is_ignored(store: SqliteStore) -> None:
+    store.write_records([make_record(counter=1)], ["a"])
+    # The journal replays a cycle that was stored before the crash
+    records = [make_record(counter=1), make_record(counter=2)]
+    assert store.write_records(records, ["a", "b"]) == 1
+    assert counters(store) == ["1", "2"]
+
+
+def test_cycles_without_ids_are_always_stored(store: SqliteStore) -> None:
+    assert store.write_records([make_record()]) == 1
+    assert store.write_records([make_record()]) == 1
+    assert len(counters(store)) == 2
+
+
+def test_old_database_is_migrated(tmp_path) -> None:
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(OLD_SCHEMA)
+    conn.execute(
+        "INSERT INTO cycles (machine, part_number, timestamp, fields)"
+        " VALUES ('VF2', '265-1', '2025-12-09 15:13:58', '{\"Parts_Counter\": \"7\"}')"
+    )
+    conn.commit()
+    conn.close()
+
+    store = SqliteStore(path)
+    try:
+        # The old unique index is gone, so identical cycles are both stored
+        assert store.write_records([make_record(), make_record()], ["a", "b"]) == 2
+        assert counters(store) == ["7", "1", "1"]
+        indexes = [row[1] for row in store.conn.execute("PRAGMA index_list(cycles)")]
+        assert "cycles_unique" not in indexes
+        assert "cycles_cycle_id" in indexes
+    finally:
+        store.close()
+    # Opening a migrated database again changes nothing
+    SqliteStore(path).close()
+
+
+def test_replace_records_upserts(store: SqliteStore) -> None:
+    store.write_records([make_record(counter=1), make_record(counter=2)], ["a", "b"])
+
+    changed = store.replace_records(
+        [make_record(counter=10), make_record(counter=30)], ["a", "c"]
+    )
+    assert changed == 2
+    # "a" is replaced, "b" is kept, "c" is added
+    assert sorted(counters(store)) == ["10", "2", "30"]
+    assert store.conn.execute("SELECT COUNT(*) FROM cycles").fetchone()[0] == 3
+
+
+def test_export_new_appends_only_new_cycles(tmp_path, store: SqliteStore) -> None:
+    out = str(tmp_path / "logs")
+    path = os.path.join(out, "VF2_265-1.csv")
+    store.write_records([make_record(counter=1)], ["a"])
+    assert store.export_new(out) == [path]
+
+    store.write_records([make_record(counter=2, second=59)], ["b"])
+    assert store.export_new(out) == [path]
+    assert [row["Parts_Counter"] for row in read_csv_rows(path)[1]] == ["1", "2"]
+    # Nothing new, nothing written
+    assert store.export_new(out) == []
+
+
+def test_export_new_rewrites_after_replace(tmp_path, store: SqliteStore) -> None:
+    out = str(tmp_path / "logs")
+    path = os.path.join(out, "VF2_265-1.csv")
+    store.write_records([make_record(counter=1), make_record(counter=2)], ["a", "b"])
+    store.export_new(out)
+
+    store.replace_records([make_record(counter=10)], ["a"])
+    assert store.export_new(out) == [path]
+    rows = read_csv_rows(path)[1]
+    assert sorted(row["Parts_Counter"] for row in rows) == ["10", "2"]
+
+
+def test_export_new_rewrites_removed_file(tmp_path, store: SqliteStore) -> None:
+    out = str(tmp_path / "logs")
+    path = os.path.join(out, "VF2_265-1.csv")
+    store.write_records([make_record(counter=1)], ["a"])
+    store.export_new(out)
+    os.remove(path)
+
+    store.write_records([make_record(counter=2, second=59)], ["b"])
+    assert store.export_new(out) == [path]
+    assert [row["Parts_Counter"] for row in read_csv_rows(path)[1]] == ["1", "2"]